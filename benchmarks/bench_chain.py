@@ -0,0 +1,141 @@
+"""Benchmark command throughput and latency on a simulated chain.
+
+Runs headless against pumpy3.sim on a pseudo-terminal (Linux and macOS), so
+it needs no pumps. For every combination of baudrate and timeout it measures
+the latency of common pump operations and the time to configure all pumps
+from scratch, and writes the results as JSON:
+
+    python benchmarks/bench_chain.py --pumps 4 --baudrates 9600 19200 --output results.json
+
+Compare the output of two versions to catch regressions in Pump.issue_command
+and the setters before a release.
+"""
+import argparse
+import itertools
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from importlib import metadata
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pumpy3
+from pumpy3.sim import SimulatedChain, SimulatedModel33, SimulatedPHD2000
+
+def make_rig(npumps: int) -> tuple[list, list]:
+    """Return simulated pumps and matching pump classes, alternating Model 33 and PHD 2000 pumps with addresses from 1."""
+    simulated, classes = [], []
+    for address in range(1, npumps + 1):
+        if address % 2:
+            simulated.append(SimulatedModel33(address))
+            classes.append(pumpy3.PumpModel33)
+        else:
+            simulated.append(SimulatedPHD2000(address, refill=True))
+            classes.append(pumpy3.PumpPHD2000_Refill)
+    return simulated, classes
+
+def configure(pump: pumpy3.Pump, rate: float):
+    """Set up a pump for an experiment, as a typical script does at the start."""
+    if isinstance(pump, pumpy3.PumpModel33):
+        pump.set_parallel_reciprocal("ON")
+        for syringe in (1, 2):
+            pump.set_diameter(14.5, syringe=syringe)
+            pump.set_rate(rate, "ml/hr", syringe=syringe)
+        pump.set_direction("INF")
+    else:
+        pump.set_mode("PMP")
+        pump.set_diameter(14.5)
+        pump.set_rate(rate, "ml/hr")
+        pump.set_refill_rate(rate, "ml/hr")
+
+def summarise(latencies: list[float]) -> dict:
+    """Return count, throughput and latency percentiles (in ms) of a list of latencies in seconds."""
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    total = sum(latencies)
+    return {
+        'count': len(latencies),
+        'per_second': len(latencies) / total,
+        'mean_ms': 1000 * total / len(latencies),
+        'p50_ms': 1000 * quantiles[49],
+        'p95_ms': 1000 * quantiles[94],
+        'p99_ms': 1000 * quantiles[98],
+        'max_ms': 1000 * max(latencies),
+    }
+
+def timed(function, repeat: int) -> list[float]:
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def bench(npumps: int, baudrate: int, timeout: float, repeat: int, response_delay: float) -> dict:
+    """Benchmark one chain configuration and return the results."""
+    simulated, classes = make_rig(npumps)
+    with SimulatedChain(simulated, baudrate=baudrate, response_delay=response_delay) as sim:
+        with pumpy3.Chain(sim.port, baudrate=baudrate, timeout=timeout) as chain:
+            pumps = [cls(chain, address=address, name=f"pump{address}") for address, cls in enumerate(classes, start=1)]
+
+            def configure_all(i):
+                for pump in pumps:
+                    pump.forget_settings()
+                    configure(pump, rate=10 + i % 2)
+
+            # every call uses the next pump, and each pump gets another rate each time so that remembered settings are never reused;
+            # states and statuses are always read from the pump (max_age=0), so every call is a transaction on the chain
+            cycle = itertools.cycle(pumps)
+            operations = {
+                'get_state': lambda i: next(cycle).get_state(max_age=0),
+                'get_status': lambda i: next(cycle).get_status(max_age=0),
+                'set_rate': lambda i: next(cycle).set_rate(10 + (i // npumps) % 2, "ml/hr"),
+                'run_stop': lambda i: (pump := next(cycle)).run() or pump.stop(),
+                'log_all_parameters': lambda i: next(cycle).log_all_parameters(),
+            }
+            results = {name: summarise(timed(operation, repeat)) for name, operation in operations.items()}
+            results['configure_all'] = summarise(timed(configure_all, max(2, repeat // 10)))
+            for pump in pumps:
+                pump.stop()
+    return {'pumps': npumps, 'baudrate': baudrate, 'timeout': timeout, 'response_delay': response_delay, 'results': results}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pumps', type=int, nargs='+', default=[1, 4], help="numbers of pumps on the chain")
+    parser.add_argument('--baudrates', type=int, nargs='+', default=[9600, 19200])
+    parser.add_argument('--timeouts', type=float, nargs='+', default=[0.1, 1.0], help="Chain timeouts in seconds")
+    parser.add_argument('--repeat', type=int, default=50, help="calls per operation")
+    parser.add_argument('--response-delay', type=float, default=0.001, help="time in seconds the simulated pumps take to answer")
+    parser.add_argument('--output', type=Path, help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+    if args.repeat < 2:
+        parser.error("--repeat must be at least 2")
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        version = metadata.version('pumpy3')
+    except metadata.PackageNotFoundError:
+        version = None
+    report = {
+        'pumpy3': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'runs': [],
+    }
+    for npumps, baudrate, timeout in itertools.product(args.pumps, args.baudrates, args.timeouts):
+        print(f"{npumps} pumps at {baudrate} baud with timeout {timeout} s", file=sys.stderr)
+        report['runs'].append(bench(npumps, baudrate, timeout, args.repeat, args.response_delay))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
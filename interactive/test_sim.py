@@ -0,0 +1,208 @@
+"""Checks against simulated pumps (pumpy3.sim), so they run without any hardware:
+
+    python -m pytest interactive/test_sim.py
+"""
+import asyncio
+import os
+import queue
+import time
+
+import pytest
+
+import pumpy3
+from pumpy3.sim import SimulatedChain, SimulatedModel33
+
+# the simulated chain is exposed on a pseudo-terminal for checks that depend on timing
+posix_only = pytest.mark.skipif(os.name != 'posix', reason="needs a pseudo-terminal")
+
+def count_commands(chain: pumpy3.Chain) -> list:
+    """Return a list that gets the instruction of every transaction on chain appended."""
+    sent = []
+    chain.add_observer(lambda record: sent.append(record.instruction))
+    return sent
+
+def test_reapplying_two_syringes_sends_nothing():
+    chain = pumpy3.Chain(pumpy3.LoopbackTransport(SimulatedChain([SimulatedModel33(1)])))
+    pump = pumpy3.PumpModel33(chain, address=1)
+    sent = count_commands(chain)
+    def configure():
+        for syringe, diameter, rate in ((1, 14.5, 5.0), (2, 10.0, 6.0)):
+            pump.set_diameter(diameter, syringe)
+            pump.set_rate(rate, "ml/hr", syringe)
+    configure()
+    assert sent
+    sent.clear()
+    configure()
+    assert sent == []
+    # syringe 0 acts on syringe A, so it shares what is remembered of A
+    pump.set_rate(5.0, "ml/hr")
+    assert sent == []
+
+@posix_only
+def test_reply_slower_than_learned_is_still_read():
+    with SimulatedChain([SimulatedModel33(1)]) as sim:
+        with pumpy3.Chain(sim.port, timeout=0.2, adaptive_timeout=True) as chain:
+            pump = pumpy3.PumpModel33(chain, address=1)
+            for i in range(chain.timeout_min_samples):
+                pump.get_rate()
+                pump.get_diameter()
+                pump.get_version()
+            assert chain.learned_timeouts()[('01', 'RAT')] < 0.06
+            sim.response_delay = 0.06
+            assert pump.get_rate() == (1.0, "ml/hr")
+            assert pump.get_diameter() == 10.0
+            assert pump.get_version() == SimulatedModel33.firmware_version
+            assert chain.slow_replies == 3
+
+@posix_only
+def test_usually_slow_reply_is_waited_for_longer_than_the_timeout():
+    with SimulatedChain([SimulatedModel33(1)]) as sim:
+        with pumpy3.Chain(sim.port, timeout=0.08, adaptive_timeout=True) as chain:
+            chain.timeout_margin = 6.0
+            pump = pumpy3.PumpModel33(chain, address=1)
+            sim.response_delay = 0.02
+            for i in range(chain.timeout_min_samples):
+                pump.get_rate()
+            assert chain.learned_timeouts()[('01', 'RAT')] > 0.13
+            sim.response_delay = 0.1
+            assert pump.get_rate() == (1.0, "ml/hr")
+            assert chain.slow_replies == 0
+
+class SlowStartModel33(SimulatedModel33):
+    """Takes longer than the chain timeout to answer its first RUN."""
+    slow_runs = 1
+
+    def cmd_RUN(self, letter: str, value: str):
+        if self.slow_runs:
+            self.slow_runs -= 1
+            time.sleep(0.07)
+        return super().cmd_RUN(letter, value)
+
+@posix_only
+def test_late_run_reply_does_not_shift_replies():
+    with SimulatedChain([SlowStartModel33(1)]) as sim:
+        with pumpy3.Chain(sim.port, timeout=0.05) as chain:
+            pump = pumpy3.PumpModel33(chain, address=1)
+            pump.run() # the first RUN gets no reply in time, the one run() sends again is answered with NA
+            assert pump.get_diameter() == 10.0
+            assert pump.get_rate() == (1.0, "ml/hr")
+            assert pump.get_version() == SimulatedModel33.firmware_version
+            assert chain.discarded_replies == 1
+
+def test_observers_of_a_failed_transaction_run_after_the_chain_is_released():
+    sim = SimulatedChain([SimulatedModel33(1)])
+    connected = [True]
+    def handle(line: bytes):
+        if not connected[0]:
+            raise OSError("port is gone")
+        return sim.handle(line)
+    chain = pumpy3.Chain(pumpy3.LoopbackTransport(handle))
+    pump = pumpy3.PumpModel33(chain, address=1)
+    seen = []
+    chain.add_observer(lambda record: seen.append((record.outcome, chain._bus_owner)))
+    connected[0] = False
+    with pytest.raises(OSError):
+        pump.get_rate()
+    assert seen == [('OSError', None)]
+
+def test_async_pump_sends_the_same_commands_as_the_blocking_one():
+    def session(pump):
+        yield pump.set_rate(5.0, "ml/hr", 1)
+        yield pump.set_diameter(12.0, 2, verify=pumpy3.VERIFY_DEFERRED)
+        yield pump.run()
+        yield pump.stop()
+        yield pump.snapshot()
+    chain = pumpy3.Chain(pumpy3.LoopbackTransport(SimulatedChain([SimulatedModel33(1)])))
+    pump = pumpy3.PumpModel33(chain, address=1)
+    sent = count_commands(chain)
+    *_, snapshot = session(pump)
+    async def main():
+        chain = pumpy3.AsyncChain(pumpy3.LoopbackTransport(SimulatedChain([SimulatedModel33(1)])))
+        pump = await pumpy3.AsyncPumpModel33.create(chain, address=1)
+        sent = count_commands(chain)
+        results = [await result for result in session(pump)]
+        return sent, results[-1]
+    async_sent, async_snapshot = asyncio.run(main())
+    assert async_sent == sent
+    assert async_snapshot.syringes == snapshot.syringes
+
+def test_discover_asks_each_address_once():
+    sim = SimulatedChain([SimulatedModel33(1)])
+    sent = []
+    def handle(line: bytes):
+        sent.append(line)
+        return sim.handle(line)
+    chain = pumpy3.Chain(pumpy3.LoopbackTransport(handle))
+    pumps = chain.discover(range(3))
+    assert [type(pump) for pump in pumps] == [pumpy3.PumpModel33]
+    assert pumps[0].firmware_version == SimulatedModel33.firmware_version
+    assert sent == [b'00VER', b'01VER', b'02VER']
+    assert chain.is_open
+
+@pytest.mark.parametrize('garbled', [b'\r\n', b'\r\n\r\n'])
+def test_watchdog_survives_a_truncated_reply(garbled):
+    sim = SimulatedChain([SimulatedModel33(1)])
+    truncate = [False]
+    def handle(line: bytes):
+        reply = sim.handle(line)
+        return garbled if truncate[0] and line.endswith(b'MOD') else reply
+    chain = pumpy3.Chain(pumpy3.LoopbackTransport(handle), timeout=0.02)
+    pump = pumpy3.PumpModel33(chain, address=1)
+    events = queue.Queue()
+    with pumpy3.Watchdog([chain], interval=0.05, events=events) as watchdog:
+        while pump not in watchdog.states: # the first poll has nothing to compare with, so reports nothing
+            time.sleep(0.01)
+        truncate[0] = True
+        event = events.get(timeout=2)
+        assert event.kind == pumpy3.EVENT_DISCONNECTED
+        assert event.error is not None
+        truncate[0] = False
+        assert events.get(timeout=2).kind == pumpy3.EVENT_RECONNECTED
+        assert watchdog._thread.is_alive()
+
+def test_watchdog_does_not_poll_a_pump_that_just_answered():
+    chain = pumpy3.Chain(pumpy3.LoopbackTransport(SimulatedChain([SimulatedModel33(1)])))
+    pump = pumpy3.PumpModel33(chain, address=1)
+    sent = count_commands(chain)
+    with pumpy3.Watchdog([chain], interval=0.2) as watchdog:
+        finish = time.monotonic() + 0.5
+        while time.monotonic() < finish:
+            pump.get_rate()
+            time.sleep(0.02)
+        assert watchdog.states[pump] in pump.stopped_status
+    assert sent and '01MOD' not in sent
+    sent.clear()
+    with pumpy3.Watchdog([chain], interval=0.2): # nothing else talks to the pump, so it is polled
+        time.sleep(0.5)
+    assert len(sent) >= 2 and set(sent) == {'01MOD'}
+
+def test_table_profile_with_a_step():
+    profile = pumpy3.RateProfile.table([(0, 1), (10, 1), (10, 5), (20, 5)], step_interval=5)
+    assert profile.setpoints == [(0, 1), (5, 1), (10, 5), (15, 5), (20, 5)]
+    assert profile.rate_at(9.9) == 1 and profile.rate_at(10) == 5
+
+class SlowDiameterModel33(SimulatedModel33):
+    """Takes longer than the chain timeout to tell its diameter while slow is set."""
+    slow = False
+
+    def cmd_DIA(self, letter: str, value: str):
+        if self.slow:
+            time.sleep(0.07)
+        return super().cmd_DIA(letter, value)
+
+@posix_only
+@pytest.mark.parametrize('stop', [lambda pump: pump.stop(), lambda pump: pump.serialcon.emergency_stop_all()], ids=['stop', 'emergency_stop_all'])
+def test_stop_is_not_confirmed_by_a_late_reply(stop):
+    sim_pump = SlowDiameterModel33(1)
+    with SimulatedChain([sim_pump]) as sim:
+        with pumpy3.Chain(sim.port, timeout=0.05) as chain:
+            pump = pumpy3.PumpModel33(chain, address=1)
+            pump.run()
+            sim_pump.slow = True
+            with pytest.raises(pumpy3.PumpNoResponseError):
+                pump.get_diameter()
+            # the late reply to DIA still shows the pump running, STP gets it as its reply
+            stop(pump)
+            assert not sim_pump.running
+            sim_pump.slow = False
+            assert pump.get_diameter() == 10.0
@@ -3,4 +3,11 @@
 __version__ = "0.1.0"
 __author__ = "WetenSchaap"
 
-from .pump import *
\ No newline at end of file
+from .pump import *
+from .aio import AsyncChain, AsyncPump, AsyncPumpModel33, AsyncPumpPHD2000, AsyncPumpPHD2000_Refill, AsyncPumpPHD2000_NoRefill
+from .pool import ChainPool
+from .watchdog import Watchdog, PumpEvent, EVENT_STARTED, EVENT_STOPPED, EVENT_STALLED, EVENT_DISCONNECTED, EVENT_RECONNECTED
+from .volume import VolumeIntegrator
+from .profiles import RateProfile, ProfileRunner, ProfileStep, ProfileReport
+from .transport import FdTransport, TcpTransport, LoopbackTransport
+from .server import PumpServer, PumpClient, RemotePump
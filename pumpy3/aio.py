@@ -0,0 +1,497 @@
+"""asyncio versions of Chain and the pump classes.
+
+AsyncChain talks to its pumps without blocking the event loop, so many
+pumps on many ports can be controlled from a single thread. The pump classes
+are the blocking ones in pump.py, except that every method that talks to the
+pump is a coroutine:
+
+    async def main():
+        async with AsyncChain("/dev/ttyUSB0") as chain:
+            pump = await AsyncPumpPHD2000_NoRefill.create(chain, address=1, name="Janet")
+            await pump.set_rate(2, "ml/hr")
+            await pump.run()
+
+What is sent to the pumps and how their replies are handled is shared with
+the blocking classes: those methods are written as steps (see
+pumpy3.pump._run_steps), which are run here with await. This module only
+adds the waiting for the chain and for replies.
+"""
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+from .pump import (
+    _COMMAND_PRIORITY,
+    _PROMPT,
+    PRIORITY_NORMAL,
+    PRIORITY_RUN,
+    PRIORITY_STOP,
+    Chain,
+    Pump,
+    PumpError,
+    PumpModel33,
+    PumpPHD2000,
+    PumpPHD2000_NoRefill,
+    PumpPHD2000_Refill,
+    SerialTransport,
+    SyncReport,
+    Transport,
+    _model_from_version,
+    _probe_data,
+    _prompt_address,
+)
+
+logger = logging.getLogger(__name__)
+
+async def _run_steps_async(steps):
+    """Carry out the steps of a pump operation with await, and return its result. See pumpy3.pump._run_steps()."""
+    try:
+        request = next(steps)
+        while True:
+            pump, *args = request
+            try:
+                response = await pump.issue_command(*args)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(response)
+    except StopIteration as done:
+        return done.value
+
+class AsyncChain:
+    """Create AsyncChain object, the asyncio version of Chain.
+
+    Like Chain, it talks to the pumps over a Transport, by default a
+    SerialTransport. Where the transport has a file descriptor (see
+    Transport.fileno()) and the event loop supports it, the loop is woken up
+    when a reply arrives, otherwise (e.g. on Windows) the transport is polled
+    every millisecond while waiting for a reply.
+    Transactions are ordered by priority and arrival like Chain.reserve().
+    Observers get a TransactionRecord of every transaction, see
+    Chain.add_observer(). trace_size keeps recent transactions for the
+    log like Chain does.
+    """
+    poll_interval = 0.001 # seconds between checks of the transport, if it cannot wake up the event loop
+
+    timeout_quantile = Chain.timeout_quantile
+    timeout_margin = Chain.timeout_margin
+    timeout_window = Chain.timeout_window
+    timeout_min_samples = Chain.timeout_min_samples
+    min_timeout = Chain.min_timeout
+    max_timeout = Chain.max_timeout
+
+    def __init__(self, port: 'str | Transport', baudrate:int=9600, timeout:float=0.1, trace_size:int=0, adaptive_timeout:bool=False):
+        """
+        :param port: Port of pump at PC (or a pyserial URL), or a Transport to talk over
+        :type port: str or Transport
+        :param baudrate: Baudrate set on the pumps, not used when a Transport is given
+        :type baudrate: int
+        :param timeout: Maximum time to wait for a reply in seconds
+        :type timeout: float
+        :param trace_size: Number of recent transactions to log when a command fails, 0 to disable (default)
+        :type trace_size: int
+        :param adaptive_timeout: Learn the time each pump takes to answer each command, see Chain.reply_timeout() (default False)
+        :type adaptive_timeout: bool
+        """
+        self.timeout = timeout
+        self.adaptive_timeout = adaptive_timeout
+        self._first_byte_times = {}
+        self._learned_timeouts = {}
+        self.pumps = {}
+        self.transport = port if isinstance(port, Transport) else SerialTransport(port, baudrate, timeout)
+        self.port = self.transport.port
+        self._bus_condition = None # created on first use, inside the event loop
+        self._bus_queue = []
+        self._bus_tickets = itertools.count()
+        self._bus_owner = None
+        self._bus_depth = 0
+        self.observers = []
+        self.first_byte_time = None
+        self.discarded_replies = 0
+        self._out_of_step_since = None
+        self.slow_replies = 0
+        self.trace = collections.deque(maxlen=trace_size) if trace_size else None
+        logger.info('AsyncChain created on %s',self.port)
+
+    def __repr__(self):
+        """Return string representation of AsyncChain object."""
+        return f"Async pump chain on {self.port}"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    baudrate = Chain.baudrate
+    is_open = Chain.is_open
+    open = Chain.open
+    close = Chain.close
+    write = Chain.write
+    add_observer = Chain.add_observer
+    remove_observer = Chain.remove_observer
+    _notify_observers = Chain._notify_observers
+    format_trace = Chain.format_trace
+    reply_timeout = Chain.reply_timeout
+    learn_reply_time = Chain.learn_reply_time
+    learned_timeouts = Chain.learned_timeouts
+    mark_out_of_step = Chain.mark_out_of_step
+    # steps of the operations on several pumps, see pumpy3.pump._run_steps()
+    _emergency_stop = Chain._emergency_stop
+    _verify_all = Chain._verify_all
+    _send_together = Chain._send_together
+    _confirm_together = Chain._confirm_together
+    _snapshot_all = Chain._snapshot_all
+
+    def reserve(self, priority: int = PRIORITY_NORMAL):
+        """Reserve the chain for the current task, for the duration of the async with-block. See Chain.reserve().
+
+        :param priority: PRIORITY_STOP, PRIORITY_RUN or PRIORITY_NORMAL (default)
+        :type priority: int
+        """
+        return _Reservation(self, priority)
+
+    async def drain(self, wait_quiet: bool = True) -> bytes:
+        """Discard input that arrived outside of a transaction, and return it, see Chain.drain().
+
+        :param wait_quiet: Wait for the chain to go quiet after mark_out_of_step() (default)
+        :type wait_quiet: bool
+        """
+        stale = self.transport.flush()
+        if wait_quiet and self._out_of_step_since is not None:
+            quiet_until = self._out_of_step_since + self.timeout
+            while (remaining := quiet_until - time.monotonic()) > 0:
+                await self._wait_readable(remaining)
+                chunk = self.transport.read(256, 0)
+                if chunk:
+                    stale += chunk
+                    quiet_until = time.monotonic() + self.timeout
+            self._out_of_step_since = None
+        if stale:
+            self.discarded_replies += 1
+            logger.warning('Discarded %r on %s, probably a late reply to an earlier command', stale, self.port)
+        return stale
+
+    async def resync(self, pump: 'AsyncPump | None' = None) -> bool:
+        """Bring commands and replies back in step in a single transaction, see Chain.resync().
+
+        :param pump: Pump on this chain to use, defaults to the first registered pump
+        :type pump: AsyncPump, optional
+        :return: True if the chain is in step again, False if the pump did not answer within the timeout of the chain
+        :rtype: bool
+        """
+        if pump is None:
+            if not self.pumps:
+                raise PumpError(f'No pumps registered on {self.port} to resynchronise with')
+            pump = next(iter(self.pumps.values()))
+        address = int(pump.address)
+        async with self.reserve():
+            self.mark_out_of_step()
+            await self.drain()
+            self.write(f'{pump.address}VER\r'.encode())
+            deadline = time.monotonic() + self.timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                reply = await self.read_reply(timeout=remaining)
+                if not reply:
+                    break
+                if _prompt_address(reply.decode(errors='replace')) == address:
+                    logger.info('%s is in step again, %s answered', self.port, pump.name)
+                    return True
+                self.discarded_replies += 1
+                logger.warning('Discarded %r on %s while resynchronising', reply, self.port)
+        logger.error(f'Could not resynchronise {self.port}: {pump.name} did not answer')
+        return False
+
+    async def read_reply(self, size: int = 80, timeout: float | None = None, first_byte_timeout: float | None = None, expected_within: float | None = None) -> bytes:
+        """Read a single reply from the chain, see Chain.read_reply().
+
+        :param size: Maximum number of bytes to read
+        :type size: int
+        :param timeout: Maximum time to wait for the reply in seconds, defaults to the timeout of the chain
+        :type timeout: float, optional
+        :param first_byte_timeout: If given, the reply has to start within this time, and then gets timeout to complete
+        :type first_byte_timeout: float, optional
+        :param expected_within: If given, the time the reply usually starts within. A reply that has not started by then is counted in slow_replies, and waited for up to timeout. If expected_within is longer than timeout, the reply gets expected_within to start, and then timeout to complete.
+        :type expected_within: float, optional
+        :return: Raw reply, can be incomplete or empty if the timeout expired
+        :rtype: bytes
+        """
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout if timeout is None else timeout
+        if first_byte_timeout is None and expected_within is not None and expected_within > timeout:
+            first_byte_timeout = expected_within # a command the pump is usually slow to answer gets more time to start
+        started = loop.time()
+        if first_byte_timeout is not None:
+            deadline = started + first_byte_timeout
+        elif expected_within is not None and expected_within < timeout:
+            deadline = started + expected_within
+        else:
+            deadline = started + timeout
+            expected_within = None
+        reply = bytearray()
+        self.first_byte_time = None
+        while len(reply) < size:
+            chunk = self.transport.read(size - len(reply), 0)
+            if chunk:
+                if not reply:
+                    self.first_byte_time = time.perf_counter()
+                    if first_byte_timeout is not None:
+                        deadline = loop.time() + timeout
+                    elif expected_within is not None:
+                        deadline = started + timeout
+                reply += chunk
+                if _PROMPT.search(reply, max(0, len(reply) - 4)):
+                    break
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                if reply or expected_within is None:
+                    break
+                self.slow_replies += 1
+                logger.info('No reply within the usual %.1f ms on %s, waiting up to %.1f ms', expected_within * 1000, self.port, timeout * 1000)
+                deadline = started + timeout
+                expected_within = None
+                continue
+            await self._wait_readable(remaining)
+        return bytes(reply)
+
+    async def discover(self, addresses=range(100), timeout: float | None = None) -> list:
+        """Find the pumps on this chain, and return a connected pump object for each of them, see Chain.discover().
+
+        :param addresses: Addresses to try, defaults to all addresses (0 to 99)
+        :type addresses: iterable of int
+        :param timeout: Time in seconds to wait for a pump to start replying, defaults to 20 ms plus the time to send a command at the baudrate
+        :type timeout: float, optional
+        :return: The pumps found, in the order of addresses
+        :rtype: list of AsyncPump
+        """
+        if timeout is None:
+            timeout = 0.02 + (10 * 11 / self.baudrate if self.baudrate else 0.0)
+        found = []
+        for address in addresses:
+            version = await self._probe(address, 'VER', timeout)
+            if version is None:
+                continue
+            model = _model_from_version(version)
+            if model == 'Model33':
+                cls = AsyncPumpModel33
+            elif model == 'PHD2000':
+                refill = await self._probe(address, 'RFR', timeout)
+                cls = AsyncPumpPHD2000_NoRefill if refill is None or '?' in refill else AsyncPumpPHD2000_Refill
+            else:
+                logger.warning('Unknown pump with firmware version %s at address %02d on %s, using it as a generic AsyncPump', version, address, self.port)
+                cls = AsyncPump
+            pump = self.pumps.get(f'{address:02}')
+            if type(pump) is not cls:
+                pump = await cls.create(self, address=address, name=f'{model or "Pump"} {address:02}', firmware_version=version)
+            found.append(pump)
+        logger.info('Discovered %s pump(s) on %s: %s', len(found), self.port, ", ".join(pump.name for pump in found))
+        return found
+
+    async def _probe(self, address: int, command: str, timeout: float) -> str | None:
+        """Send a command to an address, return the data line of the reply, or None if no pump at that address replied."""
+        async with self.reserve():
+            self.transport.flush() # a late reply to an earlier probe
+            self.write(f'{address:02}{command}\r'.encode())
+            reply = await self.read_reply(first_byte_timeout=timeout)
+        return _probe_data(reply, address)
+
+    async def _wait_readable(self, timeout: float):
+        """Wait until the transport has input or timeout expires."""
+        fileno = self.transport.fileno()
+        if fileno is not None:
+            loop = asyncio.get_running_loop()
+            readable = loop.create_future()
+            def wake_up():
+                if not readable.done():
+                    readable.set_result(None)
+            try:
+                loop.add_reader(fileno, wake_up)
+            except NotImplementedError:
+                pass # the loop cannot watch it (e.g. the proactor loop on Windows): poll instead
+            else:
+                try:
+                    await asyncio.wait_for(readable, timeout)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    loop.remove_reader(fileno)
+                return
+        await asyncio.sleep(min(timeout, self.poll_interval))
+
+    async def snapshot_all(self) -> dict:
+        """Take a snapshot of every registered pump, see Chain.snapshot_all().
+
+        :return: Snapshots by pump address
+        :rtype: dict
+        :raises PumpError: if one or more pumps could not be read, after all pumps have been tried
+        """
+        return await _run_steps_async(self._snapshot_all())
+
+    async def run_together(self, pumps: list | None = None, already_running_ok: bool = True) -> SyncReport:
+        """Start several pumps as close together in time as possible, see Chain.run_together().
+
+        :raises PumpError: if one or more pumps could not be confirmed to run, after all pumps have been tried
+        """
+        pumps = list(self.pumps.values()) if pumps is None else list(pumps)
+        await _run_steps_async(self._verify_all(pumps))
+        return await self._together(pumps, 'RUN', PRIORITY_RUN, already_running_ok)
+
+    async def stop_together(self, pumps: list | None = None, already_stopped_ok: bool = True) -> SyncReport:
+        """Stop several pumps as close together in time as possible, see Chain.stop_together().
+
+        :raises PumpError: if one or more pumps could not be confirmed to have stopped, after all pumps have been tried
+        """
+        pumps = list(self.pumps.values()) if pumps is None else list(pumps)
+        return await self._together(pumps, 'STP', PRIORITY_STOP, already_stopped_ok)
+
+    async def _together(self, pumps: list, command: str, priority: int, unchanged_ok: bool) -> SyncReport:
+        """Send command ('RUN' or 'STP') to pumps right after each other, then confirm their states."""
+        async with self.reserve(priority):
+            sent = await _run_steps_async(self._send_together(pumps, command, unchanged_ok))
+        return await _run_steps_async(self._confirm_together(command, *sent))
+
+    async def emergency_stop_all(self):
+        """Stop all pumps on this chain as fast as possible, see Chain.emergency_stop_all().
+
+        :raises PumpError: if one or more pumps could not be confirmed to have stopped
+        """
+        async with self.reserve(PRIORITY_STOP):
+            await _run_steps_async(self._emergency_stop())
+
+class _Reservation:
+    """Async context manager returned by AsyncChain.reserve()."""
+    def __init__(self, chain: AsyncChain, priority: int):
+        self.chain = chain
+        self.priority = priority
+
+    async def __aenter__(self) -> float:
+        chain = self.chain
+        if chain._bus_condition is None:
+            chain._bus_condition = asyncio.Condition()
+        me = asyncio.current_task()
+        async with chain._bus_condition:
+            if chain._bus_owner is me:
+                chain._bus_depth += 1
+                return 0.0
+            ticket = (self.priority, next(chain._bus_tickets))
+            queued = time.perf_counter()
+            heapq.heappush(chain._bus_queue, ticket)
+            try:
+                while chain._bus_owner is not None or chain._bus_queue[0] != ticket:
+                    await chain._bus_condition.wait()
+            except BaseException:
+                # e.g. cancelled while waiting: give up our place in the queue
+                chain._bus_queue.remove(ticket)
+                heapq.heapify(chain._bus_queue)
+                chain._bus_condition.notify_all()
+                raise
+            heapq.heappop(chain._bus_queue)
+            chain._bus_owner = me
+            chain._bus_depth = 1
+            return time.perf_counter() - queued
+
+    async def __aexit__(self, exception_type, exception_value, exception_traceback):
+        chain = self.chain
+        async with chain._bus_condition:
+            chain._bus_depth -= 1
+            if chain._bus_depth == 0:
+                chain._bus_owner = None
+                chain._bus_condition.notify_all()
+
+class AsyncPump(Pump):
+    """Base class for AsyncPump objects, the asyncio version of Pump.
+
+    Create pumps with `await AsyncPumpXXX.create(chain, address, name)`, which
+    also checks the connection to the pump like creating a Pump does. All
+    methods of Pump that talk to the pump return a coroutine here; only the
+    I/O is replaced, the steps of the methods are those of Pump.
+    """
+    _drive = staticmethod(_run_steps_async)
+
+    def __init__(self, chain: AsyncChain, address: int = 0, name: str = 'Pump'):
+        """Does not talk to the pump yet, use create() instead, or await connect() before using the pump."""
+        self._setup(chain, address, name)
+
+    @classmethod
+    async def create(cls, chain: AsyncChain, address: int = 0, name: str | None = None, firmware_version: str | None = None):
+        """Create a pump and connect to it.
+
+        Parameters
+        ----------
+        chain : AsyncChain
+            Chain the pump is connected to.
+        address : int, optional
+            Address set on the pump (default is 0).
+        name : str, optional
+            Name for logging, defaults to the name used by the pump class.
+        firmware_version : str, optional
+            Firmware version read from the pump already, see Pump.connect() (default is None, ask the pump).
+        """
+        pump = cls(chain, address) if name is None else cls(chain, address, name)
+        await pump.connect(firmware_version)
+        return pump
+
+    async def read(self, bytes: int = 80, expected_within: float | None = None) -> str:
+        """Read a reply from the pump, see Pump.read()."""
+        return self._decode_reply(await self.serialcon.read_reply(bytes, expected_within=expected_within))
+
+    async def _read_own_reply(self, expected_within: float | None = None) -> str:
+        """Read the reply to a command, skipping replies of other pumps, see Pump._read_own_reply()."""
+        reply = await self.read(80, expected_within)
+        for attempt in range(3):
+            if not self._foreign_reply(reply):
+                return reply
+            if attempt < 2:
+                reply = await self.read(80)
+        await self.serialcon.resync(self)
+        return ''
+
+    async def issue_command(self, command: str, value: str = '', units: str = '', syringe: int=0) -> list[str]:
+        """Write serial command to pump, and listen to response. See Pump.issue_command()."""
+        instruction, encoded, changes_status = self._begin_command(command, value, units, syringe)
+        chain = self.serialcon
+        error = None
+        async with chain.reserve(_COMMAND_PRIORITY.get(command, PRIORITY_NORMAL)) as queue_wait:
+            await chain.drain(wait_quiet=command != 'STP')
+            started = time.perf_counter()
+            try:
+                self.write(encoded)
+                reply = await self._read_own_reply(chain.reply_timeout(self.address, command))
+            except BaseException as e:
+                reply, error = '', e
+            timing = self._end_command(command, changes_status, reply, queue_wait, started, error)
+        return self._finish_command(command, syringe, instruction, reply, timing, error)
+
+    async def sleep_with_heartbeat(self, sleep_time: float, beat_interval: float = 5, error_wakeup: bool = False, volumes=None, min_beat_interval: float = 1.0, max_beat_interval: float = 60.0):
+        """Sleep while checking the pump state, see Pump.sleep_with_heartbeat(). Other tasks keep running meanwhile."""
+        loop = asyncio.get_running_loop()
+        end_time = loop.time() + sleep_time
+        if len(self.stalled_status) == 0 and error_wakeup:
+            logger.warning("%s: This pump does not have automatic stall detection! Error detection will *not* fail when syringe is depleted!", self.name)
+        while loop.time() < end_time:
+            state = await self.get_state(max_age=min_beat_interval)
+            if state in self.stalled_status and error_wakeup:
+                raise PumpError(f'{self.name}: pump has stalled, please check the syringe(s)!')
+            if volumes is not None:
+                interval = volumes.check_interval(self, beat_interval, min_beat_interval, max_beat_interval)
+            else:
+                interval = beat_interval
+            await asyncio.sleep(max(0.0, min(interval, end_time - loop.time())))
+
+class AsyncPumpModel33(AsyncPump, PumpModel33):
+    def __init__(self, chain:AsyncChain, address:int=0, name:str='Model33'):
+        super().__init__(chain,address,name)
+
+class AsyncPumpPHD2000(AsyncPump, PumpPHD2000):
+    def __init__(self, chain:AsyncChain, address:int=0, name:str='PHD2000'):
+        super().__init__(chain,address,name)
+
+class AsyncPumpPHD2000_Refill(AsyncPumpPHD2000, PumpPHD2000_Refill):
+    pass
+
+class AsyncPumpPHD2000_NoRefill(AsyncPumpPHD2000, PumpPHD2000_NoRefill):
+    pass
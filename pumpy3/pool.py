@@ -0,0 +1,181 @@
+"""Drive several chains (serial ports) at the same time.
+
+Every chain is a bottleneck of its own: only one command can be on a port at
+a time, but different ports do not wait for each other. ChainPool gives each
+chain a worker thread, so an action on all chains takes as long as the
+slowest chain instead of the sum of all chains:
+
+    with ChainPool([Chain("COM2"), Chain("COM3")]) as pool:
+        for chain in pool.chains:
+            chain.discover()
+        pool.run_all()
+        print(pool.poll_states())
+        pool.stop_all()
+"""
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from .pump import Chain, Pump, PumpError
+
+logger = logging.getLogger(__name__)
+
+class ChainPool:
+    """Create ChainPool object, owning several chains with one worker thread each.
+
+    Work for a chain is done by its worker in order of submission. Stopping
+    does not queue behind other work: stop_all() and emergency_stop_all()
+    use their own threads, and the chains let stop commands go first (see
+    Chain.reserve).
+    """
+    def __init__(self, chains: list[Chain] = ()):
+        """
+        :param chains: Chains to drive, more can be added with add()
+        :type chains: list of Chain
+        """
+        self.chains = []
+        self._workers = {}
+        for chain in chains:
+            self.add(chain)
+
+    def __repr__(self):
+        return f"Pool of {len(self.chains)} chains on {', '.join(chain.port for chain in self.chains)}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def add(self, chain: Chain):
+        """Add a chain to the pool, and start a worker thread for it."""
+        if chain in self._workers:
+            raise ValueError(f'{chain} is already in the pool')
+        self.chains.append(chain)
+        self._workers[chain] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'ChainPool {chain.port}')
+
+    def close(self, close_chains: bool = True):
+        """Wait for the work that was submitted, stop the worker threads and close the chains.
+
+        :param close_chains: Also close the serial ports of the chains (default)
+        :type close_chains: bool
+        """
+        for worker in self._workers.values():
+            worker.shutdown(wait=True)
+        if close_chains:
+            for chain in self.chains:
+                chain.close()
+
+    @property
+    def pumps(self) -> list[Pump]:
+        """All pumps registered on the chains of the pool."""
+        return [pump for chain in self.chains for pump in chain.pumps.values()]
+
+    def submit(self, chain: Chain, function, *args, **kwargs) -> Future:
+        """Run function(*args, **kwargs) on the worker of chain, and return its Future.
+
+        Only talk to pumps of that chain from function, so the chains stay independent.
+        """
+        return self._workers[chain].submit(function, *args, **kwargs)
+
+    def for_each_chain(self, function) -> dict:
+        """Run function(chain) for all chains at the same time, each on the worker of the chain.
+
+        :return: Results by chain
+        :rtype: dict
+        :raises PumpError: if function failed for one or more chains, after all chains have finished
+        """
+        futures = {chain: self.submit(chain, function, chain) for chain in self.chains}
+        return self._results(futures, function)
+
+    def for_each_pump(self, function) -> dict:
+        """Run function(pump) for all pumps, the chains at the same time and the pumps of a chain one after another.
+
+        :return: Results by pump
+        :rtype: dict
+        :raises PumpError: if function failed for one or more pumps, after all pumps have been tried
+        """
+        return self._pump_results(self.for_each_chain(self._on_pumps(function)))
+
+    def run_all(self, already_running_ok: bool = True):
+        """Start all pumps on all chains, see Pump.run().
+
+        :raises PumpError: if one or more pumps could not be started, after all pumps have been tried
+        """
+        self.for_each_pump(lambda pump: pump.run(already_running_ok))
+
+    def stop_all(self, already_stopped_ok: bool = True):
+        """Stop all pumps on all chains, see Pump.stop(). Does not wait for other work of the workers.
+
+        :raises PumpError: if one or more pumps could not be stopped, after all pumps have been tried
+        """
+        self._pump_results(self._outside_workers(self._on_pumps(lambda pump: pump.stop(already_stopped_ok))))
+
+    def emergency_stop_all(self):
+        """Stop all pumps on all chains as fast as possible, see Chain.emergency_stop_all(). Does not wait for other work of the workers.
+
+        :raises PumpError: if one or more pumps could not be confirmed to have stopped, after all chains have been tried
+        """
+        self._outside_workers(Chain.emergency_stop_all)
+
+    def poll_states(self) -> dict:
+        """Get the state of all pumps on all chains, see Pump.get_state().
+
+        :return: State symbol by pump
+        :rtype: dict
+        :raises PumpError: if the state of one or more pumps could not be read, after all pumps have been tried
+        """
+        return self.for_each_pump(Pump.get_state)
+
+    @staticmethod
+    def _on_pumps(function):
+        """Return a function running function(pump) for the pumps of a chain, giving (results by pump, errors)."""
+        def on_chain(chain):
+            results, errors = {}, []
+            for pump in list(chain.pumps.values()):
+                try:
+                    results[pump] = function(pump)
+                except PumpError as e:
+                    logger.error(f'{pump.name}: failed: {e}')
+                    errors.append(str(e))
+            return results, errors
+        return on_chain
+
+    @staticmethod
+    def _pump_results(chain_results: dict) -> dict:
+        """Combine the (results by pump, errors) of all chains, raise PumpError if there are errors."""
+        results, errors = {}, []
+        for pump_results, pump_errors in chain_results.values():
+            results.update(pump_results)
+            errors += pump_errors
+        if errors:
+            raise PumpError('; '.join(errors))
+        return results
+
+    def _results(self, futures: dict, function) -> dict:
+        """Wait for all futures (by chain), and return their results by chain. PumpErrors are combined after all are done."""
+        wait(futures.values())
+        results, errors = {}, []
+        for chain, future in futures.items():
+            try:
+                results[chain] = future.result()
+            except PumpError as e:
+                logger.error(f'{chain}: {getattr(function, "__name__", function)} failed: {e}')
+                errors.append(str(e))
+        if errors:
+            raise PumpError('; '.join(errors))
+        return results
+
+    def _outside_workers(self, function) -> dict:
+        """Like for_each_chain(), but on new threads, so the work does not wait for the queues of the workers."""
+        futures = {}
+        for chain in self.chains:
+            future = Future()
+            def target(chain=chain, future=future):
+                try:
+                    future.set_result(function(chain))
+                except BaseException as e:
+                    future.set_exception(e)
+            threading.Thread(target=target, name=f'ChainPool {chain.port} urgent', daemon=True).start()
+            futures[chain] = future
+        return self._results(futures, function)
@@ -0,0 +1,246 @@
+"""Change the flow rate of a pump over time following a profile.
+
+A RateProfile is a list of setpoints: moments (in seconds from the start) at
+which the rate changes. It can be made from steps, linear ramps, a table of
+points, or a sine. A ProfileRunner writes the setpoints to a pump on a fixed
+schedule against time.monotonic(), so the time taken by the commands does
+not add up over the profile:
+
+    profile = RateProfile.ramp(0, 10, duration=600, step_interval=5, unit="ml/hr")
+    report = ProfileRunner(pump, profile).run()
+    print(report.max_error)   # largest deviation from the plan in seconds
+
+Each rate is sent with a single RAT command (verification is skipped between
+steps, see VERIFY_NONE), and the command is sent early by the latency
+measured so far, so the pump takes the new rate at the planned moment. The
+syringes of a Model 33 can follow profiles of their own:
+
+    ProfileRunner(pump, {1: RateProfile.steps([1, 2, 3], 60), 2: RateProfile.steps([3, 2, 1], 60)}).run()
+"""
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+from .pump import VERIFY_NONE, Pump
+
+logger = logging.getLogger(__name__)
+
+class RateProfile:
+    """Create RateProfile object, a list of (seconds from the start, rate) setpoints.
+
+    The rate of a setpoint holds until the next setpoint, or until duration
+    for the last one. Use the class methods to make common profiles.
+    """
+    def __init__(self, setpoints: list[tuple[float, float]], unit: str = "ml/hr", duration: float | None = None):
+        """
+        :param setpoints: (time in seconds from the start, rate) pairs, in increasing order of time
+        :type setpoints: list of tuple of float and float
+        :param unit: Unit of the rates, can be 'ml/hr', 'ul/hr', 'ml/mn', or 'ul/mn' (default is 'ml/hr')
+        :type unit: str
+        :param duration: Seconds from the start to the end of the profile, defaults to the time of the last setpoint
+        :type duration: float, optional
+        """
+        self.setpoints = [(float(t), float(rate)) for t, rate in setpoints]
+        if not self.setpoints:
+            raise ValueError('a profile needs at least one setpoint')
+        if unit not in Pump.unit_conversion:
+            raise ValueError(f'unknown unit {unit}, must be one of {tuple(Pump.unit_conversion.keys())}')
+        times = [t for t, rate in self.setpoints]
+        if times[0] < 0 or any(b < a for a, b in zip(times, times[1:])):
+            raise ValueError('setpoint times must be positive and in increasing order')
+        if any(rate < 0 for t, rate in self.setpoints):
+            raise ValueError('rates must be positive, change the direction of the pump to refill')
+        self.unit = unit
+        self.duration = times[-1] if duration is None else duration
+        if self.duration < times[-1]:
+            raise ValueError(f'duration {self.duration} s ends before the last setpoint at {times[-1]} s')
+
+    def __repr__(self):
+        return f"RateProfile of {len(self.setpoints)} setpoints over {self.duration} s in {self.unit}"
+
+    def rate_at(self, t: float) -> float:
+        """Return the planned rate t seconds from the start (the rate of the first setpoint before it)."""
+        rate = self.setpoints[0][1]
+        for time_, setpoint_rate in self.setpoints:
+            if time_ > t:
+                break
+            rate = setpoint_rate
+        return rate
+
+    @classmethod
+    def steps(cls, rates: list[float], step_duration: float, unit: str = "ml/hr") -> 'RateProfile':
+        """Return a profile holding each of rates for step_duration seconds."""
+        return cls([(i * step_duration, rate) for i, rate in enumerate(rates)], unit, len(rates) * step_duration)
+
+    @classmethod
+    def ramp(cls, start: float, end: float, duration: float, step_interval: float = 1.0, unit: str = "ml/hr") -> 'RateProfile':
+        """Return a profile changing the rate linearly from start to end over duration seconds, in steps of step_interval seconds."""
+        return cls.table([(0, start), (duration, end)], unit, step_interval)
+
+    @classmethod
+    def table(cls, points: list[tuple[float, float]], unit: str = "ml/hr", step_interval: float | None = None) -> 'RateProfile':
+        """Return a profile through (seconds from the start, rate) points.
+
+        With step_interval None, each rate holds until the next point.
+        Otherwise the rate is interpolated linearly between the points, in
+        steps of step_interval seconds; the last point ends the profile. Two
+        points at the same time make a step from one rate to the other.
+        """
+        if step_interval is None:
+            return cls(points, unit)
+        if step_interval <= 0:
+            raise ValueError(f'step_interval must be positive, not {step_interval}')
+        points = [(float(t), float(rate)) for t, rate in points]
+        setpoints = []
+        for (t0, rate0), (t1, rate1) in zip(points, points[1:]):
+            if t1 == t0:
+                continue # a step, the rate of the next segment starts at t1
+            n = max(1, math.ceil((t1 - t0) / step_interval - 1e-9))
+            for i in range(n):
+                t = t0 + i * (t1 - t0) / n
+                setpoints.append((t, rate0 + (rate1 - rate0) * (t - t0) / (t1 - t0)))
+        setpoints.append(points[-1])
+        return cls(setpoints, unit)
+
+    @classmethod
+    def sine(cls, mean: float, amplitude: float, period: float, duration: float, step_interval: float = 1.0, unit: str = "ml/hr") -> 'RateProfile':
+        """Return a profile following mean + amplitude * sin(2 pi t / period) for duration seconds, in steps of step_interval seconds."""
+        if amplitude > mean:
+            raise ValueError(f'amplitude {amplitude} is larger than the mean {mean}, rates would become negative')
+        n = max(1, math.ceil(duration / step_interval - 1e-9))
+        return cls([(t, mean + amplitude * math.sin(2 * math.pi * t / period)) for t in (i * duration / n for i in range(n))], unit, duration)
+
+@dataclass(frozen=True)
+class ProfileStep:
+    """A setpoint of a profile as it was carried out."""
+    syringe: int
+    rate: float
+    planned: float          # seconds from the start the rate was planned to change
+    achieved: float | None  # seconds from the start the pump confirmed the rate, None if skipped
+    latency: float          # seconds the command took, 0 if skipped
+
+    @property
+    def error(self) -> float | None:
+        """Seconds the rate changed after (positive) or before (negative) the plan, None if skipped."""
+        return None if self.achieved is None else self.achieved - self.planned
+
+@dataclass(frozen=True)
+class ProfileReport:
+    """Planned and achieved timing of all setpoints of a ProfileRunner.run()."""
+    steps: tuple[ProfileStep, ...]
+    cancelled: bool = False
+
+    @property
+    def errors(self) -> list[float]:
+        return [step.error for step in self.steps if step.error is not None]
+
+    @property
+    def max_error(self) -> float:
+        """Largest deviation from the plan in seconds."""
+        return max(map(abs, self.errors), default=0.0)
+
+    @property
+    def mean_error(self) -> float:
+        """Mean deviation from the plan in seconds, positive when late."""
+        errors = self.errors
+        return sum(errors) / len(errors) if errors else 0.0
+
+    @property
+    def skipped(self) -> int:
+        """Number of setpoints that were not sent, because a later one was due already."""
+        return sum(step.achieved is None for step in self.steps)
+
+class ProfileRunner:
+    """Create ProfileRunner object, carrying out rate profiles on the syringes of a pump.
+
+    run() blocks until the profile is done, cancel() ends it early from
+    another thread. To run profiles on pumps of several chains at the same
+    time, run them on the workers of a ChainPool.
+    """
+    latency_smoothing = 0.3 # weight of the latest command in the latency estimate
+
+    def __init__(self, pump: Pump, profiles: RateProfile | dict[int, RateProfile]):
+        """
+        :param pump: Pump to run the profiles on
+        :type pump: Pump
+        :param profiles: Profile for the pump, or profiles by syringe number (e.g. {1: ..., 2: ...} for syringes A and B of a Model 33)
+        :type profiles: RateProfile or dict of int and RateProfile
+        """
+        self.pump = pump
+        self.profiles = profiles if isinstance(profiles, dict) else {0: profiles}
+        for syringe in self.profiles:
+            if syringe not in pump.syringe_selection:
+                raise ValueError(f"{pump.name}: syringe {syringe} is not addressable in this pump. Available syringes are: {tuple(pump.syringe_selection.keys())}")
+        self.latency = None # seconds, estimate of the time a RAT command takes
+        self._cancelled = threading.Event()
+
+    def __repr__(self):
+        return f"Profile runner on {self.pump.name} for syringes {tuple(self.profiles)}"
+
+    def cancel(self):
+        """End a running profile before its next setpoint. The pump keeps its last rate."""
+        self._cancelled.set()
+
+    def run(self, start_pump: bool = True, stop_pump: bool = True) -> ProfileReport:
+        """Carry out the profiles and report the timing.
+
+        The setpoints at time 0 are set before the pump is started, the
+        profile starts when the pump confirms it is running.
+
+        :param start_pump: Start the pump at the start of the profile (default)
+        :type start_pump: bool
+        :param stop_pump: Stop the pump at the end of the profile (default)
+        :type stop_pump: bool
+        :return: Planned and achieved moments of all setpoints
+        :rtype: ProfileReport
+        """
+        self._cancelled.clear()
+        schedule = sorted((t, syringe, rate) for syringe, profile in self.profiles.items() for t, rate in profile.setpoints)
+        end = max(profile.duration for profile in self.profiles.values())
+        steps = []
+        first = [(syringe, rate) for t, syringe, rate in schedule if t == 0]
+        for syringe, rate in first:
+            self._set(syringe, rate)
+        if start_pump:
+            self.pump.run()
+        start = time.monotonic()
+        steps += [ProfileStep(syringe, rate, 0.0, 0.0, 0.0) for syringe, rate in first]
+        logger.info(f'{self}: started, {len(schedule)} setpoints over {end} s')
+        pending = [entry for entry in schedule if entry[0] > 0]
+        try:
+            for i, (t, syringe, rate) in enumerate(pending):
+                # a setpoint is skipped when the next one of the same syringe is due already
+                later = next((entry for entry in pending[i + 1:] if entry[1] == syringe), None)
+                if later is not None and start + later[0] - (self.latency or 0.0) <= time.monotonic():
+                    steps.append(ProfileStep(syringe, rate, t, None, 0.0))
+                    continue
+                if self._cancelled.wait(max(0.0, start + t - (self.latency or 0.0) - time.monotonic())):
+                    break
+                latency = self._set(syringe, rate)
+                steps.append(ProfileStep(syringe, rate, t, time.monotonic() - start, latency))
+            else:
+                self._cancelled.wait(max(0.0, start + end - time.monotonic()))
+        finally:
+            if stop_pump:
+                self.pump.stop()
+        report = ProfileReport(tuple(steps), self._cancelled.is_set())
+        if report.skipped:
+            logger.warning(f'{self}: {report.skipped} setpoints skipped, the chain cannot keep up with the profile')
+        logger.info(f'{self}: {"cancelled" if report.cancelled else "finished"}, mean error {report.mean_error * 1000:.1f} ms, max error {report.max_error * 1000:.1f} ms')
+        return report
+
+    def _set(self, syringe: int, rate: float) -> float:
+        """Set the rate of a syringe without verification, update the latency estimate and return the time it took."""
+        unit = self.profiles[syringe].unit
+        if self.pump._remembered_setting('RAT', syringe) == (float(self.pump.parse_float_to_str(rate)), unit):
+            return 0.0 # set_rate() sends nothing, this says nothing about the latency
+        started = time.monotonic()
+        self.pump.set_rate(rate, unit, syringe, verify=VERIFY_NONE)
+        latency = time.monotonic() - started
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.latency_smoothing * (latency - self.latency)
+        return latency
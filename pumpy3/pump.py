@@ -1,779 +1,2152 @@
-import serial
-import logging
-import time
-from time import sleep
-
-class Chain(serial.Serial):
-    """Create Chain object.
-    Harvard syringe pumps are daisy chained together in a 'pump chain'
-    off a single serial port. A pump address is set on each pump. You
-    must first create a chain to which you then add Pump objects.
-    Chain is a subclass of serial.Serial. Chain creates a serial.Serial
-    instance with the required parameters, flushes input and output
-    buffers (found during testing that this fixes a lot of problems) and
-    logs creation of the Chain. Adapted from pumpy on github.
-    """
-    def __init__(self, port:str, baudrate:int=9600, timeout:float=0.1):
-        """
-        :param port: Port of pump at PC
-        :type port: str
-        """
-        serial.Serial.__init__(self, port=port, stopbits=serial.STOPBITS_TWO, parity=serial.PARITY_NONE, bytesize=serial.EIGHTBITS, xonxoff= False, baudrate = baudrate, timeout=timeout)
-        self.flushOutput()
-        self.flushInput()
-        logging.info('Chain created on %s',port)
-        
-    def __repr__(self):
-        """Return string representation of Chain object."""
-        return f"Pump chain on {self.port}"
-    
-    def __enter__(self):
-        #this is called by doing the with... construction
-        return self
-
-    def __exit__(self, exception_type, exception_value, exception_traceback):
-        #Exception handling here, if an error occurs in the with... block
-        self.close()
-
-class Pump:
-    """Base class for Pump objects."""
-    def __init__(self, chain: Chain, address: int = 0, name: str = 'Pump'):
-        self.name = name
-        self.serialcon = chain
-        self.address = '{0:02.0f}'.format(address)
-        self.syringe_selection = { 
-            0 : "",
-        } # if the punp has individually addressable syringes, translate number to internal name with this.
-        self.unit_conversion = {
-            "ul/mn": "UM",
-            "ml/mn": "MM",
-            "ul/hr": "UH",
-            "ml/hr": "MH",
-        }
-        self.mode_conversion = {
-            "PUMP": "PMP",
-            "VOLUME": "VLM",
-        } # each pump has different modes, overwrite for each pump.
-        self.possible_directions = ('INF', 'REF', 'REV') # INF(use), REF(ill), or REV(erse).
-        # the following statuses probably need to be overwritten for each device type.
-        self.running_status = ('<','>')
-        self.stopped_status = (':', ) 
-        self.stalled_status = ('*',) 
-        try:
-            self.firmware_version = self.get_version()
-        except PumpError:
-            self.serialcon.close()
-            raise
-        logging.info(f'{self.name}: created at address {self.address} on {self.serialcon.port}')
-
-    def __repr__(self):
-        rep = f"{self.__class__.__name__} Object (name = {self.name}) on <{str(self.serialcon)}> with address <{self.address}>.\n"
-        return rep
-
-    def parse_float_response(self, response: str) -> float:
-        """
-        Parse a float value from a response string.
-
-        Parameters
-        ----------
-        response : str
-            Response string from the pump.
-
-        Returns
-        -------
-        float
-            Parsed float value.
-        """
-        try:
-            return float(response.strip())
-        except ValueError:
-            raise PumpError(f'{self.name}: could not parse float from response {response}')
-
-    def parse_float_to_str(self, number: float) -> str:
-        """
-        Convert a float to a string with 5 symbols, including the seperator.
-        e.g. 12.3 becomes 12.30, 12.345 becomes 12.35, and 2.1 becomes 2.100.
-
-        Parameters
-        ----------
-        number : float
-            Number to convert.
-
-        Returns
-        -------
-        str
-            String representation of the number with two decimal places.
-        """
-        if not (0 <= number < 9999):
-            raise ValueError(f'{self.name}: {number} is out of range for parsing, must be between 0 and 9999')
-        parsed = f"{number:.3f}"[:5].ljust(5, '0')
-        return parsed
-
-    def write(self, command: str):
-        """Write serial command to pump.
-
-        Parameters
-        ----------
-        command : str
-            Command to write.
-        """
-        logging.debug(f'{self.name}: writing command: {command}')
-        self.serialcon.write((command + '\r').encode())
-
-    def read(self, bytes: int = 80) -> str:
-        """Read serial stream from pump.
-
-        Parameters
-        ----------
-        bytes : int, optional
-            Number of bytes to read (default is 80).
-
-        Returns
-        -------
-        str
-            Response string from the pump.
-        """
-        response = self.serialcon.read(bytes)
-        logging.debug(f'{self.name}: reading response: {response}')
-        if len(response) == 0:
-            logging.warning(f'{self.name}: no response to command')
-            return ''
-        else:
-            return response.decode()
-
-    def issue_command(self, command: str, value: str = '', units: str = '', syringe: int=0) -> list[str]:
-        """
-        Write serial command to pump, and listen to response.
-
-        Parameters
-        ----------
-        command : str
-            Command to write.
-        value : str, optional
-            Value to write with the command (default is an empty string).
-        units : str, optional
-            Units for the value (default is an empty string).
-        syringe : int, optional
-            Syringe number to act on (default is 0). Only pass when syringes can be individually addressed.
-        Returns
-        -------
-        list of str
-            List of response lines from the pump. Typically, you only care about the last line.
-        """
-        try:
-            syringe_command = self.syringe_selection[syringe]
-        except KeyError:
-            raise ValueError(f"{self.name}: a syringe was selected ({syringe}) that is not addressable in this pump. Available syringes are: {tuple(self.syringe_selection.keys())}")
-        instruction =  (self.address + command + syringe_command + value + units).strip()
-        self.write(instruction)
-        response = self.read(80).splitlines()
-        if not response or len(response) == 0:
-            raise PumpNoResponseError(f'{self.name}: no response to command <{instruction}> - pump may be disconnected?')
-        # The next lines handle the error response from the pump.
-        elif '?' in response[1]:
-            logging.error(f'{self.name}: pump reported SYNTAX ERROR when <{instruction}> was issued.')
-            raise PumpSyntaxError(f'{self.name}: pump reported SYNTAX ERROR when <{instruction}> was issued.')
-        elif 'NA' in response[1]:
-            logging.error(f'{self.name}: pump reported COMMAND NOT APPLICABLE AT THIS TIME error when <{instruction}> was issued.')
-            raise PumpNotApplicableError(f'{self.name}: pump reported COMMAND NOT APPLICABLE AT THIS TIME error when <{instruction}> was issued.')
-        elif 'OOR' in response[1]:
-            logging.error(f'{self.name}: pump reported OUT OF RANGE error when <{instruction}> was issued.')
-            raise PumpOutOfRangeError(f'{self.name}: pump reported OUT OF RANGE error when <{instruction}> was issued.')
-        logging.debug(f'{self.name}: response passed to handler function: {response}')
-        return response
-
-    def _run_checks_ignorable(self, no_response_ok:bool, already_running_ok:bool):
-        """
-        Send the run command, and optionally ignore errors from the pump, and do not check success. Do not invoke directly, use run() instead.
-
-        Parameters
-        ----------
-        no_response_ok : bool
-            If True, ignore errors from no response to run command
-        already_running_ok : bool
-            If True, does not raise an error if the pump is already running (default is True).
-        """
-        try:
-            resp = self.issue_command('RUN')
-        except PumpNotApplicableError as e:
-            if already_running_ok:
-                logging.info(f'{self.name}: Pump is already running, continuing without error.')
-                return
-            else:
-                raise PumpNotApplicableError(f'{self.name}: Pump is already running, cannot start pump.')
-        except PumpNoResponseError as e:
-            # sometimes response is slow after run command for no clear reason run again to be sure it is ok:
-            if no_response_ok:
-                logging.warning(f'{self.name}: Pump gave no response after run command.')
-            else:
-                raise e
-        return
-
-    def run(self, already_running_ok: bool = True):
-        """
-        Starts the pump. If the pump is already running and `already_running_ok` is False, the method raises an exception.
-        Parameters
-        ----------
-        already_running_ok : bool, optional
-            If True, does not raise an error if the pump is already running (default is True).
-        """
-        try:
-            self._run_checks_ignorable(False, already_running_ok)
-        except PumpNoResponseError as e:
-            # sometimes response is slow after run command for no clear reason - run again to be sure it is ok:
-            logging.warning(f'{self.name}: Pump gave no response after run command, try again before throwing error.')
-            self._run_checks_ignorable(False, already_running_ok)
-        state = self.get_state()
-        if state in self.running_status:
-            self.state = 'infusing'
-            logging.info(f'{self.name}: Pump has started running')
-        else:
-            raise PumpError(f'{self.name}: pump is not running: {state}')
-
-    def stop(self, already_stopped_ok: bool = True):
-        """
-        Stops pump. If the pump is already stopped, nothing will happen.
-        """
-        try:
-            resp = self.issue_command('STP')
-        except PumpNotApplicableError as e:
-            if already_stopped_ok:
-                logging.info(f'{self.name}: Pump is already stopped, continuing without error.')
-            else:
-                raise PumpNotApplicableError(f'{self.name}: Pump is already stopped, cannot stop pump.')
-       
-        state = self.get_state()
-        if state in self.stopped_status:
-            self.state = 'idle'
-            logging.info(f'{self.name}: stopped pump')
-        else:
-            raise PumpError(f'{self.name}: pump has not stopped: {state}')
-
-    # shared gets:
-
-    def get_version(self) -> str:
-        """
-        Get the firmware version of the connected device
-
-        Returns
-        -------
-        str
-            Version
-        """
-        version = self.issue_command('VER')[1].strip()
-        logging.debug(f'{self.name}: firmware version is {version}')
-        return version
-
-    def get_state(self) -> str:
-        """Get the current state of the pump. Note that the symbol returned will have a different meaning in different pump models.
-
-        Returns
-        -------
-        str
-            Can be :, >, <, *, /, or ^.
-        """
-        response = self.issue_command('MOD')
-        return response[2][1]
-
-    def get_mode(self) -> str:
-        """Get the current mode of the pump. Note that different pumps have different modes available.
-
-        Returns
-        -------
-        str
-            Pump mode. Possible replies depend on pump model
-        """
-        resp = self.issue_command('MOD')
-        return resp[1].strip()
-
-    def get_direction(self) -> str:
-        """Get the current direction of the pump.
-
-        Returns
-        -------
-        str
-            Can be INFUSE (outward flow) or REFILL (inward flow).
-        
-        Notes
-        -----
-        IF this pump has multiple addressable syringes, this will give only the direction of syringe 1. The direction of other syringes depends on parallel/reciprocal setting, see self.get_parallel_reciprocal.
-        """
-        response = self.issue_command('DIR')
-        return response[1]
-    
-    def get_diameter(self, syringe:int=0) -> float:
-        """
-        Get syringe diameter in mm.
-
-        Parameters
-        ----------
-        syringe : int, optional
-            Syringe number to get diameter for, 0 for do not pass on (either defaults to syringe 1 or is not used). Defaults to 0.
-
-        Returns
-        -------
-        float
-            Syringe diameter in mm.
-        """
-        resp = self.issue_command('DIA', syringe = syringe)
-        relevant_line = resp[1].strip()
-        returned_diameter = self.parse_float_response(relevant_line)
-        logging.debug(f'{self.name}: diameter of syringe is {returned_diameter} mm')
-        return returned_diameter
-
-    def get_rate(self, syringe:int=0) -> tuple[float, str]:
-        """Get flow rate.
-
-        Parameters
-        ----------
-        syringe : int, optional
-            Syringe number to get rate for, 0 (default) for do not pass on (either defaults to syringe 1 or is not used).
-
-        Returns
-        -------
-        tuple of float and str
-            Flow rate and its units.
-        """
-        resp = self.issue_command('RAT', syringe=syringe)
-        relevant_line = resp[1]
-        relevant_line = relevant_line.strip()
-        number = relevant_line[0:6].strip()
-        unit = relevant_line[6:].strip()
-        returned_flowrate = self.parse_float_response(number)
-        logging.debug(f'{self.name}: flow rate (syringe = {syringe}) is {returned_flowrate} {unit}')
-        return (returned_flowrate, unit)
-
-    # shared sets
-
-    def set_mode(self, mode: str):
-        """Set the mode of the pump.
-
-        Parameters
-        ----------
-        mode : str
-            Mode to set, available modes will depend on the device.
-        """
-        if mode not in self.mode_conversion.values():
-            raise PumpError(f'{self.name}: Trying to set unknown mode <{mode}>, possible modes are {tuple(self.mode_conversion.values())}')
-        # if mode == 'PGM': # can I add this later?
-        #     logging.warning(f"{self.name}: Pump mode set to PGM (program mode). Although this mode is theoretically available, it is not implemented in these scripts. Use only if you know what you are doing")
-        resp = self.issue_command('MOD', mode)
-        set_mode = self.get_mode()
-        set_mode = self.mode_conversion[set_mode]
-        if (set_mode == mode):
-            logging.info(f'{self.name}: mode set to {mode}')
-        else:
-            raise PumpError(f'{self.name}: mode not set correctly, response to set_mode {mode}: {set_mode}')
-
-    def set_direction(self, direction: str):
-        """Set the direction of the pump.
-
-        Parameters
-        ----------
-        direction : str
-            Direction to set, can be INF(use), REF(ill), or REV(erse).
-        """
-        if len(self.possible_directions) == 0:
-            # this means this pump does not support changing direction.
-            raise PumpFunctionNotAvailableError(f"{self.name}: This pump does not support changing pump direction")
-        elif direction not in self.possible_directions:
-            raise PumpError(f'{self.name}: unknown direction {direction}, possible options are {self.possible_directions}')
-        
-        old_direction = self.get_direction()
-        resp = self.issue_command('DIR', direction)
-        new_direction = self.get_direction()
-
-        if direction in ['INF','REV'] and (new_direction[:3] == direction):
-            logging.info(f'{self.name}: direction set to {direction}')
-        elif direction == 'REF' and (new_direction != old_direction) and (new_direction[:3] in ['INF','REV']):
-            logging.info(f'{self.name}: direction reversed to {direction}')
-        else:
-            raise PumpError(f'{self.name}: direction not set correctly, response to set_direction {direction}: {new_direction}')
-
-    def set_diameter(self, diameter : float, syringe:int=0):
-        """
-        Set syringe diameter (always in millimetres).
-
-        Parameters
-        ----------
-        diameter : float
-            Syringe diameter.
-        syringe : int, optional
-            Syringe number to set diameter for, 0 (the default) for do not pass on (either defaults to syringe 1 or is not used).
-        """
-        if not (0.1 < diameter < 50): # manual gives these limits
-            raise PumpError(f'{self.name}: diameter {diameter} mm is out of range')
-        elif self.get_state() in self.running_status:
-            raise PumpError(f'{self.name}: cannot set diameter while pump is running, please stop the pump first')
-        str_diameter = self.parse_float_to_str(diameter)
-        resp = self.issue_command('DIA', str_diameter, syringe=syringe) 
-        returned_diameter = self.get_diameter(syringe)
-        # Check diameter was set accurately
-        if returned_diameter != float(str_diameter):
-            raise PumpError(f'{self.name}: set diameter ({diameter} mm) does not match diameter returned by pump ({returned_diameter} mm)')
-            # this should be raised no?
-        elif float(returned_diameter) == diameter:
-            logging.info(f'{self.name}: diameter set to {diameter} mm')
-
-    def set_rate(self, flowrate:float, unit:str="ml/hr", syringe:int=0):
-        """
-        Set flow rate.
-
-        Parameters
-        ----------
-        flowrate : float
-            Flow rate to set.
-        unit : str, optional
-            Unit of flow rate, can be 'ml/hr', 'ul/hr', 'ml/mn', or 'ul/mn' (default is 'ml/hr').
-        syringe : int, optional
-            Syringe number to set rate for, 0 (the default) for do not pass on (either defaults to syringe 1 or is not used) (default is 0).
-        """
-        if unit not in self.unit_conversion:
-            raise ValueError(f'{self.name}: unknown unit {unit}, must be one of {tuple(self.unit_conversion.keys())}')
-        actual_units = self.unit_conversion[unit]
-        parsed_flowrate = self.parse_float_to_str(flowrate)
-        resp = self.issue_command('RAT', f"{parsed_flowrate}", actual_units, syringe)
-        rate_reply = self.get_rate(syringe)
-        
-        logging.debug(f'{self.name}: flowrate of syringe <{syringe}> set to {float(parsed_flowrate)}, outcome = {rate_reply[0]}')
-        logging.debug(f'{self.name}: unit of syringe <{syringe}> set to {unit}, outcome = {rate_reply[1]}')
-
-        if (float(parsed_flowrate) == rate_reply[0]) and (unit == rate_reply[1]):
-            logging.info(f'{self.name}: flowrate of syringe <{syringe}> set to {flowrate} {unit}')
-        else:
-            raise PumpError(f'{self.name}: flowrate of syringe <{syringe}> not set correctly, response to set_rate {flowrate} {unit}: {rate_reply}')
-
-    # misc functions
-
-    def log_all_settings(self):
-        """
-        Log all internal pump settings we have available, like state, mode, etc. This function will not log current output rate, etc.
-        """
-        logging.info(f'{self.name}: logging all settings:')
-        logging.info(f'\tControlled using {self.__class__.__name__} object')
-        logging.info(f'\tfirmware version: {self.firmware_version}')
-        logging.info(f'\tstate: {self.get_state()}')
-        logging.info(f'\tmode: {self.get_mode()}')
-        logging.info(f'\tdirection: {self.get_direction()}')
-
-    def log_all_parameters(self):
-        """
-        Log important parameters, like pump rate, diameter, etc.
-        """
-        logging.info(f'{self.name}: logging all parameters:')
-        for syr in self.syringe_selection.keys():
-            logging.info(f'syringe <{syr}>:')
-            logging.info(f'\trate: {self.get_rate(syr)}')
-            logging.info(f'\tdiameter: {self.get_diameter(syr)} mm')
-
-    def sleep_with_heartbeat(self, sleep_time: float, beat_interval: float = 5, error_wakeup: bool = False):
-        """Sleep for a specified number of seconds, while checking the pump state to watch for stall, and making sure pump is not disconnected during wait.
-
-        Parameters
-        ----------
-        sleep_time : float
-            Number of seconds to sleep.
-        beat_interval : float, optional
-            Interval in seconds to check the pump state (default is 5 seconds).
-        error_wakeup : bool, optional
-            If True, will raise a PumpError if the pump state changes to stalled or disconnected during the sleep period (default is False).
-        """
-        end_time = time.time() + sleep_time
-        if len(self.stalled_status) == 0 and error_wakeup:
-            logging.warning(f"{self.name}: This pump does not have automatic stall detection! Error detection will *not* fail when syringe is depleted!")
-        while time.time() < end_time:
-            state = self.get_state() # just ask anything, just so things will error out when connection is lost
-            if state in self.stalled_status and error_wakeup:
-                raise PumpError(f'{self.name}: pump has stalled, please check the syringe(s)!')
-            time.sleep(beat_interval)
-
-class PumpModel33(Pump):
-    def __init__(self, chain:Chain, address:int=0, name:str='Model33'):
-        super().__init__(chain,address,name)
-        self.syringe_selection = {
-            0 : "",
-            1 : "A",
-            2 : "B",
-        }
-        self.running_status = ('<','>')
-        self.stopped_status = (':', ) 
-        self.stalled_status = ('*',) 
-        self.mode_conversion = {
-            "AUT": "AUT", # AUTo
-            "PRO": "PRO", # PROportiona
-            "CON": "CON", # CONtinuous
-        } # AUT(o stop), PRO(portional), or CON(tinuous).
-        if not self.firmware_version.startswith('33'):
-            logging.warning(f'{self.name}: firmware version {self.firmware_version} indicates this is probably not a Model 33 pump. Continue at your own risk.')
-
-    def get_parallel_reciprocal(self) -> str:
-        """
-        Get the current parallel/reciprocal setting of the pump.
-
-        Returns
-        -------
-        str
-            Can be ON (parallel) or OFF (Reciprocal).
-        """
-        response = self.issue_command('PAR')
-        return response[1]
-    
-    def set_parallel_reciprocal(self, setting: str):
-        """Set the parallel/reciprocal setting of the pump.
-
-        Parameters
-        ----------
-        setting : str
-            Setting to set, can be ON (parallel) or OFF (Reciprocal).
-        """
-        if setting not in ['ON', 'OFF']:
-            raise PumpError(f'{self.name}: unknown parallel/reciprocal setting {setting}')
-        
-        resp = self.issue_command('PAR', setting)
-        parrep = self.get_parallel_reciprocal()
-        if (parrep == setting):
-            logging.info(f'{self.name}: parallel/reciprocal set to {setting}')
-        else:
-            raise PumpError(f'{self.name}: parallel/reciprocal not set correctly, response to set_parallel_reciprocal {setting}: {parrep}')
-
-    def log_all_settings(self):
-        super().log_all_settings()
-        logging.info(f'\tparallel_reciprocal: {self.get_parallel_reciprocal()}')
-
-class PumpPHD2000(Pump):
-    def __init__(self, chain:Chain, address:int=0, name:str='PHD2000'):
-        super().__init__(chain,address,name)
-        self.mode_conversion = {
-            "PUMP": "PMP",
-            "VOLUME": "VLM",
-        }
-        self.syringe_selection = { 
-            0 : "",
-        }
-        self.running_status = ('<','>')
-        self.stopped_status = (':', '*', '/', '^') # stopped, interupted, paused, and wait for trigger respectively.
-        self.stalled_status = tuple()              # PHD2000 has no stall detection?
-        if not self.firmware_version.startswith('PHD'):
-            logging.warning(f'{self.name}: firmware version {self.firmware_version} indicates this is probably not a PHD 2000 pump. Continue at your own risk.')
-        
-    def get_volume_delivered(self) -> float:
-        """
-        Get the volume delivered, in mL.
-
-        Returns
-        -------
-        float
-            Volume delivered in mL
-        """
-        resp = self.issue_command('DEL')
-        relevant_line = resp[1]
-        vol = relevant_line.strip()
-        returned_volume = self.parse_float_response(vol)
-        logging.debug(f'{self.name}: delivered volume is {returned_volume} mL')
-        return returned_volume
-
-    def reset_volume_delivered(self):
-        """
-        Reset the volume delivered to zero. Only run this when pump is not running.
-        """
-        #if self.get_state not in self.stopped_status:
-        #    raise PumpNotApplicableError(f"{self.name}: Volume delivered can only be reset when pump is not running")
-        resp = self.issue_command('CLD')
-        vol_del = self.get_volume_delivered()
-        if vol_del != 0:
-            raise PumpError(f'{self.name}: volume delivered not succesfully reset')
-        else:
-            logging.info(f'{self.name}: volume delivered reset to 0 mL')
-
-    def get_target_volume(self) -> float:
-        """
-        Get target volume (as needed in 'VOL' mode).
-
-        Returns
-        -------
-        float
-            Target volume, in unit mL
-        """
-        resp = self.issue_command('TGT')
-        relevant_line = resp[1]
-        number = relevant_line.strip()
-        returned_target_volume = self.parse_float_response(number)
-        logging.debug(f'{self.name}: target volume is {returned_target_volume} mL')
-        return returned_target_volume
-
-    def set_target_volume(self, volume:float):
-        """
-        Set target volume (as needed in 'VOL' mode).
-
-        Parameters
-        ----------
-        volume : float
-            Target volume in mL.
-        """
-        if self.get_state() in self.running_status:
-            raise PumpError(f'{self.name}: cannot set diameter while pump is running, please stop the pump first')
-        str_volume = self.parse_float_to_str(volume)
-        resp = self.issue_command('TGT', str_volume) 
-        returned_volume = self.get_target_volume()
-        # Check diameter was set accurately
-        if (self.parse_float_to_str(returned_volume)) != str_volume:
-            logging.error(f'{self.name}: set target volume ({volume} mL) does not match diameter returned by pump ({returned_volume} mL)')
-        else:
-            logging.info(f'{self.name}: diameter set to {volume} mL')
-
-    def get_autofill(self):
-        """
-        Get the auto-fill setting.
-        
-        Returns
-        -------
-        str
-            Auto-fill setting, either 'ON' or 'OFF'
-        """
-        
-        resp = self.issue_command('AF')
-        return resp[1].strip()
-
-    def set_autofill(self, autofill:str):
-        """Will raise an PumpFunctionNotAvailable error"""
-        raise PumpFunctionNotAvailableError(f"{self.name}: This pump cannot refill, and thus auto-fill mode is always OFF.")
-
-    def log_all_settings(self):
-        super().log_all_settings()
-        logging.info(f'\tautofill: {self.get_autofill()}')
-
-    def log_all_parameters(self):
-        """
-        Log important parameters, like pump rate, diameter, etc.
-        """
-        logging.info(f'{self.name}: logging all parameters:')
-        for syr in self.syringe_selection.keys():
-            logging.info(f'syringe <{syr}>:')
-            logging.info(f'\trate: {self.get_rate(syr)}')
-            logging.info(f'\trefill_rate: {self.get_refill_rate(syr)}')
-            logging.info(f'\tdiameter: {self.get_diameter(syr)} mm')
-            logging.info(f'\tvolume_delivered: {self.get_volume_delivered()} mL')
-            logging.info(f'\ttarget_volume: {self.get_target_volume()} mL')
-
-    def set_refill_rate(self, flowrate:float, unit:str=""):
-        """Will raise an PumpFunctionNotAvailable error"""
-        raise PumpFunctionNotAvailableError(f"{self.name}: This pump cannot refill, and thus a refill rate cannot be set.")
-
-    def get_refill_rate(self, syringe:float=0) -> tuple[float,str]:
-        """This pump does not have refill capabilities. Will always return a random number"""
-        logging.warning(f'{self.name}: refill rate requested, but does not exist for this pump. User given a random number')
-        return (4, list(self.unit_conversion.keys())[-1])
-
-    def set_direction(self, direction: str):
-        """Will raise an PumpFunctionNotAvailable error"""
-        raise PumpFunctionNotAvailableError(f"{self.name}: This pump does not support changing pump direction")
-
-class PumpPHD2000_Refill(PumpPHD2000):
-    def __init__(self, chain:Chain, address:int=0, name:str='PHD2000'):
-        super().__init__(chain,address,name)
-
-    def set_refill_rate(self, flowrate:float, unit:str="ml/hr"):
-        """
-        Set refill flow rate.
-
-        Parameters
-        ----------
-        flowrate : float
-            Refill flow rate to set.
-        unit : str, optional
-            Unit of flow rate, can be 'ml/hr', 'ul/hr', 'ml/mn', or 'ul/mn' (default is 'ml/hr').
-        """
-        if unit not in self.unit_conversion:
-            raise ValueError(f'{self.name}: unknown unit {unit}, must be one of {list(self.unit_conversion.keys())}')
-        actual_units = self.unit_conversion[unit]
-        parsed_flowrate = self.parse_float_to_str(flowrate)
-        resp = self.issue_command('RFR', f"{parsed_flowrate}", actual_units)
-        rate_reply = self.get_refill_rate()
-        
-        logging.debug(f'{self.name}: refill flowrate set to {float(parsed_flowrate)}, outcome = {rate_reply[0]}')
-        logging.debug(f'{self.name}: refill unit set to {unit}, outcome = {rate_reply[1]}')
-
-        if (float(parsed_flowrate) == rate_reply[0]) and (unit == rate_reply[1]):
-            logging.info(f'{self.name}: refill flowrate set to {flowrate} {unit}')
-        else:
-            raise PumpError(f'{self.name}: refill flowrate not set correctly, response to set_rate {flowrate} {unit}: {rate_reply}')
-        
-    def get_refill_rate(self, syringe:float=0) -> tuple[float, str]:
-        """
-        Gets the refill flow rate.
-
-        Parameters
-        ----------
-        syringe : float, optional
-            The syringe number (default is 0, use if syringes not individually addressable).
-        
-        Returns
-        -------
-        tuple of float and str
-            Flow rate and its units.
-        """
-        resp = self.issue_command('RFR')
-        relevant_line = resp[1].strip()
-        number = relevant_line[0:6].strip()
-        unit = relevant_line[6:].strip()
-        returned_flowrate = self.parse_float_response(number)
-        logging.debug(f'{self.name}: refill flow rate is {returned_flowrate} {unit}')
-        return (returned_flowrate, unit)
-
-    def set_autofill(self, autofill:str):
-        """
-        Set the auto-fill setting. Cannot be run if the pump is running.
-
-        Parameters
-        ----------
-        autofill : str
-            Whether auto-fill is 'ON' or 'OFF'
-        """
-        if self.get_state() != "~":
-            raise PumpError(f'{self.name}: cannot set auto-fill while pump is running, please stop the pump first')
-        elif autofill not in ["ON", "OFF"]:
-            raise ValueError(f'{self.name}: <{autofill}> is not a valid choise for auto-fill mode. Select either ON or OFF')
-        resp = self.issue_command('AF', autofill)
-        if self.get_autofill() == autofill:
-            logging.info(f'{self.name}: Auto-fill mode is set to {autofill}')
-        else:
-            raise PumpError(f"{self.name}: Auto-fill mode was not set to {autofill}, actual value is {self.get_autofill()}.")
-
-class PumpPHD2000_NoRefill(PumpPHD2000):
-    def __init__(self, chain:Chain, address:int=0, name:str='PHD2000'):
-        super().__init__(chain,address,name)
-
-# Errors:
-
-class PumpError(Exception):
-    pass
-
-class PumpNoResponseError(PumpError):
-    """Raised when the pump gives no response."""
-    def __init__(self, message):
-        super().__init__(message)   
-
-class PumpSyntaxError(PumpError):
-    """Raised when the pump returns a syntax error."""
-    def __init__(self, message):
-        super().__init__(message)
-
-class PumpOutOfRangeError(PumpError):
-    """Raised when the pump returns an out of range error."""
-    def __init__(self, message):
-        super().__init__(message)
-
-class PumpNotApplicableError(PumpError):
-    """Raised when the pump returns a command not applicable error."""
-    def __init__(self, message):
-        super().__init__(message)
-
-class PumpStallError(PumpError):
-    """Raised when we detect the pump has stalled"""
-    def __init__(self, message):
-        super().__init__(message)
-        
-class PumpFunctionNotAvailableError(PumpError):
-    """Raised when we try to use a function a pump does not have (like refilling mode)"""
-    def __init__(self, message):
-        super().__init__(message)
+import serial
+import collections
+import heapq
+import itertools
+import logging
+import re
+import select
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import sleep
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+# Every reply of a pump ends with a prompt: a newline, the address of the pump
+# (omitted for address 0) and a symbol giving the pump status.
+_PROMPT = re.compile(rb'\n(\d*)([:<>*/^])\Z')
+_PROMPT_TEXT = re.compile(r'\n(\d*)[:<>*/^]\Z')
+_STATE_SYMBOLS = frozenset(':<>*/^')
+
+# Priorities of transactions waiting for a chain, lower goes first (see Chain.reserve).
+PRIORITY_STOP = 0
+PRIORITY_RUN = 1
+PRIORITY_NORMAL = 2
+_COMMAND_PRIORITY = {
+    'STP': PRIORITY_STOP,
+    'RUN': PRIORITY_RUN,
+}
+
+# Verification policies for the set_...() methods of pumps (see Pump.verification).
+VERIFY_STRICT = 'strict'     # read the setting back right away
+VERIFY_DEFERRED = 'deferred' # read the setting back at the next Pump.verify() (or Pump.run())
+VERIFY_NONE = 'none'         # only check the reply to the set command for errors
+
+def _probe_data(reply: bytes, address: int) -> str | None:
+    """Return the data line of a reply to a probe of address, or None if the reply is incomplete or from another address."""
+    prompt = _PROMPT.search(reply, max(0, len(reply) - 4))
+    if prompt is None or int(prompt.group(1) or 0) != address:
+        return None
+    lines = reply.decode(errors='replace').splitlines()
+    return lines[1].strip() if len(lines) > 2 else ''
+
+def _prompt_address(reply: str) -> int | None:
+    """Return the address in the prompt that ends reply, None if reply does not end with a prompt."""
+    match = _PROMPT_TEXT.search(reply, max(0, len(reply) - 4))
+    if match is None:
+        return None
+    return int(match.group(1) or 0)
+
+def _model_from_version(version: str) -> str | None:
+    """Return the pump model ('Model33' or 'PHD2000') a firmware version belongs to, or None if unknown."""
+    if version.startswith('33'):
+        return 'Model33'
+    if version.startswith('PHD'):
+        return 'PHD2000'
+    return None
+
+def _run_steps(steps):
+    """Carry out the steps of a pump operation, talking to the pumps with blocking I/O, and return its result.
+
+    What an operation sends and how it handles the replies is written once,
+    as a generator that yields a request for every command it needs (see
+    Pump._command()) and gets the response lines back, or the exception
+    raised by issue_command() thrown in. This runs such a generator with
+    Pump.issue_command(), pumpy3.aio runs the same generators with await.
+    """
+    try:
+        request = next(steps)
+        while True:
+            pump, *args = request
+            try:
+                response = pump.issue_command(*args)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(response)
+    except StopIteration as done:
+        return done.value
+
+@dataclass(frozen=True)
+class PumpStatus:
+    """Mode and state of a pump, read with a single MOD command (see Pump.get_status)."""
+    mode: str      # as reported by the pump, e.g. 'PUMP' or 'AUT'
+    state: str     # state symbol, e.g. ':' or '>', see Pump.get_state
+    running: bool  # state is in running_status of the pump
+    stopped: bool  # state is in stopped_status of the pump
+    stalled: bool  # state is in stalled_status of the pump
+    time: float    # time.monotonic() when the reply was received
+
+@dataclass(frozen=True)
+class SyringeSnapshot:
+    """Settings of a single syringe in a PumpSnapshot."""
+    rate: tuple[float, str] # flow rate and its unit
+    diameter: float         # in mm
+
+@dataclass(frozen=True)
+class PumpSnapshot:
+    """Everything a pump reports about itself at one moment (see Pump.snapshot). Fields a pump model does not have are None."""
+    name: str
+    address: str
+    model: str                                 # class name of the pump object
+    firmware_version: str
+    time: float                                # time.time() when the snapshot was taken
+    status: PumpStatus
+    direction: str
+    syringes: MappingProxyType                 # syringe number: SyringeSnapshot
+    parallel_reciprocal: str | None = None     # Model 33
+    volume_delivered: float | None = None      # PHD 2000, in mL
+    target_volume: float | None = None         # PHD 2000, in mL
+    autofill: str | None = None                # PHD 2000
+    refill_rate: tuple[float, str] | None = None # PHD 2000 with refill
+
+@dataclass(frozen=True)
+class TransactionRecord:
+    """A single command and reply between the computer and a pump, as passed to the observers of a chain (see Chain.add_observer).
+
+    Times are in seconds. time_to_first_byte and latency are counted from
+    writing the command, so they do not include the queue_wait for the chain.
+    """
+    pump: str                          # name of the pump
+    address: str
+    command: str                       # e.g. 'RAT', without address, syringe and value
+    syringe: int
+    instruction: str                   # complete command as sent, without the closing carriage return
+    bytes_written: int
+    bytes_read: int
+    queue_wait: float                  # time spent waiting for the chain
+    time_to_first_byte: float | None   # None if the pump did not reply
+    latency: float                     # time until the complete reply was read (or the read timed out)
+    error: BaseException | None = None # exception raised by the transaction, if any
+    reply: str = ''                    # the reply as received, e.g. '\r\n12.30 ml/hr\r\n1>'
+
+    @property
+    def outcome(self) -> str:
+        """'ok', or the class name of the error, e.g. 'PumpNoResponseError'."""
+        return 'ok' if self.error is None else type(self.error).__name__
+
+@dataclass(frozen=True)
+class SyncReport:
+    """When the pumps started or stopped with Chain.run_together() or Chain.stop_together()."""
+    command: str                # 'RUN' or 'STP'
+    offsets: MappingProxyType   # pump: seconds its reply arrived after the reply of the first pump
+    unchanged: tuple            # pumps that were running (or stopped) already
+
+    @property
+    def skew(self) -> float:
+        """Seconds between the first and the last pump, 0 for a single pump."""
+        return max(self.offsets.values(), default=0.0)
+
+class Transport:
+    """Base class for the connections a Chain talks to its pumps over.
+
+    Subclasses implement write(), read(), flush() and close() (and open()
+    if they can be reopened). read_reply() is built on read(), override it
+    only if the connection can wait for a reply more efficiently. With
+    fileno(), an AsyncChain waits for input without polling. More
+    transports are in pumpy3.transport.
+    """
+    port = None     # name of the connection, for logging
+    baudrate = None # baudrate of the pumps, None if it does not apply
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.port!r})"
+
+    @property
+    def is_open(self) -> bool:
+        return True
+
+    def open(self):
+        """Open the connection again after close()."""
+        raise NotImplementedError(f'{self} cannot be reopened')
+
+    def write(self, data: bytes):
+        """Write all of data."""
+        raise NotImplementedError
+
+    def read(self, size: int, timeout: float) -> bytes:
+        """Return up to size bytes, waiting at most timeout seconds for the first one. Returns b'' if nothing arrives in time."""
+        raise NotImplementedError
+
+    def flush(self) -> bytes:
+        """Discard the input that has arrived but was not read, and return it."""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def fileno(self) -> int | None:
+        """Return a file descriptor that becomes readable when input arrives (for event loops, see pumpy3.aio), or None if there is none."""
+        return None
+
+    def read_reply(self, size: int, timeout: float) -> tuple[bytes, float | None]:
+        """Read a single reply, stopping as soon as its trailing prompt has arrived.
+
+        :param size: Maximum number of bytes to read
+        :type size: int
+        :param timeout: Maximum time to wait for the reply in seconds
+        :type timeout: float
+        :return: The raw reply (can be incomplete or empty if the timeout expired), and the time.perf_counter() at which its first byte arrived (None if nothing arrived)
+        :rtype: tuple of bytes and float
+        """
+        deadline = time.monotonic() + timeout
+        reply = bytearray()
+        first_byte_time = None
+        while len(reply) < size:
+            chunk = self.read(size - len(reply), max(0.0, deadline - time.monotonic()))
+            if not chunk:
+                break
+            if not reply:
+                first_byte_time = time.perf_counter()
+            reply += chunk
+            if _PROMPT.search(reply, max(0, len(reply) - 4)):
+                break
+        return bytes(reply), first_byte_time
+
+class SerialTransport(Transport):
+    """Create SerialTransport object, a serial port opened with pyserial with the settings of the pumps.
+
+    Flushes input and output buffers when opened (found during testing
+    that this fixes a lot of problems). Besides port names, any URL
+    pyserial understands can be used, e.g. socket://host:port or
+    rfc2217://host:port for serial servers on the network.
+    Reads wait for input with select() on the port, so every read can have
+    a deadline of its own without reconfiguring the port. Ports that cannot
+    be used with select() (e.g. on Windows) wait in slices of at most
+    poll_interval seconds instead.
+    """
+    poll_interval = 0.005
+
+    def __init__(self, port: str, baudrate: int = 9600, timeout: float = 0.1):
+        """
+        :param port: Port of pump at PC, or a pyserial URL
+        :type port: str
+        :param baudrate: Baudrate set on the pumps
+        :type baudrate: int
+        :param timeout: Timeout of the serial object, for reads of serial that do not go through this transport
+        :type timeout: float
+        """
+        self.port = port
+        self.timeout = timeout
+        self.serial = serial.serial_for_url(port, stopbits=serial.STOPBITS_TWO, parity=serial.PARITY_NONE, bytesize=serial.EIGHTBITS, xonxoff= False, baudrate = baudrate, timeout=timeout)
+        self._configure()
+
+    def _configure(self):
+        """Find the file descriptor to wait on, and empty the buffers."""
+        try:
+            self._fileno = self.serial.fileno()
+        except (AttributeError, OSError):
+            self._fileno = None
+        timeout = self.timeout if self._fileno is not None else self.poll_interval
+        if self.serial.timeout != timeout:
+            self.serial.timeout = timeout
+        self.serial.reset_output_buffer()
+        self.serial.reset_input_buffer()
+
+    @property
+    def baudrate(self) -> int:
+        return self.serial.baudrate
+
+    @property
+    def is_open(self) -> bool:
+        return self.serial.is_open
+
+    def open(self):
+        self.serial.open()
+        self._configure()
+
+    def write(self, data: bytes):
+        self.serial.write(data)
+
+    def fileno(self) -> int | None:
+        return self._fileno
+
+    def read(self, size: int, timeout: float) -> bytes:
+        if timeout <= 0 and not self.serial.in_waiting:
+            return b''
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._fileno is not None and not self.serial.in_waiting:
+                if not select.select([self._fileno], [], [], max(0.0, deadline - time.monotonic()))[0]:
+                    return b''
+            # with input waiting this returns right away, otherwise it waits at most poll_interval
+            chunk = self.serial.read(min(max(self.serial.in_waiting, 1), size))
+            if chunk or time.monotonic() >= deadline:
+                return chunk
+
+    def flush(self) -> bytes:
+        waiting = self.serial.in_waiting
+        if not waiting:
+            return b''
+        data = self.serial.read(waiting)
+        self.serial.reset_input_buffer()
+        return data
+
+    def close(self):
+        self.serial.close()
+
+class Chain:
+    """Create Chain object.
+    Harvard syringe pumps are daisy chained together in a 'pump chain'
+    off a single serial port. A pump address is set on each pump. You
+    must first create a chain to which you then add Pump objects.
+    Chain talks to the pumps over a Transport: by default a SerialTransport
+    opening the port with the required parameters, but any other
+    Transport can be given instead of a port name (see pumpy3.transport).
+    Adapted from pumpy on github.
+    Pumps on the chain can be used from multiple threads: every
+    transaction (command and reply) reserves the chain, see reserve().
+    Pumps register themselves in the pumps dict (address: Pump) when
+    they are created. Functions added with add_observer() get a
+    TransactionRecord of every transaction, e.g. to collect statistics.
+    With trace_size set, the last transactions are kept as they were sent
+    and received, and only written to the log when a command fails.
+    With adaptive_timeout, the chain learns how long each pump takes to
+    start answering each command, counts replies that take longer than
+    that as slow, and waits longer than timeout for commands that are
+    usually slow, see reply_timeout().
+    """
+    # With adaptive_timeout, a reply is slow when it does not start within timeout_margin times the timeout_quantile
+    # of the last timeout_window times to first byte of the same command to the same pump, kept between min_timeout
+    # and max_timeout. A learned time longer than the timeout of the chain replaces it as the time a reply has to
+    # start within, so max_timeout is the longest a reply is waited for to start. Until timeout_min_samples replies have been seen, no reply counts as slow.
+    timeout_quantile = 0.99
+    timeout_margin = 2.0
+    timeout_window = 200
+    timeout_min_samples = 20
+    min_timeout = 0.01
+    max_timeout = 1.0
+
+    def __init__(self, port: 'str | Transport', baudrate:int=9600, timeout:float=0.1, trace_size:int=0, adaptive_timeout:bool=False):
+        """
+        :param port: Port of pump at PC (or a pyserial URL), or a Transport to talk over
+        :type port: str or Transport
+        :param baudrate: Baudrate set on the pumps, not used when a Transport is given
+        :type baudrate: int
+        :param timeout: Maximum time to wait for a reply in seconds
+        :type timeout: float
+        :param trace_size: Number of recent transactions to log when a command fails, 0 to disable (default)
+        :type trace_size: int
+        :param adaptive_timeout: Learn the time each pump takes to answer each command, count replies that take longer as slow, and wait longer for slow commands (default False)
+        :type adaptive_timeout: bool
+        """
+        self.pumps = {}
+        self._bus_condition = threading.Condition()
+        self._bus_queue = []                  # heap of (priority, ticket) of threads waiting for the chain
+        self._bus_tickets = itertools.count() # tickets are handed out in order of arrival
+        self._bus_owner = None                # thread that currently has the chain reserved
+        self._bus_depth = 0
+        self.queue_wait_count = 0             # number of reservations
+        self.queue_wait_total = 0.0           # total time spent waiting for the chain in seconds
+        self.queue_wait_max = 0.0             # longest wait for the chain in seconds
+        self.observers = []                   # functions called with a TransactionRecord after every transaction
+        self.first_byte_time = None           # time.perf_counter() at which the first byte of the last reply arrived
+        self.discarded_replies = 0            # late or misaddressed replies thrown away, see drain() and resync()
+        self._out_of_step_since = None        # time.monotonic() of the last failed transaction not drained yet, see mark_out_of_step()
+        self.slow_replies = 0                 # replies that did not start within the learned time, see reply_timeout()
+        self.trace = collections.deque(maxlen=trace_size) if trace_size else None # (time.perf_counter(), instruction, reply) of recent transactions
+        self.timeout = timeout                # maximum time to wait for a reply in seconds
+        self.adaptive_timeout = adaptive_timeout
+        self._first_byte_times = {}           # (address, command): deque of recent times to first byte in seconds
+        self._learned_timeouts = {}           # (address, command): time the first byte usually comes within, see reply_timeout()
+        self.transport = port if isinstance(port, Transport) else SerialTransport(port, baudrate, timeout)
+        self.port = self.transport.port
+        logger.info('Chain created on %s',self.port)
+
+    def __repr__(self):
+        """Return string representation of Chain object."""
+        return f"Pump chain on {self.port}"
+
+    @property
+    def baudrate(self) -> int | None:
+        """Baudrate of the transport, None if it does not apply."""
+        return self.transport.baudrate
+
+    @property
+    def is_open(self) -> bool:
+        return self.transport.is_open
+
+    def open(self):
+        """Open the port. Pumps forget their remembered settings, since these may have changed while the chain was closed."""
+        self.transport.open()
+        for pump in self.pumps.values():
+            pump.forget_settings()
+
+    def close(self):
+        """Close the port."""
+        self.transport.close()
+
+    def write(self, data: bytes):
+        """Write raw bytes to the chain. Reserve the chain (see reserve()) around a write and the read of its reply."""
+        self.transport.write(data)
+
+    @contextmanager
+    def reserve(self, priority: int = PRIORITY_NORMAL):
+        """Reserve the chain for the calling thread, for the duration of the with-block.
+
+        Only one thread can talk to the pumps at a time, otherwise commands and
+        replies of different pumps get mixed up. Waiting threads are let onto
+        the chain by priority (PRIORITY_STOP first, then PRIORITY_RUN, then
+        PRIORITY_NORMAL), and in order of arrival within the same priority.
+        Since a thread waits for its own transaction to finish before queueing
+        the next one, threads (and thereby pumps) take turns fairly. The thread
+        that holds the reservation can reserve again (nested, the priority is
+        then ignored), so several transactions can be grouped.
+
+        Yields the time in seconds spent waiting for the chain. Statistics of
+        the waiting times are kept in queue_wait_count, queue_wait_total and
+        queue_wait_max.
+
+        :param priority: PRIORITY_STOP, PRIORITY_RUN or PRIORITY_NORMAL (default)
+        :type priority: int
+
+        Example::
+
+            with chain.reserve():
+                pump.write('01VER')
+                reply = pump.read()
+        """
+        me = threading.get_ident()
+        waited = 0.0
+        with self._bus_condition:
+            if self._bus_owner == me:
+                self._bus_depth += 1
+            else:
+                ticket = (priority, next(self._bus_tickets))
+                queued = time.perf_counter()
+                heapq.heappush(self._bus_queue, ticket)
+                try:
+                    while self._bus_owner is not None or self._bus_queue[0] != ticket:
+                        self._bus_condition.wait()
+                except BaseException:
+                    # e.g. KeyboardInterrupt while waiting: give up our place in the queue
+                    self._bus_queue.remove(ticket)
+                    heapq.heapify(self._bus_queue)
+                    self._bus_condition.notify_all()
+                    raise
+                heapq.heappop(self._bus_queue)
+                self._bus_owner = me
+                self._bus_depth = 1
+                waited = time.perf_counter() - queued
+                self.queue_wait_count += 1
+                self.queue_wait_total += waited
+                self.queue_wait_max = max(self.queue_wait_max, waited)
+        try:
+            yield waited
+        finally:
+            with self._bus_condition:
+                self._bus_depth -= 1
+                if self._bus_depth == 0:
+                    self._bus_owner = None
+                    self._bus_condition.notify_all()
+
+    def add_observer(self, observer):
+        """Call observer with a TransactionRecord after every transaction on this chain.
+
+        Observers are called from the thread that issued the command, right
+        after the chain is released, so they should return quickly. Exceptions
+        raised by observers are logged and otherwise ignored.
+
+        :param observer: Function taking a single TransactionRecord
+        :type observer: callable
+        """
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        """Stop calling an observer added with add_observer().
+
+        :raises ValueError: if observer was not added
+        """
+        self.observers.remove(observer)
+
+    def _notify_observers(self, record: TransactionRecord):
+        for observer in list(self.observers):
+            try:
+                observer(record)
+            except Exception:
+                logger.exception(f'Observer {observer!r} on {self.port} failed')
+
+    def format_trace(self) -> str:
+        """Return the recent transactions kept with trace_size as text, one line per transaction, oldest first."""
+        if not self.trace:
+            return '(no transactions traced)'
+        now = time.perf_counter()
+        return '\n'.join(f'{started - now:9.3f} s  {instruction!r} -> {reply!r}' for started, instruction, reply in self.trace)
+
+    def reply_timeout(self, address: str, command: str) -> float | None:
+        """Return the time the reply to command from the pump at address usually starts within, None if it is not known (yet).
+
+        The time is learned from earlier replies when adaptive_timeout is
+        set, see the timeout_... attributes of the chain. A reply that has not
+        started by then is counted in slow_replies and logged, but still waited
+        for up to the timeout of the chain: the pump may carry out the command
+        anyway, and giving up early would leave its late reply to be read as
+        the reply to the next command. The slow reply is learned from, so a
+        pump that became slower gets a longer time. When the learned time is
+        longer than the timeout of the chain, the reply gets the learned time
+        (at most max_timeout) to start instead, see read_reply().
+        """
+        if not self.adaptive_timeout:
+            return None
+        return self._learned_timeouts.get((address, command))
+
+    def learn_reply_time(self, address: str, command: str, first_byte: float | None):
+        """Add the time to first byte of a reply (None if the pump did not answer) to what reply_timeout() learns from."""
+        if first_byte is None:
+            return # the pump did not answer within the timeout of the chain, that says nothing about how fast it is
+        key = (address, command)
+        samples = self._first_byte_times.get(key)
+        if samples is None:
+            samples = self._first_byte_times[key] = collections.deque(maxlen=self.timeout_window)
+        samples.append(first_byte)
+        # sorting is cheap, but not for every reply: update the timeout every 10 replies
+        if len(samples) >= self.timeout_min_samples and (key not in self._learned_timeouts or len(samples) % 10 == 0 or first_byte > self._learned_timeouts[key]):
+            ordered = sorted(samples)
+            quantile = ordered[min(len(ordered) - 1, int(self.timeout_quantile * len(ordered)))]
+            self._learned_timeouts[key] = min(self.max_timeout, max(self.min_timeout, quantile * self.timeout_margin))
+
+    def learned_timeouts(self) -> dict:
+        """Return the learned times to wait for a first byte in seconds, by (address, command)."""
+        return dict(self._learned_timeouts)
+
+    def mark_out_of_step(self):
+        """Note that a transaction got no (complete) reply, so its reply may still come. The next drain() waits for it."""
+        self._out_of_step_since = time.monotonic()
+
+    def drain(self, wait_quiet: bool = True) -> bytes:
+        """Discard input that arrived outside of a transaction, and return it. Reserve the chain (see reserve()) around this.
+
+        A reply that comes after its timeout would otherwise be read as the
+        reply to the next command, and every reply after that would be one
+        off. Pump.issue_command() drains the chain before every command; when
+        nothing is waiting, this costs a single check of the port.
+        A late reply can also still be on its way when the next command is
+        sent right after a failed one (e.g. when Pump.run() tries again).
+        So after mark_out_of_step(), input is discarded until nothing has
+        arrived for the timeout of the chain (counted from the failure, so
+        this costs nothing if the next command comes later than that).
+
+        :param wait_quiet: Wait for the chain to go quiet after mark_out_of_step() (default). If False, only input that has arrived already is discarded, and the next drain() waits instead.
+        :type wait_quiet: bool
+        """
+        stale = self.transport.flush()
+        if wait_quiet and self._out_of_step_since is not None:
+            quiet_until = self._out_of_step_since + self.timeout
+            while (remaining := quiet_until - time.monotonic()) > 0:
+                chunk = self.transport.read(256, remaining)
+                if chunk:
+                    stale += chunk
+                    quiet_until = time.monotonic() + self.timeout
+            self._out_of_step_since = None
+        if stale:
+            self.discarded_replies += 1
+            logger.warning('Discarded %r on %s, probably a late reply to an earlier command', stale, self.port)
+        return stale
+
+    def resync(self, pump: 'Pump | None' = None) -> bool:
+        """Bring commands and replies back in step in a single transaction, without reopening the port.
+
+        Input is discarded until the chain has been quiet for its timeout
+        (see drain()), then pump (by default the first registered pump) is
+        asked for its firmware version, and replies are read until one ends
+        with the address of that pump. Anything that arrives before it is
+        discarded. Pump.issue_command() does this by itself when it cannot
+        find the reply of its own pump.
+
+        :param pump: Pump on this chain to use, defaults to the first registered pump
+        :type pump: Pump, optional
+        :return: True if the chain is in step again, False if the pump did not answer within the timeout of the chain
+        :rtype: bool
+        """
+        if pump is None:
+            if not self.pumps:
+                raise PumpError(f'No pumps registered on {self.port} to resynchronise with')
+            pump = next(iter(self.pumps.values()))
+        address = int(pump.address)
+        with self.reserve():
+            self.mark_out_of_step()
+            self.drain()
+            self.write(f'{pump.address}VER\r'.encode())
+            deadline = time.monotonic() + self.timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                reply = self.read_reply(timeout=remaining)
+                if not reply:
+                    break
+                if _prompt_address(reply.decode(errors='replace')) == address:
+                    logger.info('%s is in step again, %s answered', self.port, pump.name)
+                    return True
+                self.discarded_replies += 1
+                logger.warning('Discarded %r on %s while resynchronising', reply, self.port)
+        logger.error(f'Could not resynchronise {self.port}: {pump.name} did not answer')
+        return False
+
+    def mean_queue_wait(self) -> float:
+        """Return the mean time in seconds a transaction waited for the chain, 0 if nothing happened yet."""
+        with self._bus_condition:
+            if self.queue_wait_count == 0:
+                return 0.0
+            return self.queue_wait_total / self.queue_wait_count
+
+    def emergency_stop_all(self):
+        """Stop all pumps on this chain as fast as possible.
+
+        The chain is reserved with the highest priority and a stop command is
+        sent to every registered pump right after each other. Pumps are checked
+        by the status in the reply to the stop command itself, so no extra
+        commands are needed. All pumps are tried, even if some of them fail.
+
+        :raises PumpError: if one or more pumps could not be confirmed to have stopped
+        """
+        with self.reserve(PRIORITY_STOP):
+            _run_steps(self._emergency_stop())
+
+    def _emergency_stop(self):
+        """Steps of emergency_stop_all(), see _run_steps()."""
+        failed = []
+        for pump in list(self.pumps.values()):
+            late = self._out_of_step_since is not None # STP does not wait for late replies, so its reply may be one of them
+            try:
+                state = (yield pump._command('STP'))[-1][-1:]
+                if late or state not in pump.stopped_status:
+                    state = (yield from pump._get_status(max_age=0)).state # waits for late replies first
+            except PumpNotApplicableError:
+                continue # already stopped
+            except PumpError as e:
+                logger.error(f'{pump.name}: emergency stop failed: {e}')
+                failed.append(pump.name)
+                continue
+            if state not in pump.stopped_status:
+                logger.error(f'{pump.name}: emergency stop sent, but pump reports state {state}')
+                failed.append(pump.name)
+        if failed:
+            raise PumpError(f'Emergency stop on {self.port} could not be confirmed for: {", ".join(failed)}')
+        logger.warning('Emergency stop: all pumps on %s stopped', self.port)
+
+    def run_together(self, pumps: list | None = None, already_running_ok: bool = True) -> SyncReport:
+        """Start several pumps as close together in time as possible.
+
+        Pump.run() checks the state of each pump before the next one is
+        started. Here, the RUN commands are sent right after each other under
+        a single reservation of the chain, and the states are checked
+        afterwards: the reply to RUN already shows the new state, so the pump
+        is only asked again if that is not running. Settings with deferred
+        verification are verified before any pump is started, see Pump.verify().
+
+        :param pumps: Pumps on this chain to start, defaults to all registered pumps
+        :type pumps: list of Pump, optional
+        :param already_running_ok: If True (default), pumps that are running already are left alone, otherwise they count as failed
+        :type already_running_ok: bool
+        :return: How far apart the pumps started
+        :rtype: SyncReport
+        :raises PumpError: if one or more pumps could not be confirmed to run, after all pumps have been tried
+        """
+        pumps = list(self.pumps.values()) if pumps is None else list(pumps)
+        _run_steps(self._verify_all(pumps))
+        return self._together(pumps, 'RUN', PRIORITY_RUN, already_running_ok)
+
+    def stop_together(self, pumps: list | None = None, already_stopped_ok: bool = True) -> SyncReport:
+        """Stop several pumps as close together in time as possible, like run_together() does for starting.
+
+        :param pumps: Pumps on this chain to stop, defaults to all registered pumps
+        :type pumps: list of Pump, optional
+        :param already_stopped_ok: If True (default), pumps that are stopped already are left alone, otherwise they count as failed
+        :type already_stopped_ok: bool
+        :return: How far apart the pumps stopped
+        :rtype: SyncReport
+        :raises PumpError: if one or more pumps could not be confirmed to have stopped, after all pumps have been tried
+        """
+        pumps = list(self.pumps.values()) if pumps is None else list(pumps)
+        return self._together(pumps, 'STP', PRIORITY_STOP, already_stopped_ok)
+
+    def _verify_all(self, pumps: list):
+        """Steps verifying the deferred settings of pumps, see Pump.verify()."""
+        for pump in pumps:
+            if pump._pending_checks:
+                yield from pump._verify()
+
+    def _together(self, pumps: list, command: str, priority: int, unchanged_ok: bool) -> SyncReport:
+        """Send command ('RUN' or 'STP') to pumps right after each other, then confirm their states."""
+        with self.reserve(priority):
+            sent = _run_steps(self._send_together(pumps, command, unchanged_ok))
+        return _run_steps(self._confirm_together(command, *sent))
+
+    def _send_together(self, pumps: list, command: str, unchanged_ok: bool):
+        """Steps of _together() sending the commands, while the chain is reserved. Returns the times and states of the replies, and the unchanged and failed pumps."""
+        times, states, unchanged, failed = {}, {}, [], []
+        def send(pump):
+            """Send command to pump, return False if it did not reply."""
+            try:
+                response = yield pump._command(command)
+            except PumpNotApplicableError:
+                if unchanged_ok:
+                    unchanged.append(pump)
+                else:
+                    logger.error(f'{pump.name}: {command} not applicable, the pump is {"running" if command == "RUN" else "stopped"} already')
+                    failed.append(pump.name)
+                return True
+            except PumpNoResponseError:
+                return False
+            except PumpError as e:
+                logger.error(f'{pump.name}: {command} failed: {e}')
+                failed.append(pump.name)
+                return True
+            times[pump] = self.first_byte_time or time.perf_counter()
+            states[pump] = response[-1][-1]
+            return True
+        silent = []
+        for pump in pumps:
+            if not (yield from send(pump)):
+                silent.append(pump)
+        # sometimes the response is slow for no clear reason, try those pumps once more (like Pump.run())
+        for pump in silent:
+            logger.warning('%s: Pump gave no response after %s command, try again before throwing error.', pump.name, command)
+            if not (yield from send(pump)):
+                logger.error(f'{pump.name}: no response to {command}')
+                failed.append(pump.name)
+        return times, states, unchanged, failed
+
+    def _confirm_together(self, command: str, times: dict, states: dict, unchanged: list, failed: list):
+        """Steps of _together() confirming the states after the commands were sent. Returns the SyncReport."""
+        for pump, state in states.items():
+            target = pump.running_status if command == 'RUN' else pump.stopped_status
+            if state not in target:
+                try:
+                    state = (yield from pump._get_status(max_age=0)).state
+                except PumpError as e:
+                    logger.error(f'{pump.name}: could not check the state after {command}: {e}')
+                    failed.append(pump.name)
+                    continue
+            if state in target:
+                pump.state = 'infusing' if command == 'RUN' else 'idle'
+            else:
+                logger.error(f'{pump.name}: {command} sent, but pump reports state {state}')
+                failed.append(pump.name)
+        if failed:
+            raise PumpError(f'{"Starting" if command == "RUN" else "Stopping"} pumps together on {self.port} could not be confirmed for: {", ".join(failed)}')
+        first = min(times.values(), default=0.0)
+        report = SyncReport(command, MappingProxyType({pump: t - first for pump, t in times.items()}), tuple(unchanged))
+        logger.info('%s %s pump(s) on %s within %.1f ms', "Started" if command == "RUN" else "Stopped", len(times), self.port, report.skew * 1000)
+        return report
+
+    def snapshot_all(self) -> dict:
+        """Take a snapshot of every registered pump, see Pump.snapshot().
+
+        :return: Snapshots by pump address
+        :rtype: dict
+        :raises PumpError: if one or more pumps could not be read, after all pumps have been tried
+        """
+        return _run_steps(self._snapshot_all())
+
+    def _snapshot_all(self):
+        """Steps of snapshot_all(), see _run_steps()."""
+        snapshots, failed = {}, []
+        for address, pump in list(self.pumps.items()):
+            try:
+                snapshots[address] = yield from pump._snapshot()
+            except PumpError as e:
+                logger.error(f'{pump.name}: snapshot failed: {e}')
+                failed.append(pump.name)
+        if failed:
+            raise PumpError(f'Snapshot on {self.port} failed for: {", ".join(failed)}')
+        return snapshots
+
+    def discover(self, addresses=range(100), timeout: float | None = None) -> list:
+        """Find the pumps on this chain, and return a pump object for each of them.
+
+        Every address is asked for its firmware version. Only the first byte
+        of the reply has to arrive within timeout, so addresses without a pump
+        are skipped quickly, while slow replies still get the timeout of the
+        chain to complete. Pumps are recognised by their firmware version:
+        33... becomes a PumpModel33, PHD... a PumpPHD2000_Refill or
+        PumpPHD2000_NoRefill (depending on whether it knows the refill rate
+        command), anything else a plain Pump. Pumps that are already
+        registered on the chain are returned as they are, new ones are given
+        the firmware version that was read, so they are not asked again.
+
+        :param addresses: Addresses to try, defaults to all addresses (0 to 99)
+        :type addresses: iterable of int
+        :param timeout: Time in seconds to wait for a pump to start replying, defaults to 20 ms plus the time to send a command at the baudrate
+        :type timeout: float, optional
+        :return: The pumps found, in the order of addresses
+        :rtype: list of Pump
+        """
+        if timeout is None:
+            timeout = 0.02 + (10 * 11 / self.baudrate if self.baudrate else 0.0)
+        found = []
+        for address in addresses:
+            version = self._probe(address, 'VER', timeout)
+            if version is None:
+                continue
+            model = _model_from_version(version)
+            if model == 'Model33':
+                cls = PumpModel33
+            elif model == 'PHD2000':
+                refill = self._probe(address, 'RFR', timeout)
+                cls = PumpPHD2000_NoRefill if refill is None or '?' in refill else PumpPHD2000_Refill
+            else:
+                logger.warning('Unknown pump with firmware version %s at address %02d on %s, using it as a generic Pump', version, address, self.port)
+                cls = Pump
+            pump = self.pumps.get(f'{address:02}')
+            if type(pump) is not cls:
+                pump = cls(self, address=address, name=f'{model or "Pump"} {address:02}', firmware_version=version)
+            found.append(pump)
+        logger.info('Discovered %s pump(s) on %s: %s', len(found), self.port, ", ".join(pump.name for pump in found))
+        return found
+
+    def _probe(self, address: int, command: str, timeout: float) -> str | None:
+        """Send a command to an address, return the data line of the reply, or None if no pump at that address replied."""
+        with self.reserve():
+            self.transport.flush() # a late reply to an earlier probe
+            self.write(f'{address:02}{command}\r'.encode())
+            reply = self.read_reply(first_byte_timeout=timeout)
+        return _probe_data(reply, address)
+
+    def read_reply(self, size: int = 80, timeout: float | None = None, first_byte_timeout: float | None = None, expected_within: float | None = None) -> bytes:
+        """Read a single reply from the chain.
+
+        Reading stops as soon as the trailing prompt of the reply (newline,
+        address, status symbol) has arrived, so a quick pump answer does not
+        cost the full timeout. The timeout only acts as an upper bound, for
+        when the pump does not answer (completely).
+
+        :param size: Maximum number of bytes to read
+        :type size: int
+        :param timeout: Maximum time to wait for the reply in seconds, defaults to the timeout of the chain
+        :type timeout: float, optional
+        :param first_byte_timeout: If given, the reply has to start within this time, and then gets timeout to complete
+        :type first_byte_timeout: float, optional
+        :param expected_within: If given, the time the reply usually starts within (see reply_timeout()). A reply that has not started by then is counted in slow_replies, and waited for up to timeout. If expected_within is longer than timeout, the reply gets expected_within to start, and then timeout to complete.
+        :type expected_within: float, optional
+        :return: Raw reply, can be incomplete or empty if the timeout expired
+        :rtype: bytes
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if first_byte_timeout is None and expected_within is not None and expected_within > timeout:
+            first_byte_timeout = expected_within # a command the pump is usually slow to answer gets more time to start
+        if first_byte_timeout is not None:
+            reply, self.first_byte_time = self.transport.read_reply(size, first_byte_timeout)
+            if reply and not _PROMPT.search(reply, max(0, len(reply) - 4)):
+                rest, _ = self.transport.read_reply(size - len(reply), timeout)
+                reply += rest
+            return reply
+        if expected_within is None or expected_within >= timeout:
+            reply, self.first_byte_time = self.transport.read_reply(size, timeout)
+            return reply
+        reply, self.first_byte_time = self.transport.read_reply(size, expected_within)
+        if not reply:
+            self.slow_replies += 1
+            logger.info('No reply within the usual %.1f ms on %s, waiting up to %.1f ms', expected_within * 1000, self.port, timeout * 1000)
+            reply, self.first_byte_time = self.transport.read_reply(size, timeout - expected_within)
+        elif not _PROMPT.search(reply, max(0, len(reply) - 4)):
+            rest, _ = self.transport.read_reply(size - len(reply), timeout - expected_within)
+            reply += rest
+        return reply
+    
+    def __enter__(self):
+        #this is called by doing the with... construction
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        #Exception handling here, if an error occurs in the with... block
+        self.close()
+
+class Pump:
+    """Base class for Pump objects."""
+    # The pump description below is shared by all pumps of a model, overwrite it in each pump class.
+    syringe_selection = { 
+        0 : "",
+    } # if the punp has individually addressable syringes, translate number to internal name with this.
+    unit_conversion = {
+        "ul/mn": "UM",
+        "ml/mn": "MM",
+        "ul/hr": "UH",
+        "ml/hr": "MH",
+    }
+    mode_conversion = {
+        "PUMP": "PMP",
+        "VOLUME": "VLM",
+    } # each pump has different modes, overwrite for each pump.
+    possible_directions = ('INF', 'REF', 'REV') # INF(use), REF(ill), or REV(erse).
+    # the following statuses probably need to be overwritten for each device type.
+    running_status = ('<','>')
+    stopped_status = (':', ) 
+    stalled_status = ('*',) 
+    # Settings confirmed by the pump are remembered, so setting them again to the same value needs no commands.
+    # They are forgotten after settings_ttl seconds (None to never forget, 0 to disable remembering).
+    settings_ttl = 60.0
+    # How set_...() methods check the pump took the new setting, one of VERIFY_STRICT, VERIFY_DEFERRED or VERIFY_NONE.
+    verification = VERIFY_STRICT
+    # get_status() (and get_state(), get_mode()) reuse a status that is at most this many seconds old.
+    # get_state() also uses the state at the end of any other reply, if it is at most this old.
+    # Commands that can change the status (RUN, STP and any setting) always discard it.
+    status_ttl = 0.1
+    # Methods that talk to the pump are written as steps (generators, see _run_steps()), and run by _drive().
+    # The asyncio pumps in pumpy3.aio share the steps, and only replace _drive() and the I/O.
+    _drive = staticmethod(_run_steps)
+
+    def __init__(self, chain: Chain, address: int = 0, name: str = 'Pump', firmware_version: str | None = None):
+        self._setup(chain, address, name)
+        self.connect(firmware_version)
+
+    def _setup(self, chain: Chain, address: int, name: str):
+        """Set the attributes of a new pump object, without talking to the pump."""
+        self.name = name
+        self.serialcon = chain
+        self.address = '{0:02.0f}'.format(address)
+        self.firmware_version = None # set by connect()
+        self._settings = {} # (command, syringe letter): (value, time confirmed)
+        self._pending_checks = {} # (command, syringe letter): steps reading a deferred setting back
+        self._status = None # last PumpStatus, see get_status()
+        self._status_changes = 0 # number of commands that changed the status, see issue_command()
+        self.last_state = None # state symbol at the end of the last reply, see get_state()
+        self.last_state_time = None # time.monotonic() when last_state was received
+        self._encoded = {} # (command, syringe): (instruction, bytes) of queries, see _encode_instruction()
+
+    def __repr__(self):
+        rep = f"{self.__class__.__name__} Object (name = {self.name}) on <{str(self.serialcon)}> with address <{self.address}>.\n"
+        return rep
+
+    def connect(self, firmware_version: str | None = None):
+        """
+        Get the firmware version of the pump and register the pump on its chain. Done when the pump is created.
+        If the pump does not answer, the chain is closed.
+
+        Parameters
+        ----------
+        firmware_version : str, optional
+            Firmware version read from the pump already (e.g. by Chain.discover()), so it is not asked again (default is None, ask the pump).
+        """
+        return self._drive(self._connect(firmware_version))
+
+    def _connect(self, firmware_version: str | None = None):
+        if firmware_version is None:
+            try:
+                firmware_version = yield from self._get_version()
+            except PumpError:
+                self.serialcon.close()
+                raise
+        self.firmware_version = firmware_version
+        self._check_firmware()
+        self.serialcon.pumps[self.address] = self
+        logger.info('%s: created at address %s on %s', self.name, self.address, self.serialcon.port)
+
+    def _check_firmware(self):
+        """Warn if the firmware version does not belong to the pump model of this class, overwrite this for each pump model."""
+
+    def _command(self, command: str, value: str = '', units: str = '', syringe: int = 0) -> tuple:
+        """Return the request a step yields to have command issued to this pump, see _run_steps() and issue_command()."""
+        return (self, command, value, units, syringe)
+
+    def parse_float_response(self, response: str) -> float:
+        """
+        Parse a float value from a response string.
+
+        Parameters
+        ----------
+        response : str
+            Response string from the pump.
+
+        Returns
+        -------
+        float
+            Parsed float value.
+        """
+        try:
+            return float(response.strip())
+        except ValueError:
+            raise PumpError(f'{self.name}: could not parse float from response {response}')
+
+    def parse_float_to_str(self, number: float) -> str:
+        """
+        Convert a float to a string with 5 symbols, including the seperator.
+        e.g. 12.3 becomes 12.30, 12.345 becomes 12.35, and 2.1 becomes 2.100.
+
+        Parameters
+        ----------
+        number : float
+            Number to convert.
+
+        Returns
+        -------
+        str
+            String representation of the number with two decimal places.
+        """
+        if not (0 <= number < 9999):
+            raise ValueError(f'{self.name}: {number} is out of range for parsing, must be between 0 and 9999')
+        parsed = f"{number:.3f}"[:5].ljust(5, '0')
+        return parsed
+
+    def write(self, command: str | bytes):
+        """Write serial command to pump. Reserve the chain (see Chain.reserve) when using this directly from multiple threads.
+
+        Parameters
+        ----------
+        command : str or bytes
+            Command to write. A str gets the closing carriage return added, bytes are written as they are (including the carriage return).
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s: writing command: %s', self.name, command)
+        if isinstance(command, str):
+            command = (command + '\r').encode()
+        self.serialcon.write(command)
+
+    def read(self, bytes: int = 80, expected_within: float | None = None) -> str:
+        """Read a reply from the pump. Returns as soon as the prompt that ends the reply has been received, or when the chain timeout expires.
+
+        Parameters
+        ----------
+        bytes : int, optional
+            Maximum number of bytes to read (default is 80).
+        expected_within : float, optional
+            Time in seconds the reply usually starts within, see Chain.read_reply() (default is None, not known).
+
+        Returns
+        -------
+        str
+            Response string from the pump.
+        """
+        return self._decode_reply(self.serialcon.read_reply(bytes, expected_within=expected_within))
+
+    def _decode_reply(self, response: bytes) -> str:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s: reading response: %s', self.name, response)
+        if len(response) == 0:
+            logger.warning('%s: no response to command', self.name)
+            return ''
+        else:
+            return response.decode()
+
+    def issue_command(self, command: str, value: str = '', units: str = '', syringe: int=0) -> list[str]:
+        """
+        Write serial command to pump, and listen to response.
+
+        Parameters
+        ----------
+        command : str
+            Command to write.
+        value : str, optional
+            Value to write with the command (default is an empty string).
+        units : str, optional
+            Units for the value (default is an empty string).
+        syringe : int, optional
+            Syringe number to act on (default is 0). Only pass when syringes can be individually addressed.
+        Returns
+        -------
+        list of str
+            List of response lines from the pump. Typically, you only care about the last line.
+        """
+        instruction, encoded, changes_status = self._begin_command(command, value, units, syringe)
+        chain = self.serialcon
+        error = None
+        with chain.reserve(_COMMAND_PRIORITY.get(command, PRIORITY_NORMAL)) as queue_wait:
+            chain.drain(wait_quiet=command != 'STP') # a stop does not wait for late replies, the next command does
+            started = time.perf_counter()
+            try:
+                self.write(encoded)
+                reply = self._read_own_reply(chain.reply_timeout(self.address, command))
+            except BaseException as e:
+                reply, error = '', e
+            timing = self._end_command(command, changes_status, reply, queue_wait, started, error)
+        return self._finish_command(command, syringe, instruction, reply, timing, error)
+
+    def _begin_command(self, command: str, value: str, units: str, syringe: int) -> tuple[str, bytes, bool]:
+        """Return the instruction for issue_command(), the bytes to write for it, and whether it can change the status of the pump."""
+        instruction, encoded = self._encode_instruction(command, value, units, syringe)
+        changes_status = bool(value) or command in ('RUN', 'STP')
+        if changes_status:
+            self._status = None
+        return instruction, encoded, changes_status
+
+    def _end_command(self, command: str, changes_status: bool, reply: str, queue_wait: float, started: float, error: BaseException | None) -> tuple:
+        """Wrap up the transaction of issue_command() while the chain is still reserved, and return its timing for _record_transaction()."""
+        chain = self.serialcon
+        if changes_status:
+            # a status read before this command is outdated, also if it is still on its way in another thread
+            self._status_changes += 1
+            self._status = None
+        timing = (queue_wait, started, time.perf_counter(), chain.first_byte_time)
+        if error is not None or _prompt_address(reply) is None:
+            chain.mark_out_of_step() # no reply or an incomplete one, the (rest of the) reply may still come
+        if error is None and chain.adaptive_timeout:
+            chain.learn_reply_time(self.address, command, chain.first_byte_time - started if reply else None)
+        return timing
+
+    def _finish_command(self, command: str, syringe: int, instruction: str, reply: str, timing: tuple, error: BaseException | None) -> list[str]:
+        """Check the reply of issue_command() and record the transaction, after the chain was released. Raises error if the transaction failed."""
+        if error is not None:
+            self._record_transaction(command, syringe, instruction, '', *timing, error)
+            raise error
+        self._note_state(reply)
+        response = reply.splitlines()
+        try:
+            self._check_response(instruction, response)
+        except PumpError as e:
+            # after an error we can no longer be sure what the pump has set
+            self.forget_settings()
+            self._record_transaction(command, syringe, instruction, reply, *timing, e)
+            raise
+        self._record_transaction(command, syringe, instruction, reply, *timing)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s: response passed to handler function: %s', self.name, response)
+        return response
+
+    def _read_own_reply(self, expected_within: float | None = None) -> str:
+        """Read the reply to a command, skipping replies of other pumps (late replies to earlier commands, which came right after the write).
+
+        Returns '' (no response) if the reply of this pump does not turn up;
+        the chain is then resynchronised, see Chain.resync().
+        """
+        reply = self.read(80, expected_within)
+        for attempt in range(3):
+            if not self._foreign_reply(reply):
+                return reply
+            if attempt < 2:
+                reply = self.read(80)
+        self.serialcon.resync(self)
+        return ''
+
+    def _foreign_reply(self, reply: str) -> bool:
+        """Return True if reply ends with the prompt of another pump, and count it as discarded."""
+        address = _prompt_address(reply)
+        if address is None or address == int(self.address):
+            return False
+        self.serialcon.discarded_replies += 1
+        logger.warning('%s: discarded a reply from address %s: %r', self.name, address, reply)
+        return True
+
+    def _note_state(self, reply: str):
+        """Remember the state symbol that ends every reply (error replies included) as last_state."""
+        if reply and reply[-1] in _STATE_SYMBOLS:
+            state = reply[-1]
+            if self._status is not None and self._status.state != state:
+                self._status = None
+            self.last_state = state
+            self.last_state_time = time.monotonic()
+
+    def _record_transaction(self, command: str, syringe: int, instruction: str, reply: str, queue_wait: float, started: float, finished: float, first_byte: float | None, error: BaseException | None = None):
+        """Add a transaction to the trace of the chain and pass a TransactionRecord to its observers, if enabled.
+
+        When the transaction failed, the trace is logged. Commands that are not
+        applicable at the time are not considered failures here, callers often
+        expect them (e.g. starting a pump that is already running).
+        """
+        chain = self.serialcon
+        if chain.trace is not None:
+            chain.trace.append((started, instruction, reply))
+            if error is not None and not isinstance(error, PumpNotApplicableError) and logger.isEnabledFor(logging.ERROR):
+                logger.error('%s: <%s> failed, recent transactions on %s:\n%s', self.name, instruction, chain.port, chain.format_trace())
+        if not chain.observers:
+            return
+        chain._notify_observers(TransactionRecord(
+            pump=self.name,
+            address=self.address,
+            command=command,
+            syringe=syringe,
+            instruction=instruction,
+            bytes_written=len(instruction) + 1,
+            bytes_read=len(reply),
+            queue_wait=queue_wait,
+            time_to_first_byte=None if first_byte is None or first_byte < started else first_byte - started,
+            latency=finished - started,
+            error=error,
+            reply=reply,
+        ))
+
+    def _build_instruction(self, command: str, value: str = '', units: str = '', syringe: int=0) -> str:
+        """Put together the instruction for issue_command(), without the closing carriage return."""
+        try:
+            syringe_command = self.syringe_selection[syringe]
+        except KeyError:
+            raise ValueError(f"{self.name}: a syringe was selected ({syringe}) that is not addressable in this pump. Available syringes are: {tuple(self.syringe_selection.keys())}")
+        return (self.address + command + syringe_command + value + units).strip()
+
+    def _encode_instruction(self, command: str, value: str = '', units: str = '', syringe: int=0) -> tuple[str, bytes]:
+        """Return the instruction for issue_command() and the bytes to write for it, including the closing carriage return.
+
+        Queries without a value are the same every time and are sent over and
+        over when polling, so they are encoded once per pump and kept.
+        """
+        if value or units:
+            instruction = self._build_instruction(command, value, units, syringe)
+            return instruction, (instruction + '\r').encode()
+        encoded = self._encoded.get((command, syringe))
+        if encoded is None:
+            instruction = self._build_instruction(command, syringe=syringe)
+            encoded = self._encoded[(command, syringe)] = (instruction, (instruction + '\r').encode())
+        return encoded
+
+    def _check_response(self, instruction: str, response: list[str]):
+        """Raise the matching PumpError if the response lines to instruction are empty or report an error."""
+        if not response or len(response) == 0:
+            raise PumpNoResponseError(f'{self.name}: no response to command <{instruction}> - pump may be disconnected?')
+        elif len(response) < 2:
+            raise PumpNoResponseError(f'{self.name}: incomplete response {response!r} to command <{instruction}> - pump may be disconnected?')
+        # The next lines handle the error response from the pump.
+        elif '?' in response[1]:
+            logger.error(f'{self.name}: pump reported SYNTAX ERROR when <{instruction}> was issued.')
+            raise PumpSyntaxError(f'{self.name}: pump reported SYNTAX ERROR when <{instruction}> was issued.')
+        elif 'NA' in response[1]:
+            logger.error(f'{self.name}: pump reported COMMAND NOT APPLICABLE AT THIS TIME error when <{instruction}> was issued.')
+            raise PumpNotApplicableError(f'{self.name}: pump reported COMMAND NOT APPLICABLE AT THIS TIME error when <{instruction}> was issued.')
+        elif 'OOR' in response[1]:
+            logger.error(f'{self.name}: pump reported OUT OF RANGE error when <{instruction}> was issued.')
+            raise PumpOutOfRangeError(f'{self.name}: pump reported OUT OF RANGE error when <{instruction}> was issued.')
+
+    def forget_settings(self):
+        """Forget all remembered settings, so the next set_...() always talks to the pump. Use this when settings may have been changed on the pump itself."""
+        self._settings.clear()
+
+    def _setting_key(self, command: str, syringe: int = 0) -> tuple[str, str]:
+        """Return the key of a setting in the remembered settings: the command and the syringe letter.
+
+        Syringe 0 (do not pass on) acts on the first syringe, so it shares the key of that syringe.
+        """
+        letter = self.syringe_selection.get(syringe, syringe)
+        if not letter:
+            letter = next((letter for letter in self.syringe_selection.values() if letter), '')
+        return (command, letter)
+
+    def _remembered_setting(self, command: str, syringe: int = 0):
+        """Return the remembered value of a setting, or None if it is unknown or too old."""
+        try:
+            value, confirmed = self._settings[self._setting_key(command, syringe)]
+        except KeyError:
+            return None
+        if self.settings_ttl is not None and time.monotonic() - confirmed >= self.settings_ttl:
+            return None
+        return value
+
+    def _remember_setting(self, command: str, value, syringe: int = 0):
+        """Remember a value of a setting the pump has confirmed."""
+        self._settings[self._setting_key(command, syringe)] = (value, time.monotonic())
+
+    def _forget_setting(self, command: str, syringe: int = 0):
+        """Forget a setting of a syringe, to be used before changing it."""
+        self._settings.pop(self._setting_key(command, syringe), None)
+
+    def verify(self):
+        """
+        Read back all settings that were set with deferred verification (see Pump.verification).
+
+        Raises
+        ------
+        PumpError
+            If one or more settings were not set correctly. All settings are read back before raising.
+        """
+        return self._drive(self._verify())
+
+    def _verify(self):
+        checks = list(self._pending_checks.values())
+        self._pending_checks.clear()
+        errors = []
+        for check in checks:
+            try:
+                yield from check()
+            except PumpError as e:
+                errors.append(str(e))
+        if errors:
+            raise PumpError('; '.join(errors))
+
+    def _verification_policy(self, verify: str | None) -> str:
+        """Return the verification policy to use for a set_...() call."""
+        verify = self.verification if verify is None else verify
+        if verify not in (VERIFY_STRICT, VERIFY_DEFERRED, VERIFY_NONE):
+            raise ValueError(f"{self.name}: unknown verification policy <{verify}>, must be one of {(VERIFY_STRICT, VERIFY_DEFERRED, VERIFY_NONE)}")
+        return verify
+
+    def _verify_setting(self, verify: str, command: str, check, value=None, syringe: int = 0):
+        """
+        Steps checking a setting that was just sent, following verification policy verify.
+
+        check returns the steps reading the setting back, which raise a PumpError if it is wrong.
+        Without verification, the pump accepted the setting without error, so value is remembered
+        as the new setting (unless it is None).
+        """
+        key = self._setting_key(command, syringe)
+        self._pending_checks.pop(key, None) # a check of an older value of this setting is no longer valid
+        if verify == VERIFY_STRICT:
+            yield from check()
+        elif verify == VERIFY_DEFERRED:
+            self._pending_checks[key] = check
+        elif value is not None:
+            self._remember_setting(command, value, syringe)
+
+    def _run_checks_ignorable(self, no_response_ok:bool, already_running_ok:bool):
+        """
+        Steps sending the run command, and optionally ignore errors from the pump, and do not check success. Do not invoke directly, use run() instead.
+
+        Parameters
+        ----------
+        no_response_ok : bool
+            If True, ignore errors from no response to run command
+        already_running_ok : bool
+            If True, does not raise an error if the pump is already running (default is True).
+        """
+        try:
+            resp = yield self._command('RUN')
+        except PumpNotApplicableError as e:
+            if already_running_ok:
+                logger.info('%s: Pump is already running, continuing without error.', self.name)
+                return
+            else:
+                raise PumpNotApplicableError(f'{self.name}: Pump is already running, cannot start pump.')
+        except PumpNoResponseError as e:
+            # sometimes response is slow after run command for no clear reason run again to be sure it is ok:
+            if no_response_ok:
+                logger.warning('%s: Pump gave no response after run command.', self.name)
+            else:
+                raise e
+        return
+
+    def run(self, already_running_ok: bool = True):
+        """
+        Starts the pump. If the pump is already running and `already_running_ok` is False, the method raises an exception.
+        Settings with deferred verification are verified first, see verify().
+
+        Parameters
+        ----------
+        already_running_ok : bool, optional
+            If True, does not raise an error if the pump is already running (default is True).
+        """
+        return self._drive(self._run(already_running_ok))
+
+    def _run(self, already_running_ok: bool = True):
+        if self._pending_checks:
+            yield from self._verify()
+        try:
+            yield from self._run_checks_ignorable(False, already_running_ok)
+        except PumpNoResponseError as e:
+            # sometimes response is slow after run command for no clear reason - run again to be sure it is ok:
+            logger.warning('%s: Pump gave no response after run command, try again before throwing error.', self.name)
+            yield from self._run_checks_ignorable(False, already_running_ok)
+        state = yield from self._get_state()
+        if state in self.running_status:
+            self.state = 'infusing'
+            logger.info('%s: Pump has started running', self.name)
+        else:
+            raise PumpError(f'{self.name}: pump is not running: {state}')
+
+    def stop(self, already_stopped_ok: bool = True):
+        """
+        Stops pump. If the pump is already stopped, nothing will happen.
+        """
+        return self._drive(self._stop(already_stopped_ok))
+
+    def _stop(self, already_stopped_ok: bool = True):
+        late = self.serialcon._out_of_step_since is not None # STP does not wait for late replies, so its reply may be one of them
+        try:
+            resp = yield self._command('STP')
+        except PumpNotApplicableError as e:
+            if already_stopped_ok:
+                logger.info('%s: Pump is already stopped, continuing without error.', self.name)
+            else:
+                raise PumpNotApplicableError(f'{self.name}: Pump is already stopped, cannot stop pump.')
+       
+        state = yield from self._get_state(max_age=0 if late else None)
+        if state in self.stopped_status:
+            self.state = 'idle'
+            logger.info('%s: stopped pump', self.name)
+        else:
+            raise PumpError(f'{self.name}: pump has not stopped: {state}')
+
+    # shared gets:
+
+    def get_version(self) -> str:
+        """
+        Get the firmware version of the connected device
+
+        Returns
+        -------
+        str
+            Version
+        """
+        return self._drive(self._get_version())
+
+    def _get_version(self):
+        version = (yield self._command('VER'))[1].strip()
+        logger.debug('%s: firmware version is %s', self.name, version)
+        return version
+
+    def get_status(self, max_age: float | None = None) -> PumpStatus:
+        """Get the mode and state of the pump, with a single MOD command.
+
+        A status read less than max_age seconds ago is reused, unless a
+        command was sent since that can change it (RUN, STP or a setting).
+
+        Parameters
+        ----------
+        max_age : float, optional
+            Maximum age in seconds of a reused status (default is None, use Pump.status_ttl). Use 0 to always ask the pump.
+
+        Returns
+        -------
+        PumpStatus
+            Mode, state symbol, and whether that state means running, stopped or stalled.
+        """
+        return self._drive(self._get_status(max_age))
+
+    def _get_status(self, max_age: float | None = None):
+        max_age = self.status_ttl if max_age is None else max_age
+        if self._status is not None and time.monotonic() - self._status.time < max_age:
+            return self._status
+        changes = self._status_changes
+        status = self._parse_status((yield self._command('MOD')))
+        self._status = status
+        if self._status_changes != changes:
+            self._status = None # a command changed the status while this one was read
+        return status
+
+    def _parse_status(self, response: list[str]) -> PumpStatus:
+        """Turn the reply to a MOD command into a PumpStatus, and remember the mode."""
+        mode = response[1].strip()
+        if mode in self.mode_conversion:
+            self._remember_setting('MOD', self.mode_conversion[mode])
+        state = response[-1][-1] # the prompt ends in the state symbol, after the address
+        return PumpStatus(mode, state, state in self.running_status, state in self.stopped_status, state in self.stalled_status, time.monotonic())
+
+    def get_state(self, max_age: float | None = None) -> str:
+        """Get the current state of the pump. Note that the symbol returned will have a different meaning in different pump models.
+
+        Every reply of the pump ends with its state, which is kept as
+        last_state. If that is at most max_age seconds old, it is returned
+        without asking the pump, so right after another command (e.g. in
+        run() and stop()) this costs nothing. Otherwise the state is read with
+        a MOD command, see get_status().
+
+        Parameters
+        ----------
+        max_age : float, optional
+            Maximum age in seconds of a reused state (default is None, use Pump.status_ttl). Use 0 to always ask the pump.
+
+        Returns
+        -------
+        str
+            Can be :, >, <, *, /, or ^.
+        """
+        return self._drive(self._get_state(max_age))
+
+    def _get_state(self, max_age: float | None = None):
+        max_age = self.status_ttl if max_age is None else max_age
+        if self.last_state is not None and time.monotonic() - self.last_state_time < max_age:
+            return self.last_state
+        return (yield from self._get_status(max_age=0)).state
+
+    def get_mode(self) -> str:
+        """Get the current mode of the pump. Note that different pumps have different modes available.
+        Reuses a recent status, see get_status().
+
+        Returns
+        -------
+        str
+            Pump mode. Possible replies depend on pump model
+        """
+        return self._drive(self._get_mode())
+
+    def _get_mode(self):
+        return (yield from self._get_status()).mode
+
+    def get_direction(self) -> str:
+        """Get the current direction of the pump.
+
+        Returns
+        -------
+        str
+            Can be INFUSE (outward flow) or REFILL (inward flow).
+        
+        Notes
+        -----
+        IF this pump has multiple addressable syringes, this will give only the direction of syringe 1. The direction of other syringes depends on parallel/reciprocal setting, see self.get_parallel_reciprocal.
+        """
+        return self._drive(self._get_direction())
+
+    def _get_direction(self):
+        response = yield self._command('DIR')
+        self._remember_setting('DIR', response[1])
+        return response[1]
+    
+    def get_diameter(self, syringe:int=0) -> float:
+        """
+        Get syringe diameter in mm.
+
+        Parameters
+        ----------
+        syringe : int, optional
+            Syringe number to get diameter for, 0 for do not pass on (either defaults to syringe 1 or is not used). Defaults to 0.
+
+        Returns
+        -------
+        float
+            Syringe diameter in mm.
+        """
+        return self._drive(self._get_diameter(syringe))
+
+    def _get_diameter(self, syringe:int=0):
+        resp = yield self._command('DIA', syringe = syringe)
+        relevant_line = resp[1].strip()
+        returned_diameter = self.parse_float_response(relevant_line)
+        self._remember_setting('DIA', returned_diameter, syringe)
+        logger.debug('%s: diameter of syringe is %s mm', self.name, returned_diameter)
+        return returned_diameter
+
+    def get_rate(self, syringe:int=0) -> tuple[float, str]:
+        """Get flow rate.
+
+        Parameters
+        ----------
+        syringe : int, optional
+            Syringe number to get rate for, 0 (default) for do not pass on (either defaults to syringe 1 or is not used).
+
+        Returns
+        -------
+        tuple of float and str
+            Flow rate and its units.
+        """
+        return self._drive(self._get_rate(syringe))
+
+    def _get_rate(self, syringe:int=0):
+        resp = yield self._command('RAT', syringe=syringe)
+        relevant_line = resp[1]
+        relevant_line = relevant_line.strip()
+        number = relevant_line[0:6].strip()
+        unit = relevant_line[6:].strip()
+        returned_flowrate = self.parse_float_response(number)
+        self._remember_setting('RAT', (returned_flowrate, unit), syringe)
+        logger.debug('%s: flow rate (syringe = %s) is %s %s', self.name, syringe, returned_flowrate, unit)
+        return (returned_flowrate, unit)
+
+    # shared sets
+
+    def set_mode(self, mode: str, verify: str | None = None):
+        """Set the mode of the pump.
+
+        Parameters
+        ----------
+        mode : str
+            Mode to set, available modes will depend on the device.
+        verify : str, optional
+            Verification policy for this call: VERIFY_STRICT, VERIFY_DEFERRED or VERIFY_NONE (default is None, use Pump.verification).
+        """
+        return self._drive(self._set_mode(mode, verify))
+
+    def _set_mode(self, mode: str, verify: str | None = None):
+        if mode not in self.mode_conversion.values():
+            raise PumpError(f'{self.name}: Trying to set unknown mode <{mode}>, possible modes are {tuple(self.mode_conversion.values())}')
+        # if mode == 'PGM': # can I add this later?
+        #     logger.warning(f"{self.name}: Pump mode set to PGM (program mode). Although this mode is theoretically available, it is not implemented in these scripts. Use only if you know what you are doing")
+        verify = self._verification_policy(verify)
+        if self._remembered_setting('MOD') == mode:
+            logger.debug('%s: mode already set to %s', self.name, mode)
+            return
+        self._forget_setting('MOD')
+        resp = yield self._command('MOD', mode)
+        def check():
+            set_mode = yield from self._get_mode()
+            set_mode = self.mode_conversion[set_mode]
+            if (set_mode == mode):
+                logger.info('%s: mode set to %s', self.name, mode)
+            else:
+                raise PumpError(f'{self.name}: mode not set correctly, response to set_mode {mode}: {set_mode}')
+        yield from self._verify_setting(verify, 'MOD', check, mode)
+
+    def set_direction(self, direction: str, verify: str | None = None):
+        """Set the direction of the pump.
+
+        Parameters
+        ----------
+        direction : str
+            Direction to set, can be INF(use), REF(ill), or REV(erse).
+        verify : str, optional
+            Verification policy for this call: VERIFY_STRICT, VERIFY_DEFERRED or VERIFY_NONE (default is None, use Pump.verification).
+        """
+        return self._drive(self._set_direction(direction, verify))
+
+    def _set_direction(self, direction: str, verify: str | None = None):
+        if len(self.possible_directions) == 0:
+            # this means this pump does not support changing direction.
+            raise PumpFunctionNotAvailableError(f"{self.name}: This pump does not support changing pump direction")
+        elif direction not in self.possible_directions:
+            raise PumpError(f'{self.name}: unknown direction {direction}, possible options are {self.possible_directions}')
+        verify = self._verification_policy(verify)
+        if direction in ['INF','REV'] and (self._remembered_setting('DIR') or '')[:3] == direction:
+            logger.debug('%s: direction already set to %s', self.name, direction)
+            return
+        # reversing can only be checked when we know the old direction
+        old_direction = (yield from self._get_direction()) if verify != VERIFY_NONE else None
+        self._forget_setting('DIR')
+        resp = yield self._command('DIR', direction)
+        def check():
+            new_direction = yield from self._get_direction()
+            if direction in ['INF','REV'] and (new_direction[:3] == direction):
+                logger.info('%s: direction set to %s', self.name, direction)
+            elif direction == 'REF' and (new_direction != old_direction) and (new_direction[:3] in ['INF','REV']):
+                logger.info('%s: direction reversed to %s', self.name, direction)
+            else:
+                raise PumpError(f'{self.name}: direction not set correctly, response to set_direction {direction}: {new_direction}')
+        yield from self._verify_setting(verify, 'DIR', check) # the reply to DIR is not known beforehand, so it cannot be remembered
+
+    def set_diameter(self, diameter : float, syringe:int=0, verify: str | None = None):
+        """
+        Set syringe diameter (always in millimetres).
+
+        Parameters
+        ----------
+        diameter : float
+            Syringe diameter.
+        syringe : int, optional
+            Syringe number to set diameter for, 0 (the default) for do not pass on (either defaults to syringe 1 or is not used).
+        verify : str, optional
+            Verification policy for this call: VERIFY_STRICT, VERIFY_DEFERRED or VERIFY_NONE (default is None, use Pump.verification).
+
+        Notes
+        -----
+        With strict verification, the pump is checked not to be running before the diameter is set. Otherwise
+        we rely on the pump refusing the new diameter while running.
+        """
+        return self._drive(self._set_diameter(diameter, syringe, verify))
+
+    def _set_diameter(self, diameter : float, syringe:int=0, verify: str | None = None):
+        if not (0.1 < diameter < 50): # manual gives these limits
+            raise PumpError(f'{self.name}: diameter {diameter} mm is out of range')
+        verify = self._verification_policy(verify)
+        str_diameter = self.parse_float_to_str(diameter)
+        if self._remembered_setting('DIA', syringe) == float(str_diameter):
+            logger.debug('%s: diameter of syringe <%s> already set to %s mm', self.name, syringe, diameter)
+            return
+        elif verify == VERIFY_STRICT and (yield from self._get_state()) in self.running_status:
+            raise PumpError(f'{self.name}: cannot set diameter while pump is running, please stop the pump first')
+        self._forget_setting('DIA', syringe)
+        resp = yield self._command('DIA', str_diameter, syringe=syringe) 
+        def check():
+            returned_diameter = yield from self._get_diameter(syringe)
+            # Check diameter was set accurately
+            if returned_diameter != float(str_diameter):
+                raise PumpError(f'{self.name}: set diameter ({diameter} mm) does not match diameter returned by pump ({returned_diameter} mm)')
+                # this should be raised no?
+            elif float(returned_diameter) == diameter:
+                logger.info('%s: diameter set to %s mm', self.name, diameter)
+        yield from self._verify_setting(verify, 'DIA', check, float(str_diameter), syringe)
+
+    def set_rate(self, flowrate:float, unit:str="ml/hr", syringe:int=0, verify: str | None = None):
+        """
+        Set flow rate.
+
+        Parameters
+        ----------
+        flowrate : float
+            Flow rate to set.
+        unit : str, optional
+            Unit of flow rate, can be 'ml/hr', 'ul/hr', 'ml/mn', or 'ul/mn' (default is 'ml/hr').
+        syringe : int, optional
+            Syringe number to set rate for, 0 (the default) for do not pass on (either defaults to syringe 1 or is not used) (default is 0).
+        verify : str, optional
+            Verification policy for this call: VERIFY_STRICT, VERIFY_DEFERRED or VERIFY_NONE (default is None, use Pump.verification).
+        """
+        return self._drive(self._set_rate(flowrate, unit, syringe, verify))
+
+    def _set_rate(self, flowrate:float, unit:str="ml/hr", syringe:int=0, verify: str | None = None):
+        if unit not in self.unit_conversion:
+            raise ValueError(f'{self.name}: unknown unit {unit}, must be one of {tuple(self.unit_conversion.keys())}')
+        verify = self._verification_policy(verify)
+        actual_units = self.unit_conversion[unit]
+        parsed_flowrate = self.parse_float_to_str(flowrate)
+        if self._remembered_setting('RAT', syringe) == (float(parsed_flowrate), unit):
+            logger.debug('%s: flowrate of syringe <%s> already set to %s %s', self.name, syringe, flowrate, unit)
+            return
+        self._forget_setting('RAT', syringe)
+        resp = yield self._command('RAT', f"{parsed_flowrate}", actual_units, syringe)
+        def check():
+            rate_reply = yield from self._get_rate(syringe)
+            
+            logger.debug('%s: flowrate of syringe <%s> set to %s, outcome = %s', self.name, syringe, float(parsed_flowrate), rate_reply[0])
+            logger.debug('%s: unit of syringe <%s> set to %s, outcome = %s', self.name, syringe, unit, rate_reply[1])
+
+            if (float(parsed_flowrate) == rate_reply[0]) and (unit == rate_reply[1]):
+                logger.info('%s: flowrate of syringe <%s> set to %s %s', self.name, syringe, flowrate, unit)
+            else:
+                raise PumpError(f'{self.name}: flowrate of syringe <{syringe}> not set correctly, response to set_rate {flowrate} {unit}: {rate_reply}')
+        yield from self._verify_setting(verify, 'RAT', check, (float(parsed_flowrate), unit), syringe)
+
+    # misc functions
+
+    def snapshot(self) -> PumpSnapshot:
+        """
+        Read everything the pump reports about itself, with one command per value.
+
+        Returns
+        -------
+        PumpSnapshot
+            Immutable record of state, mode, direction, rate and diameter per syringe, and the settings specific to the pump model.
+        """
+        return self._drive(self._snapshot())
+
+    def _snapshot(self):
+        started = time.time()
+        fields = yield from self._snapshot_fields()
+        return PumpSnapshot(self.name, self.address, self.__class__.__name__, self.firmware_version, started, **fields)
+
+    def _snapshot_fields(self):
+        """Steps reading the values of a snapshot, overwrite (and extend) this for pump models with more settings."""
+        status = yield from self._get_status(max_age=0)
+        direction = yield from self._get_direction()
+        syringes = {}
+        for syringe in self._snapshot_syringes():
+            syringes[syringe] = SyringeSnapshot((yield from self._get_rate(syringe)), (yield from self._get_diameter(syringe)))
+        return {'status': status, 'direction': direction, 'syringes': MappingProxyType(syringes)}
+
+    def _snapshot_syringes(self) -> list[int]:
+        """Syringes to read in a snapshot: the individually addressable ones, or 0 if there are none."""
+        return [syringe for syringe in self.syringe_selection if syringe] or [0]
+
+    def log_all_settings(self, snapshot: PumpSnapshot | None = None):
+        """
+        Log all internal pump settings we have available, like state, mode, etc. This function will not log current output rate, etc.
+
+        Parameters
+        ----------
+        snapshot : PumpSnapshot, optional
+            Snapshot to log (default is None, take a new one).
+        """
+        return self._drive(self._log_all(self._log_settings, snapshot))
+
+    def _log_all(self, log, snapshot: PumpSnapshot | None):
+        """Steps passing snapshot (or a new one) to log."""
+        log(snapshot or (yield from self._snapshot()))
+
+    def _log_settings(self, snapshot: PumpSnapshot):
+        logger.info('%s: logging all settings:', self.name)
+        logger.info('\tControlled using %s object', snapshot.model)
+        logger.info('\tfirmware version: %s', snapshot.firmware_version)
+        logger.info('\tstate: %s', snapshot.status.state)
+        logger.info('\tmode: %s', snapshot.status.mode)
+        logger.info('\tdirection: %s', snapshot.direction)
+        if snapshot.parallel_reciprocal is not None:
+            logger.info('\tparallel_reciprocal: %s', snapshot.parallel_reciprocal)
+        if snapshot.autofill is not None:
+            logger.info('\tautofill: %s', snapshot.autofill)
+
+    def log_all_parameters(self, snapshot: PumpSnapshot | None = None):
+        """
+        Log important parameters, like pump rate, diameter, etc.
+
+        Parameters
+        ----------
+        snapshot : PumpSnapshot, optional
+            Snapshot to log (default is None, take a new one).
+        """
+        return self._drive(self._log_all(self._log_parameters, snapshot))
+
+    def _log_parameters(self, snapshot: PumpSnapshot):
+        logger.info('%s: logging all parameters:', self.name)
+        for syr, syringe in snapshot.syringes.items():
+            logger.info('syringe <%s>:', syr)
+            logger.info('\trate: %s', syringe.rate)
+            if snapshot.refill_rate is not None:
+                logger.info('\trefill_rate: %s', snapshot.refill_rate)
+            logger.info('\tdiameter: %s mm', syringe.diameter)
+        if snapshot.volume_delivered is not None:
+            logger.info('\tvolume_delivered: %s mL', snapshot.volume_delivered)
+        if snapshot.target_volume is not None:
+            logger.info('\ttarget_volume: %s mL', snapshot.target_volume)
+
+    def sleep_with_heartbeat(self, sleep_time: float, beat_interval: float = 5, error_wakeup: bool = False, volumes=None, min_beat_interval: float = 1.0, max_beat_interval: float = 60.0):
+        """Sleep for a specified number of seconds, while checking the pump state to watch for stall, and making sure pump is not disconnected during wait.
+        This blocks the calling thread for one pump, to watch many pumps in the background use a Watchdog instead.
+
+        With a VolumeIntegrator that knows the volume in the syringes (see
+        VolumeIntegrator.set_syringe_volume), the state is checked rarely while
+        the syringes are far from empty and every min_beat_interval near the
+        predicted end, see VolumeIntegrator.check_interval().
+
+        Parameters
+        ----------
+        sleep_time : float
+            Number of seconds to sleep.
+        beat_interval : float, optional
+            Interval in seconds to check the pump state (default is 5 seconds).
+        error_wakeup : bool, optional
+            If True, will raise a PumpError if the pump state changes to stalled or disconnected during the sleep period (default is False).
+        volumes : VolumeIntegrator, optional
+            Integrator tracking this pump, to adapt the interval to the predicted time to empty (default is None, use beat_interval).
+        min_beat_interval : float, optional
+            Shortest interval in seconds, used near the predicted end (default is 1 second). A state in a reply to another command at most this old is used instead of asking the pump.
+        max_beat_interval : float, optional
+            Longest interval in seconds, used while the syringes are far from empty (default is 60 seconds).
+        """
+        end_time = time.time() + sleep_time
+        if len(self.stalled_status) == 0 and error_wakeup:
+            logger.warning("%s: This pump does not have automatic stall detection! Error detection will *not* fail when syringe is depleted!", self.name)
+        while time.time() < end_time:
+            state = self.get_state(max_age=min_beat_interval) # a recent reply shows the connection is fine, otherwise ask, so things will error out when connection is lost
+            if state in self.stalled_status and error_wakeup:
+                raise PumpError(f'{self.name}: pump has stalled, please check the syringe(s)!')
+            if volumes is not None:
+                interval = volumes.check_interval(self, beat_interval, min_beat_interval, max_beat_interval)
+            else:
+                interval = beat_interval
+            time.sleep(max(0.0, min(interval, end_time - time.time())))
+
+class PumpModel33(Pump):
+    syringe_selection = {
+        0 : "",
+        1 : "A",
+        2 : "B",
+    }
+    running_status = ('<','>')
+    stopped_status = (':', ) 
+    stalled_status = ('*',) 
+    mode_conversion = {
+        "AUT": "AUT", # AUTo
+        "PRO": "PRO", # PROportiona
+        "CON": "CON", # CONtinuous
+    } # AUT(o stop), PRO(portional), or CON(tinuous).
+
+    def __init__(self, chain:Chain, address:int=0, name:str='Model33', firmware_version:str|None=None):
+        super().__init__(chain,address,name,firmware_version)
+
+    def _check_firmware(self):
+        if not self.firmware_version.startswith('33'):
+            logger.warning('%s: firmware version %s indicates this is probably not a Model 33 pump. Continue at your own risk.', self.name, self.firmware_version)
+
+    def get_parallel_reciprocal(self) -> str:
+        """
+        Get the current parallel/reciprocal setting of the pump.
+
+        Returns
+        -------
+        str
+            Can be ON (parallel) or OFF (Reciprocal).
+        """
+        return self._drive(self._get_parallel_reciprocal())
+
+    def _get_parallel_reciprocal(self):
+        response = yield self._command('PAR')
+        self._remember_setting('PAR', response[1])
+        return response[1]
+    
+    def set_parallel_reciprocal(self, setting: str, verify: str | None = None):
+        """Set the parallel/reciprocal setting of the pump.
+
+        Parameters
+        ----------
+        setting : str
+            Setting to set, can be ON (parallel) or OFF (Reciprocal).
+        verify : str, optional
+            Verification policy for this call: VERIFY_STRICT, VERIFY_DEFERRED or VERIFY_NONE (default is None, use Pump.verification).
+        """
+        return self._drive(self._set_parallel_reciprocal(setting, verify))
+
+    def _set_parallel_reciprocal(self, setting: str, verify: str | None = None):
+        if setting not in ['ON', 'OFF']:
+            raise PumpError(f'{self.name}: unknown parallel/reciprocal setting {setting}')
+        verify = self._verification_policy(verify)
+        if self._remembered_setting('PAR') == setting:
+            logger.debug('%s: parallel/reciprocal already set to %s', self.name, setting)
+            return
+        self._forget_setting('PAR')
+        resp = yield self._command('PAR', setting)
+        def check():
+            parrep = yield from self._get_parallel_reciprocal()
+            if (parrep == setting):
+                logger.info('%s: parallel/reciprocal set to %s', self.name, setting)
+            else:
+                raise PumpError(f'{self.name}: parallel/reciprocal not set correctly, response to set_parallel_reciprocal {setting}: {parrep}')
+        yield from self._verify_setting(verify, 'PAR', check, setting)
+
+    def _snapshot_fields(self):
+        fields = yield from super()._snapshot_fields()
+        return fields | {'parallel_reciprocal': (yield from self._get_parallel_reciprocal())}
+
+class PumpPHD2000(Pump):
+    mode_conversion = {
+        "PUMP": "PMP",
+        "VOLUME": "VLM",
+    }
+    syringe_selection = { 
+        0 : "",
+    }
+    running_status = ('<','>')
+    stopped_status = (':', '*', '/', '^') # stopped, interupted, paused, and wait for trigger respectively.
+    stalled_status = tuple()              # PHD2000 has no stall detection?
+
+    def __init__(self, chain:Chain, address:int=0, name:str='PHD2000', firmware_version:str|None=None):
+        super().__init__(chain,address,name,firmware_version)
+
+    def _check_firmware(self):
+        if not self.firmware_version.startswith('PHD'):
+            logger.warning('%s: firmware version %s indicates this is probably not a PHD 2000 pump. Continue at your own risk.', self.name, self.firmware_version)
+        
+    def get_volume_delivered(self) -> float:
+        """
+        Get the volume delivered, in mL.
+
+        Returns
+        -------
+        float
+            Volume delivered in mL
+        """
+        return self._drive(self._get_volume_delivered())
+
+    def _get_volume_delivered(self):
+        resp = yield self._command('DEL')
+        relevant_line = resp[1]
+        vol = relevant_line.strip()
+        returned_volume = self.parse_float_response(vol)
+        logger.debug('%s: delivered volume is %s mL', self.name, returned_volume)
+        return returned_volume
+
+    def reset_volume_delivered(self):
+        """
+        Reset the volume delivered to zero. Only run this when pump is not running.
+        """
+        return self._drive(self._reset_volume_delivered())
+
+    def _reset_volume_delivered(self):
+        #if self.get_state not in self.stopped_status:
+        #    raise PumpNotApplicableError(f"{self.name}: Volume delivered can only be reset when pump is not running")
+        resp = yield self._command('CLD')
+        vol_del = yield from self._get_volume_delivered()
+        if vol_del != 0:
+            raise PumpError(f'{self.name}: volume delivered not succesfully reset')
+        else:
+            logger.info('%s: volume delivered reset to 0 mL', self.name)
+
+    def get_target_volume(self) -> float:
+        """
+        Get target volume (as needed in 'VOL' mode).
+
+        Returns
+        -------
+        float
+            Target volume, in unit mL
+        """
+        return self._drive(self._get_target_volume())
+
+    def _get_target_volume(self):
+        resp = yield self._command('TGT')
+        relevant_line = resp[1]
+        number = relevant_line.strip()
+        returned_target_volume = self.parse_float_response(number)
+        self._remember_setting('TGT', self.parse_float_to_str(returned_target_volume))
+        logger.debug('%s: target volume is %s mL', self.name, returned_target_volume)
+        return returned_target_volume
+
+    def set_target_volume(self, volume:float, verify: str | None = None):
+        """
+        Set target volume (as needed in 'VOL' mode).
+
+        Parameters
+        ----------
+        volume : float
+            Target volume in mL.
+        verify : str, optional
+            Verification policy for this call: VERIFY_STRICT, VERIFY_DEFERRED or VERIFY_NONE (default is None, use Pump.verification).
+        """
+        return self._drive(self._set_target_volume(volume, verify))
+
+    def _set_target_volume(self, volume:float, verify: str | None = None):
+        verify = self._verification_policy(verify)
+        str_volume = self.parse_float_to_str(volume)
+        if self._remembered_setting('TGT') == str_volume:
+            logger.debug('%s: target volume already set to %s mL', self.name, volume)
+            return
+        elif verify == VERIFY_STRICT and (yield from self._get_state()) in self.running_status:
+            raise PumpError(f'{self.name}: cannot set diameter while pump is running, please stop the pump first')
+        self._forget_setting('TGT')
+        resp = yield self._command('TGT', str_volume) 
+        def check():
+            returned_volume = yield from self._get_target_volume()
+            # Check diameter was set accurately
+            if (self.parse_float_to_str(returned_volume)) != str_volume:
+                logger.error(f'{self.name}: set target volume ({volume} mL) does not match diameter returned by pump ({returned_volume} mL)')
+            else:
+                logger.info('%s: diameter set to %s mL', self.name, volume)
+        yield from self._verify_setting(verify, 'TGT', check, str_volume)
+
+    def get_autofill(self):
+        """
+        Get the auto-fill setting.
+        
+        Returns
+        -------
+        str
+            Auto-fill setting, either 'ON' or 'OFF'
+        """
+        return self._drive(self._get_autofill())
+
+    def _get_autofill(self):
+        resp = yield self._command('AF')
+        return resp[1].strip()
+
+    def set_autofill(self, autofill:str):
+        """Will raise an PumpFunctionNotAvailable error"""
+        raise PumpFunctionNotAvailableError(f"{self.name}: This pump cannot refill, and thus auto-fill mode is always OFF.")
+
+    def _snapshot_fields(self):
+        fields = yield from super()._snapshot_fields()
+        return fields | {
+            'volume_delivered': (yield from self._get_volume_delivered()),
+            'target_volume': (yield from self._get_target_volume()),
+            'autofill': (yield from self._get_autofill()),
+        }
+
+    def set_refill_rate(self, flowrate:float, unit:str="", verify: str | None = None):
+        """Will raise an PumpFunctionNotAvailable error"""
+        raise PumpFunctionNotAvailableError(f"{self.name}: This pump cannot refill, and thus a refill rate cannot be set.")
+
+    def get_refill_rate(self, syringe:float=0) -> tuple[float,str]:
+        """This pump does not have refill capabilities. Will always return a random number"""
+        return self._drive(self._get_refill_rate(syringe))
+
+    def _get_refill_rate(self, syringe:float=0):
+        logger.warning('%s: refill rate requested, but does not exist for this pump. User given a random number', self.name)
+        return (4, list(self.unit_conversion.keys())[-1])
+        yield # no commands, but still steps like those of pumps that can refill
+
+    def set_direction(self, direction: str, verify: str | None = None):
+        """Will raise an PumpFunctionNotAvailable error"""
+        raise PumpFunctionNotAvailableError(f"{self.name}: This pump does not support changing pump direction")
+
+class PumpPHD2000_Refill(PumpPHD2000):
+    def __init__(self, chain:Chain, address:int=0, name:str='PHD2000', firmware_version:str|None=None):
+        super().__init__(chain,address,name,firmware_version)
+
+    def _snapshot_fields(self):
+        fields = yield from super()._snapshot_fields()
+        return fields | {'refill_rate': (yield from self._get_refill_rate())}
+
+    def set_refill_rate(self, flowrate:float, unit:str="ml/hr", verify: str | None = None):
+        """
+        Set refill flow rate.
+
+        Parameters
+        ----------
+        flowrate : float
+            Refill flow rate to set.
+        unit : str, optional
+            Unit of flow rate, can be 'ml/hr', 'ul/hr', 'ml/mn', or 'ul/mn' (default is 'ml/hr').
+        verify : str, optional
+            Verification policy for this call: VERIFY_STRICT, VERIFY_DEFERRED or VERIFY_NONE (default is None, use Pump.verification).
+        """
+        return self._drive(self._set_refill_rate(flowrate, unit, verify))
+
+    def _set_refill_rate(self, flowrate:float, unit:str="ml/hr", verify: str | None = None):
+        if unit not in self.unit_conversion:
+            raise ValueError(f'{self.name}: unknown unit {unit}, must be one of {list(self.unit_conversion.keys())}')
+        verify = self._verification_policy(verify)
+        actual_units = self.unit_conversion[unit]
+        parsed_flowrate = self.parse_float_to_str(flowrate)
+        if self._remembered_setting('RFR') == (float(parsed_flowrate), unit):
+            logger.debug('%s: refill flowrate already set to %s %s', self.name, flowrate, unit)
+            return
+        self._forget_setting('RFR')
+        resp = yield self._command('RFR', f"{parsed_flowrate}", actual_units)
+        def check():
+            rate_reply = yield from self._get_refill_rate()
+            
+            logger.debug('%s: refill flowrate set to %s, outcome = %s', self.name, float(parsed_flowrate), rate_reply[0])
+            logger.debug('%s: refill unit set to %s, outcome = %s', self.name, unit, rate_reply[1])
+
+            if (float(parsed_flowrate) == rate_reply[0]) and (unit == rate_reply[1]):
+                logger.info('%s: refill flowrate set to %s %s', self.name, flowrate, unit)
+            else:
+                raise PumpError(f'{self.name}: refill flowrate not set correctly, response to set_rate {flowrate} {unit}: {rate_reply}')
+        yield from self._verify_setting(verify, 'RFR', check, (float(parsed_flowrate), unit))
+        
+    def get_refill_rate(self, syringe:float=0) -> tuple[float, str]:
+        """
+        Gets the refill flow rate.
+
+        Parameters
+        ----------
+        syringe : float, optional
+            The syringe number (default is 0, use if syringes not individually addressable).
+        
+        Returns
+        -------
+        tuple of float and str
+            Flow rate and its units.
+        """
+        return self._drive(self._get_refill_rate(syringe))
+
+    def _get_refill_rate(self, syringe:float=0):
+        resp = yield self._command('RFR')
+        relevant_line = resp[1].strip()
+        number = relevant_line[0:6].strip()
+        unit = relevant_line[6:].strip()
+        returned_flowrate = self.parse_float_response(number)
+        self._remember_setting('RFR', (returned_flowrate, unit))
+        logger.debug('%s: refill flow rate is %s %s', self.name, returned_flowrate, unit)
+        return (returned_flowrate, unit)
+
+    def set_autofill(self, autofill:str):
+        """
+        Set the auto-fill setting. Cannot be run if the pump is running.
+
+        Parameters
+        ----------
+        autofill : str
+            Whether auto-fill is 'ON' or 'OFF'
+        """
+        return self._drive(self._set_autofill(autofill))
+
+    def _set_autofill(self, autofill:str):
+        if (yield from self._get_state()) in self.running_status:
+            raise PumpError(f'{self.name}: cannot set auto-fill while pump is running, please stop the pump first')
+        elif autofill not in ["ON", "OFF"]:
+            raise ValueError(f'{self.name}: <{autofill}> is not a valid choise for auto-fill mode. Select either ON or OFF')
+        resp = yield self._command('AF', autofill)
+        if (yield from self._get_autofill()) == autofill:
+            logger.info('%s: Auto-fill mode is set to %s', self.name, autofill)
+        else:
+            raise PumpError(f"{self.name}: Auto-fill mode was not set to {autofill}, actual value is {(yield from self._get_autofill())}.")
+
+class PumpPHD2000_NoRefill(PumpPHD2000):
+    def __init__(self, chain:Chain, address:int=0, name:str='PHD2000', firmware_version:str|None=None):
+        super().__init__(chain,address,name,firmware_version)
+
+# Errors:
+
+class PumpError(Exception):
+    pass
+
+class PumpNoResponseError(PumpError):
+    """Raised when the pump gives no response."""
+    def __init__(self, message):
+        super().__init__(message)   
+
+class PumpSyntaxError(PumpError):
+    """Raised when the pump returns a syntax error."""
+    def __init__(self, message):
+        super().__init__(message)
+
+class PumpOutOfRangeError(PumpError):
+    """Raised when the pump returns an out of range error."""
+    def __init__(self, message):
+        super().__init__(message)
+
+class PumpNotApplicableError(PumpError):
+    """Raised when the pump returns a command not applicable error."""
+    def __init__(self, message):
+        super().__init__(message)
+
+class PumpStallError(PumpError):
+    """Raised when we detect the pump has stalled"""
+    def __init__(self, message):
+        super().__init__(message)
+        
+class PumpFunctionNotAvailableError(PumpError):
+    """Raised when we try to use a function a pump does not have (like refilling mode)"""
+    def __init__(self, message):
+        super().__init__(message)
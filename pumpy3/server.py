@@ -0,0 +1,444 @@
+"""Share chains between processes through a pump server.
+
+Only one process can open a serial port. A PumpServer owns one or more chains
+and serves their pumps over a Unix socket or TCP, so any number of scripts can
+use the pumps at the same time. Clients use RemotePump objects, which have
+the same methods as the pumps on the server:
+
+    # in one process, or from the command line: python -m pumpy3.server COM3 --unix /tmp/pumps.sock
+    with PumpServer([Chain("COM3")], "/tmp/pumps.sock") as server:
+        server.chains[0].discover()
+        server.serve_forever()
+
+    # in any number of other processes
+    with PumpClient("/tmp/pumps.sock") as client:
+        pump = client.pump("01")          # by address, name or key, see PumpClient.pumps()
+        pump.set_rate(10, "ml/hr")
+        pump.run()
+
+Commands for the pumps of a chain are run one after another on the worker of
+the chain (see ChainPool), whatever client they come from. Stop commands do
+not queue behind them. Status queries (get_status(), get_state(), get_mode())
+are answered from the status the pump remembers if that is recent enough (see
+Pump.status_ttl), without waiting for the worker or the chain.
+
+The protocol is one JSON object per line. A request is
+{"id": 1, "pump": "01@COM3", "method": "set_rate", "args": [10, "ml/hr"], "kwargs": {}},
+and its reply {"id": 1, "result": ...} or {"id": 1, "error": "PumpOutOfRangeError", "message": "..."}.
+Replies to requests sent without waiting for the reply can come in another
+order, the id tells them apart. Requests without a pump are for the server
+itself: "pumps" lists the pumps, "emergency_stop_all" stops all of them.
+The server has no authentication: keep TCP servers on localhost or a
+trusted network. Raw commands (Pump.issue_command) are only served when the
+server is created with allow_raw_commands.
+"""
+import argparse
+import dataclasses
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from types import MappingProxyType
+
+from . import pump as _pump
+from .pool import ChainPool
+from .pump import Chain, Pump, PumpError
+
+logger = logging.getLogger(__name__)
+
+# Pump methods that are not served: they read or write half a transaction, would block the worker of a chain for a long time,
+# or set up the pump object itself (connect() closes the chain when the pump does not answer).
+_PRIVATE_METHODS = frozenset(('write', 'read', 'sleep_with_heartbeat', 'connect'))
+# Pump methods that send any command the client likes, only served with allow_raw_commands.
+_RAW_METHODS = frozenset(('issue_command',))
+# Pump methods that do not queue behind the worker of the chain, the chain lets them go first (see Chain.reserve).
+_URGENT_METHODS = frozenset(('stop',))
+_STATUS_METHODS = frozenset(('get_status', 'get_state', 'get_mode'))
+# Exceptions raised again by the client under their own name, others become a PumpError.
+_ERRORS = {name: cls for name, cls in vars(_pump).items() if isinstance(cls, type) and issubclass(cls, PumpError)}
+_ERRORS.update({cls.__name__: cls for cls in (ValueError, TypeError, KeyError, AttributeError)})
+_UNCACHED = object()
+
+def _encode(value):
+    """Turn a result into something json can write: dataclasses and mappings are tagged, so _decode() can restore them."""
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {'__type__': type(value).__name__, **{field.name: _encode(getattr(value, field.name)) for field in dataclasses.fields(value)}}
+    if isinstance(value, (dict, MappingProxyType)):
+        return {'__items__': [[_encode(key), _encode(item)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, BaseException):
+        return f'{type(value).__name__}: {value}'
+    if isinstance(value, Pump):
+        return value.name
+    return value
+
+def _decode(value):
+    """Restore a value written by _encode(). Lists become tuples, like the results of the pump methods."""
+    if isinstance(value, list):
+        return tuple(_decode(item) for item in value)
+    if isinstance(value, dict):
+        if '__items__' in value:
+            return MappingProxyType({_decode(key): _decode(item) for key, item in value['__items__']})
+        fields = {key: _decode(item) for key, item in value.items() if key != '__type__'}
+        cls = getattr(_pump, value.get('__type__', ''), None)
+        return cls(**fields) if dataclasses.is_dataclass(cls) else fields
+    return value
+
+def _pump_key(pump: Pump) -> str:
+    return f'{pump.address}@{pump.serialcon.port}'
+
+def _served_methods(pump: Pump, allow_raw_commands: bool = False) -> list[str]:
+    hidden = _PRIVATE_METHODS if allow_raw_commands else _PRIVATE_METHODS | _RAW_METHODS
+    return sorted(name for name in dir(type(pump)) if not name.startswith('_') and name not in hidden and callable(getattr(type(pump), name)))
+
+class PumpServer:
+    """Create PumpServer object, serving the pumps on chains to clients on a Unix socket or TCP.
+
+    The chains are driven by a ChainPool, which the server closes (with the
+    chains) when it is closed. Pumps registered on the chains later, e.g.
+    by discover(), are served as well.
+    """
+    def __init__(self, chains: list[Chain], address: str | tuple[str, int], allow_raw_commands: bool = False):
+        """
+        :param chains: Chains with the pumps to serve
+        :type chains: list of Chain
+        :param address: Path of a Unix socket, or (host, port) to listen on TCP (port 0 picks a free port, see address)
+        :type address: str or tuple of str and int
+        :param allow_raw_commands: Also serve issue_command(), which lets clients send any command to the pumps (default False)
+        :type allow_raw_commands: bool
+        """
+        self.pool = ChainPool(chains)
+        self.allow_raw_commands = allow_raw_commands
+        self.requests = 0 # number of requests answered
+        self.cached = 0   # number of those answered from a remembered status
+        self._counter_lock = threading.Lock() # requests are answered from the threads of clients and workers
+        if isinstance(address, str):
+            self._remove_stale_socket(address)
+            self._server = _UnixServer(address, _Connection)
+        else:
+            self._server = _TcpServer(address, _Connection)
+        self._server.pump_server = self
+        self.address = self._server.server_address
+        self._thread = None
+        self._serving = False
+        logger.info(f'{self}: listening')
+
+    def __repr__(self):
+        return f"Pump server on {self.address} for {', '.join(chain.port for chain in self.chains)}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    @property
+    def chains(self) -> list[Chain]:
+        return self.pool.chains
+
+    @staticmethod
+    def _remove_stale_socket(path: str):
+        """Remove a Unix socket left behind by a server that is gone, refuse to replace one that still answers."""
+        if not os.path.exists(path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise OSError(f'another server is listening on {path}')
+        finally:
+            probe.close()
+
+    def serve_forever(self):
+        """Answer clients until close() is called from another thread (or Ctrl+C)."""
+        self._serving = True
+        try:
+            self._server.serve_forever()
+        finally:
+            self._serving = False
+
+    def start(self) -> 'PumpServer':
+        """Answer clients on a background thread, and return the server."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f'PumpServer {self.address}', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self, close_chains: bool = True):
+        """Stop answering clients, wait for the commands that were submitted, and close the chains.
+
+        :param close_chains: Also close the ports of the chains (default)
+        :type close_chains: bool
+        """
+        if self._thread is not None or self._serving:
+            self._server.shutdown()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.pool.close(close_chains)
+        logger.info(f'{self}: closed after {self.requests} requests ({self.cached} answered from remembered status)')
+
+    def find_pump(self, key: str) -> Pump:
+        """Return the pump with a key (address@port), name, or address (e.g. '01' or '1').
+
+        :raises KeyError: if no pump or more than one pump matches
+        """
+        pumps = self.pool.pumps
+        for pump in pumps:
+            if _pump_key(pump) == key:
+                return pump
+        matches = [pump for pump in pumps if pump.name == key]
+        if not matches and str(key).isdigit():
+            matches = [pump for pump in pumps if int(pump.address) == int(key)]
+        if len(matches) != 1:
+            raise KeyError(f'{"no pump" if not matches else "several pumps"} found for {key!r}, use one of {[_pump_key(pump) for pump in pumps]}')
+        return matches[0]
+
+    def describe_pumps(self) -> list[dict]:
+        """Return key, name, address, model, port and methods of every pump, as sent for the 'pumps' request."""
+        return [{'key': _pump_key(pump), 'name': pump.name, 'address': pump.address, 'model': type(pump).__name__,
+                 'port': pump.serialcon.port, 'methods': _served_methods(pump, self.allow_raw_commands)} for pump in self.pool.pumps]
+
+    def handle(self, request: dict, reply):
+        """Carry out a decoded request, and pass the reply (a dict) to reply(), right away or later from a worker."""
+        def answer(result=None, error=None):
+            with self._counter_lock:
+                self.requests += 1
+            if error is None:
+                reply({'id': request.get('id'), 'result': _encode(result)})
+            else:
+                reply({'id': request.get('id'), 'error': type(error).__name__, 'message': str(error)})
+        try:
+            method = request['method']
+            args, kwargs = request.get('args', ()), request.get('kwargs', {})
+            if request.get('pump') is None:
+                if method == 'pumps':
+                    return answer(self.describe_pumps())
+                if method == 'emergency_stop_all':
+                    return answer(self.pool.emergency_stop_all())
+                raise AttributeError(f'the server has no method {method!r}')
+            pump = self.find_pump(request['pump'])
+            if method.startswith('_') or method in _PRIVATE_METHODS or (method in _RAW_METHODS and not self.allow_raw_commands):
+                raise AttributeError(f'{method!r} is not served')
+            function = getattr(pump, method)
+            if not callable(function):
+                raise AttributeError(f'{method!r} is not a method')
+            if method in _STATUS_METHODS:
+                result = self._cached_status(pump, method, args, kwargs)
+                if result is not _UNCACHED:
+                    with self._counter_lock:
+                        self.cached += 1
+                    return answer(result)
+            if method in _URGENT_METHODS:
+                return answer(function(*args, **kwargs))
+        except Exception as e:
+            return answer(error=e)
+        future = self.pool.submit(pump.serialcon, function, *args, **kwargs)
+        future.add_done_callback(lambda future: answer(error=future.exception()) if future.exception() else answer(future.result()))
+
+    @staticmethod
+    def _cached_status(pump: Pump, method: str, args, kwargs):
+        """Return the answer to a status query from what the pump remembers, or _UNCACHED if the pump has to be asked."""
+        max_age = kwargs.get('max_age', args[0] if args else None)
+        max_age = pump.status_ttl if max_age is None else max_age
+        now = time.monotonic()
+        if method == 'get_state' and pump.last_state is not None and now - pump.last_state_time < max_age:
+            return pump.last_state
+        status = pump._status
+        if status is None or now - status.time >= max_age:
+            return _UNCACHED
+        return status if method == 'get_status' else status.state if method == 'get_state' else status.mode
+
+class _Connection(socketserver.StreamRequestHandler):
+    """A client of a PumpServer, on a thread of its own."""
+    def setup(self):
+        super().setup()
+        if self.connection.family != socket.AF_UNIX:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._write_lock = threading.Lock()
+
+    def reply(self, message: dict):
+        data = json.dumps(message, separators=(',', ':')).encode() + b'\n'
+        with self._write_lock:
+            try:
+                self.connection.sendall(data)
+            except OSError:
+                pass # the client is gone, its other requests are still carried out
+
+    def handle(self):
+        server = self.server.pump_server
+        logger.debug('%s: client %s connected', server, self.client_address)
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('a request must be a JSON object')
+            except ValueError as e:
+                self.reply({'id': None, 'error': 'ValueError', 'message': f'invalid request: {e}'})
+                continue
+            server.handle(request, self.reply)
+        logger.debug('%s: client %s disconnected', server, self.client_address)
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class PumpClient:
+    """Create PumpClient object, a connection to a PumpServer.
+
+    A client can be used from several threads, but it sends one request at a
+    time. Give threads a client of their own to have their requests carried
+    out at the same time. Times in results (e.g. PumpStatus.time) are
+    time.monotonic() of the server.
+    """
+    def __init__(self, address: str | tuple[str, int], timeout: float | None = None):
+        """
+        :param address: Path of the Unix socket of the server, or its (host, port)
+        :type address: str or tuple of str and int
+        :param timeout: Maximum time in seconds to wait for a reply, None (default) to wait as long as the pump takes
+        :type timeout: float, optional
+        """
+        self.address = address
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(address)
+        else:
+            self._socket = socket.create_connection(address)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.settimeout(timeout)
+        self._file = self._socket.makefile('rb')
+        self._lock = threading.Lock()
+        self._ids = 0
+
+    def __repr__(self):
+        return f"Pump client of {self.address}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def call(self, pump: str | None, method: str, *args, **kwargs):
+        """Call method(*args, **kwargs) of a pump on the server (None for the server itself), and return the result.
+
+        :raises PumpError: or the exception raised on the server, if it is a PumpError, ValueError, TypeError, KeyError or AttributeError
+        :raises ConnectionError: if the server closed the connection
+        """
+        with self._lock:
+            self._ids += 1
+            request = {'id': self._ids, 'pump': pump, 'method': method, 'args': args, 'kwargs': kwargs}
+            self._socket.sendall(json.dumps(request, separators=(',', ':')).encode() + b'\n')
+            while True:
+                line = self._file.readline()
+                if not line:
+                    raise ConnectionError(f'{self.address} closed the connection')
+                message = json.loads(line)
+                if message.get('id') == self._ids:
+                    break
+        if 'error' in message:
+            error = _ERRORS.get(message['error'])
+            if error is None:
+                raise PumpError(f"{message['error']} on the server: {message['message']}")
+            raise error(message['message'])
+        return _decode(message['result'])
+
+    def pumps(self) -> list['RemotePump']:
+        """Return all pumps on the server."""
+        return [RemotePump(self, info) for info in self.call(None, 'pumps')]
+
+    def pump(self, key: str | int) -> 'RemotePump':
+        """Return a pump on the server by key (address@port), name or address.
+
+        :raises KeyError: if no pump or more than one pump matches
+        """
+        pumps = self.pumps()
+        for attribute in ('key', 'name'):
+            matches = [pump for pump in pumps if getattr(pump, attribute) == key]
+            if matches:
+                break
+        else:
+            matches = [pump for pump in pumps if str(key).isdigit() and int(pump.address) == int(key)]
+        if len(matches) != 1:
+            raise KeyError(f'{"no pump" if not matches else "several pumps"} found for {key!r}, use one of {[pump.key for pump in pumps]}')
+        return matches[0]
+
+    def emergency_stop_all(self):
+        """Stop all pumps on all chains of the server, see ChainPool.emergency_stop_all()."""
+        self.call(None, 'emergency_stop_all')
+
+class RemotePump:
+    """A pump on a PumpServer, with the same methods as the pump object on the server.
+
+    Every method call is a request to the server. Attributes other than
+    name, address, model, port and key are not available.
+    """
+    def __init__(self, client: PumpClient, info: dict):
+        self.client = client
+        self.key = info['key']
+        self.name = info['name']
+        self.address = info['address']
+        self.model = info['model']
+        self.port = info['port']
+        self._methods = frozenset(info['methods'])
+
+    def __repr__(self):
+        return f"RemotePump (name = {self.name}, model = {self.model}) at address <{self.address}> on <{self.port}> through <{self.client}>"
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | self._methods)
+
+    def __getattr__(self, method: str):
+        if method.startswith('_') or method not in self._methods:
+            raise AttributeError(f"{self.model} on the server has no method {method!r}")
+        def call(*args, **kwargs):
+            return self.client.call(self.key, method, *args, **kwargs)
+        call.__name__ = method
+        return call
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the pumps on one or more serial ports to other processes.")
+    parser.add_argument('ports', nargs='+', help="serial ports of the chains, e.g. COM3 or /dev/ttyUSB0")
+    listen = parser.add_mutually_exclusive_group(required=True)
+    listen.add_argument('--unix', metavar='PATH', help="path of the Unix socket to listen on")
+    listen.add_argument('--tcp', metavar='HOST:PORT', help="address to listen on, e.g. localhost:4400")
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--timeout', type=float, default=0.1, help="Chain timeout in seconds")
+    parser.add_argument('--addresses', type=int, nargs='+', default=range(100), help="pump addresses to look for (default: all)")
+    parser.add_argument('--allow-raw-commands', action='store_true', help="let clients send any command with issue_command()")
+    parser.add_argument('--verbose', '-v', action='store_true', help="log every request")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.tcp is not None:
+        host, _, port = args.tcp.rpartition(':')
+        address = (host or 'localhost', int(port))
+    else:
+        address = args.unix
+    chains = [Chain(port, baudrate=args.baudrate, timeout=args.timeout) for port in args.ports]
+    with PumpServer(chains, address, allow_raw_commands=args.allow_raw_commands) as server:
+        for chain in chains:
+            pumps = chain.discover(args.addresses)
+            print(f"{chain.port}: {', '.join(pump.name for pump in pumps) or 'no pumps found'}")
+        print(f"Serving on {server.address}, press Ctrl+C to stop")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+"""Simulated Harvard Apparatus pumps, to use the package without any hardware.
+
+A SimulatedChain holds simulated pumps at different addresses and answers
+commands like a real daisy chain would: commands and replies take as long as
+they would at the given baudrate, volumes are integrated while the pumps run,
+and syringes run empty. On Linux (and other POSIX systems) the chain is
+exposed on a pseudo-terminal, so an unmodified Chain can talk to it:
+
+    with SimulatedChain([SimulatedModel33(1), SimulatedPHD2000(2)]) as sim:
+        chain = pumpy3.Chain(sim.port)
+        pump = pumpy3.PumpModel33(chain, address=1)
+
+The simulated chain can also be started from the command line, to be used
+from another process:
+
+    python -m pumpy3.sim --model33 1 --phd2000 2 3
+
+The replies follow what the pump classes in pump.py expect. The simulation is
+meant for testing and benchmarking, it does not copy every quirk of the real
+pumps.
+"""
+import argparse
+import os
+import re
+import select
+import threading
+import time
+
+_UNIT_CODES = {
+    "UM": "ul/mn",
+    "MM": "ml/mn",
+    "UH": "ul/hr",
+    "MH": "ml/hr",
+}
+_ML_PER_SECOND = {
+    "ul/mn": 1e-3 / 60,
+    "ml/mn": 1 / 60,
+    "ul/hr": 1e-3 / 3600,
+    "ml/hr": 1 / 3600,
+}
+_NUMBER = re.compile(r'\d+(\.\d*)?|\.\d+')
+_ADDRESS = re.compile(r'\d{0,2}')
+
+def _format_number(number: float) -> str:
+    """Format a number with 5 symbols, like the pumps do (and Pump.parse_float_to_str)."""
+    return f"{number:.3f}"[:5].ljust(5, '0')
+
+class SimulatedPumpError(Exception):
+    """Raised by command handlers of simulated pumps, the message is the error reply of the pump."""
+
+class _Syringe:
+    """A simulated syringe, keeping track of its settings and the volume it delivered."""
+    def __init__(self, volume: float | None):
+        self.diameter = 10.0
+        self.rate = 1.0
+        self.unit = "ml/hr"
+        self.delivered = 0.0  # mL, positive for infusion
+        self.volume = volume  # mL in a full syringe, None for endless
+
+    def ml_per_second(self) -> float:
+        return self.rate * _ML_PER_SECOND[self.unit]
+
+    def remaining(self) -> float | None:
+        """Return the volume left to infuse in mL, or None if the syringe is endless."""
+        if self.volume is None:
+            return None
+        return max(0.0, self.volume - self.delivered)
+
+class SimulatedPump:
+    """Base class for simulated pumps.
+
+    A simulated pump answers commands through handle(). Each command has a
+    handler method called cmd_<COMMAND>, which gets the syringe letter and
+    the value of the command and returns the data line of the reply (or
+    None). Handlers raise SimulatedPumpError with '?', 'NA' or 'OOR' to make
+    the pump reply with an error.
+    """
+    firmware_version = "SIM V1.0"
+    syringes = ("",)              # letters of the syringes, the first one is used when no letter is given
+    modes = {"PMP": "PUMP"}       # mode code: reply to MOD
+    running_symbol = {"INFUSE": ">", "REVERSE": "<"}
+    stopped_symbol = ":"
+    empty_symbol = "*"            # shown when the pump stopped because a syringe is empty
+
+    def __init__(self, address: int = 0, syringe_volume: float | None = None):
+        """
+        :param address: Address of the pump on the chain
+        :type address: int
+        :param syringe_volume: Volume of a full syringe in mL, the pump stops when it is empty. None (default) for endless syringes.
+        :type syringe_volume: float, optional
+        """
+        self.address = address
+        self.mode = next(iter(self.modes))
+        self.direction = "INFUSE"
+        self.running = False
+        self.empty = False
+        self.syringe = {letter: _Syringe(syringe_volume) for letter in self.syringes}
+        self._last_update = time.monotonic()
+        self._commands = sorted((name[4:] for name in dir(self) if name.startswith('cmd_')), key=len, reverse=True)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(address={self.address})"
+
+    @property
+    def status(self) -> str:
+        """Symbol shown in the prompt."""
+        self.update()
+        if self.running:
+            return self.running_symbol[self.direction]
+        elif self.empty:
+            return self.empty_symbol
+        return self.stopped_symbol
+
+    def prompt(self) -> str:
+        """Prompt ending every reply: address (omitted for address 0) and status symbol."""
+        return (str(self.address) if self.address else "") + self.status
+
+    def handle(self, command: str) -> str:
+        """Answer a command (without address and carriage return), return the full reply."""
+        self.update()
+        try:
+            data = self._dispatch(command)
+        except SimulatedPumpError as e:
+            data = str(e)
+        reply = "\r\n"
+        if data is not None:
+            reply += data + "\r\n"
+        return reply + self.prompt()
+
+    def _dispatch(self, command: str) -> str | None:
+        for name in self._commands:
+            if command.startswith(name):
+                rest = command[len(name):]
+                break
+        else:
+            raise SimulatedPumpError("?")
+        letter = ""
+        if rest[:1] and rest[:1] in self.syringes:
+            letter, rest = rest[:1], rest[1:]
+        return getattr(self, 'cmd_' + name)(letter, rest)
+
+    def _syringe(self, letter: str) -> _Syringe:
+        """Return the syringe addressed by letter ("" for the default one)."""
+        return self.syringe[letter or self.syringes[0]]
+
+    # volume integration
+
+    def syringe_directions(self) -> dict[str, int]:
+        """Return for each syringe +1 when it infuses, -1 when it refills."""
+        sign = 1 if self.direction == "INFUSE" else -1
+        return {letter: sign for letter in self.syringes}
+
+    def update(self, now: float | None = None):
+        """Integrate the delivered volumes up to now, and stop the pump when a syringe is empty or the target is reached."""
+        now = time.monotonic() if now is None else now
+        if self.running:
+            start = self._last_update
+            directions = self.syringe_directions()
+            # find when the pump stops by itself, if that happens before now
+            end, empty = now, False
+            for letter, syringe in self.syringe.items():
+                remaining = syringe.remaining()
+                flow = syringe.ml_per_second() * directions[letter]
+                if remaining is not None and flow > 0 and start + remaining / flow < end:
+                    end, empty = start + remaining / flow, True
+            target_time = self.target_time(start, directions)
+            if target_time is not None and target_time < end:
+                end, empty = target_time, False
+            for letter, syringe in self.syringe.items():
+                syringe.delivered += syringe.ml_per_second() * directions[letter] * (end - start)
+            if end < now:
+                self.running = False
+                self.empty = empty
+        self._last_update = now
+
+    def target_time(self, start: float, directions: dict[str, int]) -> float | None:
+        """Return when the pump, running since start, reaches its target and stops by itself (None if never)."""
+        return None
+
+    # commands shared by all pumps
+
+    def cmd_VER(self, letter: str, value: str) -> str:
+        return self.firmware_version
+
+    def cmd_RUN(self, letter: str, value: str):
+        if self.running:
+            raise SimulatedPumpError("NA")
+        self.running = True
+        self.empty = False
+        self.update() # stops right away if a syringe is empty
+
+    def cmd_STP(self, letter: str, value: str):
+        self.running = False
+
+    def cmd_MOD(self, letter: str, value: str) -> str | None:
+        if not value:
+            return self.modes[self.mode]
+        elif value not in self.modes:
+            raise SimulatedPumpError("?")
+        self.mode = value
+
+    def cmd_DIA(self, letter: str, value: str) -> str | None:
+        syringe = self._syringe(letter)
+        if not value:
+            return _format_number(syringe.diameter)
+        elif self.running:
+            raise SimulatedPumpError("NA")
+        diameter = self._parse_number(value)
+        if not (0.1 <= diameter <= 50):
+            raise SimulatedPumpError("OOR")
+        syringe.diameter = float(_format_number(diameter))
+
+    def cmd_RAT(self, letter: str, value: str) -> str | None:
+        return self._rate(self._syringe(letter), value)
+
+    def cmd_DIR(self, letter: str, value: str) -> str | None:
+        if not value:
+            return self.direction
+        elif value == "INF":
+            self.direction = "INFUSE"
+        elif value == "REV":
+            self.direction = "REVERSE"
+        elif value == "REF":
+            self.direction = "REVERSE" if self.direction == "INFUSE" else "INFUSE"
+        else:
+            raise SimulatedPumpError("?")
+
+    # helpers
+
+    def _parse_number(self, value: str) -> float:
+        if not _NUMBER.fullmatch(value):
+            raise SimulatedPumpError("?")
+        return float(value)
+
+    def _rate(self, syringe: _Syringe, value: str) -> str | None:
+        """Get or set the rate of syringe."""
+        if not value:
+            return f"{_format_number(syringe.rate)} {syringe.unit}"
+        unit = _UNIT_CODES.get(value[-2:])
+        if unit is None:
+            raise SimulatedPumpError("?")
+        rate = self._parse_number(value[:-2])
+        if not (0 <= rate < 9999):
+            raise SimulatedPumpError("OOR")
+        syringe.rate = float(_format_number(rate))
+        syringe.unit = unit
+
+class SimulatedModel33(SimulatedPump):
+    """Simulated Harvard Apparatus Model 33, with two syringes (A and B)."""
+    firmware_version = "33 V1.0 (simulated)"
+    syringes = ("A", "B")
+    modes = {"AUT": "AUT", "PRO": "PRO", "CON": "CON"}
+
+    def __init__(self, address: int = 0, syringe_volume: float | None = None):
+        super().__init__(address, syringe_volume)
+        self.parallel = "OFF"
+
+    def syringe_directions(self) -> dict[str, int]:
+        sign = 1 if self.direction == "INFUSE" else -1
+        # in reciprocal mode syringe B moves the other way
+        return {"A": sign, "B": sign if self.parallel == "ON" else -sign}
+
+    def cmd_PAR(self, letter: str, value: str) -> str | None:
+        if not value:
+            return self.parallel
+        elif value not in ("ON", "OFF"):
+            raise SimulatedPumpError("?")
+        self.parallel = value
+
+class SimulatedPHD2000(SimulatedPump):
+    """Simulated Harvard Apparatus PHD 2000, with or without refill."""
+    firmware_version = "PHD 2000 V1.0 (simulated)"
+    modes = {"PMP": "PUMP", "VLM": "VOLUME"}
+
+    def __init__(self, address: int = 0, syringe_volume: float | None = None, refill: bool = False):
+        """
+        :param address: Address of the pump on the chain
+        :type address: int
+        :param syringe_volume: Volume of a full syringe in mL, None (default) for an endless syringe.
+        :type syringe_volume: float, optional
+        :param refill: Simulate the version with refill (RFR and AF commands), defaults to False
+        :type refill: bool
+        """
+        super().__init__(address, syringe_volume)
+        self.refill = refill
+        self.target_volume = 0.0
+        self.autofill = "OFF"
+        self.refill_rate = _Syringe(None)
+
+    def target_time(self, start: float, directions: dict[str, int]) -> float | None:
+        flow = self.syringe[""].ml_per_second() * directions[""]
+        if self.mode != "VLM" or self.target_volume <= 0 or flow <= 0:
+            return None
+        return start + max(0.0, self.target_volume - self.syringe[""].delivered) / flow
+
+    def cmd_DIR(self, letter: str, value: str) -> str | None:
+        if value:
+            raise SimulatedPumpError("?")
+        return super().cmd_DIR(letter, value)
+
+    def cmd_DEL(self, letter: str, value: str) -> str | None:
+        if value:
+            raise SimulatedPumpError("?")
+        return _format_number(max(0.0, self.syringe[""].delivered))
+
+    def cmd_CLD(self, letter: str, value: str):
+        self.syringe[""].delivered = 0.0
+
+    def cmd_TGT(self, letter: str, value: str) -> str | None:
+        if not value:
+            return _format_number(self.target_volume)
+        elif self.running:
+            raise SimulatedPumpError("NA")
+        self.target_volume = float(_format_number(self._parse_number(value)))
+
+    def cmd_AF(self, letter: str, value: str) -> str | None:
+        if not value:
+            return self.autofill
+        elif not self.refill:
+            raise SimulatedPumpError("NA")
+        elif value not in ("ON", "OFF"):
+            raise SimulatedPumpError("?")
+        self.autofill = value
+
+    def cmd_RFR(self, letter: str, value: str) -> str | None:
+        if not self.refill:
+            raise SimulatedPumpError("?")
+        return self._rate(self.refill_rate, value)
+
+class SimulatedChain:
+    """A daisy chain of simulated pumps.
+
+    Use handle() to answer raw commands directly (pumpy3.LoopbackTransport
+    does this for a Chain), or start() (or a with-block) to expose the chain
+    on a pseudo-terminal, of which the name is in port.
+    Replies are delayed by the time it takes to send the command and the
+    reply at the baudrate, plus response_delay for the pump to think. The
+    first byte of a reply comes as early as it would on a real chain.
+    """
+    def __init__(self, pumps: list[SimulatedPump] = (), baudrate: int = 9600, response_delay: float = 0.001):
+        """
+        :param pumps: Simulated pumps on the chain
+        :type pumps: list of SimulatedPump
+        :param baudrate: Baudrate used to calculate the transmission times, set to None to answer without delay
+        :type baudrate: int, optional
+        :param response_delay: Time in seconds the pumps take before answering
+        :type response_delay: float
+        """
+        self.pumps = {}
+        for pump in pumps:
+            self.add_pump(pump)
+        self.baudrate = baudrate
+        self.response_delay = response_delay
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop_pipe = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Simulated pump chain on {self.port} with {list(self.pumps.values())}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.stop()
+
+    def add_pump(self, pump: SimulatedPump):
+        """Connect a simulated pump to the chain."""
+        if pump.address in self.pumps:
+            raise ValueError(f"There already is a pump at address {pump.address} on the simulated chain")
+        self.pumps[pump.address] = pump
+
+    def transmission_time(self, nbytes: int) -> float:
+        """Time in seconds to send nbytes at the baudrate (1 start bit, 8 data bits, 2 stop bits)."""
+        if not self.baudrate:
+            return 0.0
+        return nbytes * 11 / self.baudrate
+
+    def handle(self, line: bytes) -> bytes | None:
+        """Answer a single command line (without carriage return), return the reply or None if no pump answers."""
+        text = line.decode(errors='replace').strip()
+        digits = _ADDRESS.match(text).group()
+        pump = self.pumps.get(int(digits) if digits else 0)
+        if pump is None:
+            return None
+        with self._lock:
+            return pump.handle(text[len(digits):]).encode()
+
+    def start(self) -> str:
+        """Expose the chain on a new pseudo-terminal, and return the name of its port."""
+        import tty # only available on POSIX systems
+        if self._thread is not None:
+            raise RuntimeError("Simulated chain already started")
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop_pipe = os.pipe()
+        self._thread = threading.Thread(target=self._serve, name=f"SimulatedChain {self.port}", daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        """Stop answering and close the pseudo-terminal."""
+        if self._thread is None:
+            return
+        os.write(self._stop_pipe[1], b'x')
+        self._thread.join()
+        for fd in (self._master, self._slave, *self._stop_pipe):
+            os.close(fd)
+        self._thread = None
+
+    def _serve(self):
+        buffer = b''
+        while True:
+            readable, _, _ = select.select([self._master, self._stop_pipe[0]], [], [])
+            if self._stop_pipe[0] in readable:
+                return
+            buffer += os.read(self._master, 1024)
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                received = time.monotonic()
+                reply = self.handle(line)
+                if reply is None:
+                    continue
+                # a real pump only has the command after it was sent, and the reply trickles in at the baudrate
+                delay = self.transmission_time(len(line) + 1) + self.response_delay + self.transmission_time(1)
+                delay -= time.monotonic() - received
+                if delay > 0:
+                    time.sleep(delay)
+                os.write(self._master, reply[:1])
+                time.sleep(self.transmission_time(len(reply) - 1))
+                os.write(self._master, reply[1:])
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a chain of Harvard Apparatus pumps on a pseudo-terminal.")
+    parser.add_argument('--model33', type=int, nargs='*', default=[], metavar='ADDRESS', help="addresses of simulated Model 33 pumps")
+    parser.add_argument('--phd2000', type=int, nargs='*', default=[], metavar='ADDRESS', help="addresses of simulated PHD 2000 pumps (without refill)")
+    parser.add_argument('--phd2000-refill', type=int, nargs='*', default=[], metavar='ADDRESS', help="addresses of simulated PHD 2000 pumps with refill")
+    parser.add_argument('--syringe-volume', type=float, default=None, help="volume of the syringes in mL (default: endless)")
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--response-delay', type=float, default=0.001, help="time in seconds the pumps take to answer")
+    args = parser.parse_args()
+    pumps = [SimulatedModel33(address, args.syringe_volume) for address in args.model33]
+    pumps += [SimulatedPHD2000(address, args.syringe_volume) for address in args.phd2000]
+    pumps += [SimulatedPHD2000(address, args.syringe_volume, refill=True) for address in args.phd2000_refill]
+    if not pumps:
+        parser.error("add at least one pump")
+    with SimulatedChain(pumps, baudrate=args.baudrate, response_delay=args.response_delay) as sim:
+        print(f"Simulated pumps at {sorted(sim.pumps)} listening on {sim.port}, press Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == '__main__':
+    main()
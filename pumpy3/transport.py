@@ -0,0 +1,201 @@
+"""Connections a Chain can talk to its pumps over.
+
+A Chain sends commands and reads replies through a Transport. Given a port
+name it opens a SerialTransport, but the pump classes work the same over
+any other transport:
+
+    chain = Chain("COM3")                                       # SerialTransport
+    chain = Chain(SerialTransport("socket://10.0.0.5:4001"))    # any pyserial URL
+    chain = Chain(FdTransport("/dev/ttyUSB0"))                  # file descriptor, POSIX only
+    chain = Chain(TcpTransport("10.0.0.5", 4001))               # serial server on the network
+    chain = Chain(LoopbackTransport(SimulatedChain([...])))     # simulated pumps in this process
+
+To talk over something else, subclass Transport and implement write(),
+read(), flush() and close().
+"""
+import logging
+import os
+import select
+import socket
+
+from .pump import Transport, SerialTransport
+
+logger = logging.getLogger(__name__)
+
+def _read_waiting(readable, read, size: int = 4096) -> bytes:
+    """Read everything that can be read without waiting, using select on readable."""
+    data = bytearray()
+    while select.select([readable], [], [], 0)[0]:
+        chunk = read(size)
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+class FdTransport(Transport):
+    """Create FdTransport object, talking over a file descriptor with plain os.read() and os.write() (POSIX only).
+
+    Terminals (serial ports, pseudo-terminals) are set to raw mode with the
+    settings of the pumps. This skips the layers of pyserial, and also works
+    for a pseudo-terminal of e.g. pumpy3.sim.
+    """
+    def __init__(self, port: str | int, baudrate: int | None = 9600):
+        """
+        :param port: Path of the device to open, or a file descriptor that is open already (it is not closed by close())
+        :type port: str or int
+        :param baudrate: Baudrate set on the pumps, None to leave the speed of the terminal as it is
+        :type baudrate: int, optional
+        """
+        self.baudrate = baudrate
+        self._path = None if isinstance(port, int) else port
+        self.port = f'fd {port}' if self._path is None else self._path
+        self._fd = port if self._path is None else None
+        if self._fd is None:
+            self.open()
+        else:
+            self._configure()
+
+    @property
+    def is_open(self) -> bool:
+        return self._fd is not None
+
+    def open(self):
+        if self._path is None:
+            raise NotImplementedError(f'{self} was given a file descriptor, it cannot be reopened')
+        self._fd = os.open(self._path, os.O_RDWR | os.O_NOCTTY)
+        self._configure()
+        self.flush()
+
+    def _configure(self):
+        if not os.isatty(self._fd):
+            return
+        import termios, tty # only available on POSIX systems
+        tty.setraw(self._fd)
+        attributes = termios.tcgetattr(self._fd)
+        attributes[2] |= termios.CSTOPB | termios.CLOCAL | termios.CREAD # 2 stop bits, like the pumps
+        if self.baudrate is not None:
+            attributes[4] = attributes[5] = getattr(termios, f'B{self.baudrate}')
+        termios.tcsetattr(self._fd, termios.TCSANOW, attributes)
+
+    def write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+
+    def read(self, size: int, timeout: float) -> bytes:
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return b''
+        return os.read(self._fd, size)
+
+    def fileno(self) -> int | None:
+        return self._fd
+
+    def flush(self) -> bytes:
+        return _read_waiting(self._fd, lambda size: os.read(self._fd, size))
+
+    def close(self):
+        if self._fd is not None and self._path is not None:
+            os.close(self._fd)
+        self._fd = None
+
+class TcpTransport(Transport):
+    """Create TcpTransport object, talking to a serial server on the network over a raw TCP connection.
+
+    The server passes bytes between the connection and the serial port of the
+    pumps as they are (e.g. ser2net in raw mode, or a serial device server),
+    and takes care of the baudrate itself.
+    """
+    def __init__(self, host: str, port: int, connect_timeout: float = 5.0):
+        """
+        :param host: Name or address of the server
+        :type host: str
+        :param port: TCP port of the server
+        :type port: int
+        :param connect_timeout: Maximum time to wait for the connection in seconds
+        :type connect_timeout: float
+        """
+        self.address = (host, port)
+        self.connect_timeout = connect_timeout
+        self.port = f'tcp://{host}:{port}'
+        self._socket = None
+        self.open()
+
+    @property
+    def is_open(self) -> bool:
+        return self._socket is not None
+
+    def open(self):
+        self._socket = socket.create_connection(self.address, timeout=self.connect_timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # commands are tiny, send them right away
+        self._socket.settimeout(None)
+
+    def write(self, data: bytes):
+        self._socket.sendall(data)
+
+    def read(self, size: int, timeout: float) -> bytes:
+        if not select.select([self._socket], [], [], timeout)[0]:
+            return b''
+        data = self._socket.recv(size)
+        if not data:
+            raise ConnectionError(f'{self.port} closed the connection')
+        return data
+
+    def fileno(self) -> int | None:
+        return None if self._socket is None else self._socket.fileno()
+
+    def flush(self) -> bytes:
+        return _read_waiting(self._socket, self._socket.recv)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+
+class LoopbackTransport(Transport):
+    """Create LoopbackTransport object, passing commands straight to an emulator in the same process.
+
+    Every command is answered right away by calling handle(line) of the
+    target (e.g. a pumpy3.sim.SimulatedChain), without a port, thread or
+    transmission delay in between. This measures the time spent in the
+    library itself, and runs on any platform.
+    """
+    port = 'loopback'
+
+    def __init__(self, target):
+        """
+        :param target: Object with a handle(line) method, or a function, taking a command without the carriage return and returning the reply (None for no reply)
+        :type target: SimulatedChain or callable
+        """
+        self.handle = getattr(target, 'handle', target)
+        self._pending = bytearray()  # written bytes not yet forming a complete command
+        self._replies = bytearray()  # replies not yet read
+        self._open = True
+
+    @property
+    def is_open(self) -> bool:
+        return self._open
+
+    def open(self):
+        self._open = True
+
+    def write(self, data: bytes):
+        self._pending += data
+        while (end := self._pending.find(b'\r')) >= 0:
+            reply = self.handle(bytes(self._pending[:end]))
+            del self._pending[:end + 1]
+            if reply:
+                self._replies += reply
+
+    def read(self, size: int, timeout: float) -> bytes:
+        # replies are complete as soon as the command is written, waiting would not bring more
+        data = bytes(self._replies[:size])
+        del self._replies[:size]
+        return data
+
+    def flush(self) -> bytes:
+        data = bytes(self._replies)
+        self._replies.clear()
+        return data
+
+    def close(self):
+        self._open = False
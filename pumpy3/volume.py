@@ -0,0 +1,307 @@
+"""Keep track of the volume the pumps move, without asking them.
+
+A VolumeIntegrator observes the transactions on a chain (see
+Chain.add_observer). Every reply ends with the state of the pump (infusing,
+refilling or stopped), and the rates are known from the commands that set or
+read them, so the volume moved by each syringe can be integrated over time on
+the computer. Reading it sends no commands:
+
+    integrator = VolumeIntegrator(chain)
+    integrator.track(pump)
+    pump.set_rate(2, "ml/hr")
+    pump.run()
+    ...
+    print(integrator.volume(pump))     # mL, infused is positive, refilled negative
+
+The rates the pumps report are volumetric already, so the syringe diameter is
+not needed. The model only learns about changes from replies, so a pump that
+stops by itself (a stall, the stop button, an empty syringe) is noticed at the
+next command to that pump; in volume mode the target volume is taken into
+account. Pumps that report their delivered volume (the PHD 2000) are
+reconciled with it every reconcile_interval seconds, and whenever a reply to
+a DEL command passes by. Settings changed on the pump itself are not seen, call
+track() again after changing them.
+
+With the volume loaded in a syringe (set_syringe_volume), the integrator
+predicts when it runs empty. check_interval() turns that into the time until
+the next state check: long while the syringe is far from empty, down to
+min_interval near the predicted end, so Pump.sleep_with_heartbeat() notices
+depletion quickly with few commands:
+
+    integrator.set_syringe_volume(pump, 10.0)   # mL in the syringe now
+    pump.run()
+    pump.sleep_with_heartbeat(3600, error_wakeup=True, volumes=integrator)
+"""
+import logging
+import threading
+import time
+
+from .pump import Chain, Pump, PumpModel33, PumpPHD2000, PumpPHD2000_Refill, TransactionRecord
+
+logger = logging.getLogger(__name__)
+
+_ML_PER_SECOND = {
+    "ul/mn": 1e-3 / 60,
+    "ml/mn": 1 / 60,
+    "ul/hr": 1e-3 / 3600,
+    "ml/hr": 1 / 3600,
+}
+
+class _PumpVolumes:
+    """What the integrator knows about a single pump."""
+    def __init__(self, pump: Pump):
+        self.syringes = pump._snapshot_syringes()
+        self.volumes = dict.fromkeys(self.syringes, 0.0) # syringe: mL moved, infused is positive
+        self.rates = {}                                  # syringe: mL/s
+        for syringe in self.syringes:
+            rate = pump._remembered_setting('RAT', syringe)
+            self.rates[syringe] = 0.0 if rate is None else rate[0] * _ML_PER_SECOND[rate[1]]
+        self.refill_rate = None                          # mL/s, for pumps with a separate refill rate
+        self.reciprocal = False                          # Model 33: the second syringe moves the other way
+        self.volume_mode = False                         # PHD 2000: stops at the target volume
+        self.target = None                               # mL
+        self.direction = 0                               # 1 infusing, -1 refilling, 0 stopped
+        self.since = time.monotonic()                    # the volumes are integrated up to this moment
+        self.reconciled = None                           # time.monotonic() of the last DEL reply
+        self.contents = {}                               # syringe: (mL loaded, volume moved at that moment)
+
+    def syringe(self, syringe: int) -> int:
+        """Syringe 0 means the first one on pumps with individually addressable syringes."""
+        return syringe if syringe in self.volumes else self.syringes[0]
+
+    def flow(self, syringe: int) -> float:
+        """Flow of a syringe in mL/s, positive when infusing."""
+        if not self.direction:
+            return 0.0
+        rate = self.refill_rate if self.direction < 0 and self.refill_rate is not None else self.rates[syringe]
+        sign = -self.direction if self.reciprocal and syringe != self.syringes[0] else self.direction
+        return sign * rate
+
+    def time_to_empty(self, syringe: int) -> float | None:
+        if syringe not in self.contents or self.flow(syringe) <= 0:
+            return None
+        loaded, mark = self.contents[syringe]
+        return max(0.0, loaded - (self.volumes[syringe] - mark)) / self.flow(syringe)
+
+    def zero(self, syringe: int):
+        """Set the volume moved by a syringe to 0, keeping what is left in it."""
+        if syringe in self.contents:
+            loaded, mark = self.contents[syringe]
+            self.contents[syringe] = (loaded - (self.volumes[syringe] - mark), 0.0)
+        self.volumes[syringe] = 0.0
+
+    def integrate(self, now: float):
+        for syringe in self.syringes:
+            volume = self.volumes[syringe] + self.flow(syringe) * (now - self.since)
+            if self.volume_mode and self.target and self.direction > 0:
+                volume = min(volume, max(self.target, self.volumes[syringe]))
+            self.volumes[syringe] = volume
+        self.since = now
+
+class VolumeIntegrator:
+    """Create VolumeIntegrator object, modelling the volume moved by every pump on a chain.
+
+    Rates, directions and the moments pumps start and stop are taken from
+    the transactions on the chain. Pumps are tracked from the first command
+    they get (with their remembered rates, see Pump.settings_ttl), or with
+    track(), which reads their settings from the pump.
+
+    On an AsyncChain the transactions are observed all the same, but track()
+    and reconcile() cannot be used: read the settings with the async methods,
+    and pass reconcile_interval=None.
+    """
+    def __init__(self, chain: Chain, reconcile_interval: float | None = 60.0):
+        """
+        :param chain: Chain of which the pumps are tracked
+        :type chain: Chain
+        :param reconcile_interval: Seconds after which volume() reads the delivered volume from pumps that report it (PHD 2000), None to never do this
+        :type reconcile_interval: float, optional
+        """
+        self.chain = chain
+        self.reconcile_interval = reconcile_interval
+        self._pumps = {}
+        self._lock = threading.RLock()
+        chain.add_observer(self._observe)
+
+    def __repr__(self):
+        return f"Volume integrator on {self.chain.port}"
+
+    def close(self):
+        """Stop observing the chain."""
+        self.chain.remove_observer(self._observe)
+
+    def track(self, pump: Pump):
+        """Start tracking a pump, reading its rates and state from the pump (a few commands).
+
+        The volumes start at 0, or at the delivered volume for pumps that report it.
+        """
+        with self._lock:
+            model = self._pumps[pump] = _PumpVolumes(pump)
+        # the replies are observed, and fill in the model
+        for syringe in model.syringes:
+            pump.get_rate(syringe)
+        if isinstance(pump, PumpModel33):
+            pump.get_parallel_reciprocal()
+        if isinstance(pump, PumpPHD2000_Refill):
+            pump.get_refill_rate()
+        if isinstance(pump, PumpPHD2000):
+            pump.get_target_volume()
+        pump.get_status(max_age=0)
+        with self._lock:
+            model.volumes = dict.fromkeys(model.syringes, 0.0)
+            model.since = time.monotonic()
+        self.reconcile(pump)
+
+    def volume(self, pump: Pump, syringe: int = 0) -> float:
+        """Return the volume in mL a syringe of pump has moved, infused is positive and refilled negative.
+
+        Sends no commands, except for pumps that report their delivered
+        volume: those are reconciled first when that was last done more than
+        reconcile_interval seconds ago.
+
+        :raises KeyError: if the pump is not tracked
+        """
+        with self._lock:
+            model = self._pumps[pump]
+            due = self.reconcile_interval is not None and isinstance(pump, PumpPHD2000) and (model.reconciled is None or time.monotonic() - model.reconciled >= self.reconcile_interval)
+        if due:
+            self.reconcile(pump)
+        with self._lock:
+            model.integrate(time.monotonic())
+            return model.volumes[model.syringe(syringe)]
+
+    def volumes(self) -> dict:
+        """Return the volumes of all tracked pumps, as {pump: {syringe: mL}}. Sends no commands."""
+        now = time.monotonic()
+        with self._lock:
+            for model in self._pumps.values():
+                model.integrate(now)
+            return {pump: dict(model.volumes) for pump, model in self._pumps.items()}
+
+    def flow_rate(self, pump: Pump, syringe: int = 0) -> float:
+        """Return the modelled flow rate of a syringe in mL/s: positive when infusing, negative when refilling, 0 when stopped."""
+        with self._lock:
+            model = self._pumps[pump]
+            return model.flow(model.syringe(syringe))
+
+    def set_syringe_volume(self, pump: Pump, volume: float | None, syringe: int = 0):
+        """Set the volume in a syringe of pump now, in mL, to predict when it runs empty. None to stop predicting.
+
+        :raises KeyError: if the pump is not tracked
+        """
+        with self._lock:
+            model = self._pumps[pump]
+            syringe = model.syringe(syringe)
+            model.integrate(time.monotonic())
+            if volume is None:
+                model.contents.pop(syringe, None)
+            else:
+                model.contents[syringe] = (volume, model.volumes[syringe])
+
+    def syringe_volume(self, pump: Pump, syringe: int = 0) -> float | None:
+        """Return the predicted volume left in a syringe of pump in mL, or None if set_syringe_volume() was not used. Sends no commands."""
+        with self._lock:
+            model = self._pumps[pump]
+            syringe = model.syringe(syringe)
+            if syringe not in model.contents:
+                return None
+            model.integrate(time.monotonic())
+            loaded, mark = model.contents[syringe]
+            return loaded - (model.volumes[syringe] - mark)
+
+    def time_to_empty(self, pump: Pump, syringe: int | None = None) -> float | None:
+        """Return the predicted number of seconds until a syringe of pump is empty. Sends no commands.
+
+        :param syringe: Syringe to predict for, None (default) for the first one of the pump to run empty
+        :type syringe: int, optional
+        :return: Seconds, 0 if it should be empty by now, None if the syringe is not infusing or its volume is unknown
+        :rtype: float or None
+        """
+        with self._lock:
+            model = self._pumps[pump]
+            model.integrate(time.monotonic())
+            syringes = model.syringes if syringe is None else [model.syringe(syringe)]
+            predictions = [t for t in map(model.time_to_empty, syringes) if t is not None]
+            return min(predictions, default=None)
+
+    def check_interval(self, pump: Pump, default: float, min_interval: float = 1.0, max_interval: float = 60.0) -> float:
+        """Return the number of seconds until the state of pump should be checked again, to notice an empty syringe within min_interval.
+
+        This is half the predicted time to empty, limited to between
+        min_interval and max_interval, so checks are sparse early on and
+        dense near the end. Without a prediction (see time_to_empty()) it is
+        default. Sends no commands.
+        """
+        remaining = self.time_to_empty(pump) if pump in self._pumps else None
+        if remaining is None:
+            return default
+        return min(max_interval, max(min_interval, remaining / 2))
+
+    def reset(self, pump: Pump):
+        """Set the volumes of a pump to 0, e.g. after changing syringes. Pumps that report their delivered volume are reset as well."""
+        with self._lock:
+            model = self._pumps[pump]
+            model.integrate(time.monotonic())
+            for syringe in model.syringes:
+                model.zero(syringe)
+        if isinstance(pump, PumpPHD2000):
+            pump.reset_volume_delivered() # otherwise the next reconciliation undoes the reset
+
+    def reconcile(self, pump: Pump | None = None):
+        """Correct the model with the delivered volume reported by the pumps that can (one DEL command per pump).
+
+        :param pump: Pump to reconcile, all tracked pumps if None
+        :type pump: Pump, optional
+        """
+        with self._lock:
+            pumps = list(self._pumps) if pump is None else [pump]
+        for pump in pumps:
+            if isinstance(pump, PumpPHD2000):
+                pump.get_volume_delivered() # the reply is observed
+
+    def _observe(self, record: TransactionRecord):
+        if record.error is not None or not record.reply:
+            return
+        pump = self.chain.pumps.get(record.address)
+        if pump is None:
+            return # a pump being created, or probed by Chain.discover()
+        now = time.monotonic()
+        lines = record.reply.splitlines()
+        data = lines[1].strip() if len(lines) > 2 else ''
+        value = record.instruction[len(record.address + record.command + pump.syringe_selection.get(record.syringe, '')):]
+        with self._lock:
+            model = self._pumps.get(pump)
+            if model is None:
+                model = self._pumps[pump] = _PumpVolumes(pump)
+                logger.info(f'{self}: tracking {pump.name}')
+            model.integrate(now)
+            try:
+                self._update(pump, model, record.command, record.syringe, value, data)
+            except (ValueError, KeyError, IndexError):
+                logger.warning(f'{self}: could not interpret <{record.instruction}> -> {data!r} of {pump.name}')
+            state = record.reply[-1]
+            model.direction = 1 if state == '>' else -1 if state == '<' else 0
+
+    def _update(self, pump: Pump, model: _PumpVolumes, command: str, syringe: int, value: str, data: str):
+        """Update the model of a pump with a command (value is empty for queries) and the data line of its reply."""
+        if command in ('RAT', 'RFR'):
+            if value:
+                units = {code: unit for unit, code in pump.unit_conversion.items()}
+                rate = float(value[:-2]) * _ML_PER_SECOND[units[value[-2:]]]
+            else:
+                rate = float(data[0:6]) * _ML_PER_SECOND[data[6:].strip()]
+            if command == 'RFR':
+                model.refill_rate = rate
+            else:
+                model.rates[model.syringe(syringe)] = rate
+        elif command == 'PAR':
+            model.reciprocal = (value or data) == 'OFF'
+        elif command == 'MOD':
+            model.volume_mode = (value or pump.mode_conversion.get(data)) == 'VLM'
+        elif command == 'TGT':
+            model.target = float(value or data)
+        elif command == 'DEL':
+            model.volumes[model.syringes[0]] = float(data)
+            model.reconciled = time.monotonic()
+        elif command == 'CLD':
+            model.zero(model.syringes[0])
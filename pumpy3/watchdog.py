@@ -0,0 +1,227 @@
+"""Watch all pumps on one or more chains from a single background thread.
+
+The watchdog checks the state of every registered pump every interval seconds.
+Every reply of a pump ends with its state, so a pump that answered another
+command in the last half interval is not asked again; otherwise the watchdog
+sends one MOD command. The polls are spread over the interval, and the time spent
+polling a chain is kept below max_utilization of the time of the chain, so
+there is room left for other commands. Changes are reported as PumpEvents:
+
+    def on_event(event):
+        if event.kind == EVENT_STALLED:
+            chain.emergency_stop_all()
+
+    with Watchdog([chain], interval=2.0) as watchdog:
+        watchdog.add_callback(on_event)
+        pump.run()
+        time.sleep(24 * 3600)
+
+A stall, stop or disconnection is reported at most 1.5 interval seconds (plus
+the time of a poll) after it happened, as long as the pumps of a chain can be
+polled within max_utilization of the interval. Otherwise the polls are spaced
+out further, and a warning is logged.
+"""
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+
+from .pump import Chain, Pump, PumpError, PumpNoResponseError
+
+logger = logging.getLogger(__name__)
+
+# Kinds of events reported by the watchdog.
+EVENT_STARTED = 'started'           # the pump started running
+EVENT_STOPPED = 'stopped'           # the pump stopped running (including interrupted, paused, or reaching its target)
+EVENT_STALLED = 'stalled'           # the pump reports a stall (see Pump.stalled_status)
+EVENT_DISCONNECTED = 'disconnected' # the pump did not answer, or the port failed
+EVENT_RECONNECTED = 'reconnected'   # the pump answers again after being disconnected
+
+@dataclass(frozen=True)
+class PumpEvent:
+    """A change of a pump noticed by a Watchdog."""
+    kind: str                          # one of the EVENT_... constants
+    pump: Pump
+    state: str | None                  # state symbol of the pump, None when disconnected
+    previous_state: str | None         # state symbol at the poll before, None if unknown
+    time: float                        # time.time() of the poll that noticed the change
+    error: BaseException | None = None # the error of a disconnection
+
+class Watchdog:
+    """Create Watchdog object, polling all pumps registered on the given chains.
+
+    Pumps registered on the chains later are picked up automatically. Events
+    are passed to the callbacks (see add_callback) and put in the events queue,
+    if one is given. Callbacks run on the watchdog thread, so they should
+    return quickly; exceptions raised by them are logged and otherwise ignored.
+    """
+    def __init__(self, chains: list[Chain], interval: float = 5.0, max_utilization: float = 0.25, events: queue.Queue | None = None):
+        """
+        :param chains: Chains of which the pumps are watched
+        :type chains: list of Chain
+        :param interval: Time in seconds between two polls of the same pump
+        :type interval: float
+        :param max_utilization: Maximum fraction of time the watchdog keeps a chain busy, between 0 and 1
+        :type max_utilization: float
+        :param events: Queue to put PumpEvents in, optional
+        :type events: queue.Queue
+        """
+        if not 0 < max_utilization <= 1:
+            raise ValueError(f'max_utilization must be between 0 and 1, not {max_utilization}')
+        self.chains = list(chains)
+        self.interval = interval
+        self.max_utilization = max_utilization
+        self.events = events
+        self.callbacks = []
+        self.states = {}            # pump: last state symbol, None while disconnected
+        self._schedule = []         # heap of (due time, order, pump)
+        self._order = itertools.count()
+        self._scheduled = set()
+        self._chain_free = {}       # chain: time.monotonic() before which the chain is not polled again
+        self._warned_slow = set()   # chains for which the polls could not keep up
+        self._disconnected = set()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return f"Watchdog on {', '.join(chain.port for chain in self.chains)} every {self.interval} s"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.stop()
+
+    def add_callback(self, callback):
+        """Call callback with every PumpEvent.
+
+        :param callback: Function taking a single PumpEvent
+        :type callback: callable
+        """
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """Stop calling a callback added with add_callback().
+
+        :raises ValueError: if callback was not added
+        """
+        self.callbacks.remove(callback)
+
+    def start(self):
+        """Start watching in a background thread."""
+        if self._thread is not None:
+            raise RuntimeError('Watchdog already started')
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._watch, name=repr(self), daemon=True)
+        self._thread.start()
+        logger.info(f'{self} started')
+
+    def stop(self):
+        """Stop watching, waits for a running poll to finish."""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        logger.info(f'{self} stopped')
+
+    def _watch(self):
+        while not self._stopping.is_set():
+            self._add_new_pumps()
+            if not self._schedule:
+                self._stopping.wait(self.interval)
+                continue
+            due, order, pump = self._schedule[0]
+            chain = pump.serialcon
+            free = self._chain_free.get(chain, 0.0)
+            if free > due:
+                # polling this chain now would keep it too busy, wait for it
+                if free - due > self.interval and chain not in self._warned_slow:
+                    logger.warning(f'{self}: pumps on {chain.port} cannot all be polled every {self.interval} s within {self.max_utilization:.0%} of the time of the chain, polling less often')
+                    self._warned_slow.add(chain)
+                heapq.heapreplace(self._schedule, (free, order, pump))
+                continue
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._stopping.wait(delay)
+                continue
+            heapq.heappop(self._schedule)
+            if chain.pumps.get(pump.address) is not pump:
+                self._scheduled.discard(pump) # removed from the chain
+                self.states.pop(pump, None)
+                continue
+            self._poll(pump)
+            heapq.heappush(self._schedule, (max(due + self.interval, time.monotonic()), order, pump))
+
+    def _add_new_pumps(self):
+        """Schedule pumps that were registered on the chains since the last check, spread over the interval."""
+        new = [pump for chain in self.chains for pump in list(chain.pumps.values()) if pump not in self._scheduled]
+        now = time.monotonic()
+        for i, pump in enumerate(new):
+            heapq.heappush(self._schedule, (now + self.interval * i / len(new), next(self._order), pump))
+            self._scheduled.add(pump)
+
+    def _poll(self, pump: Pump):
+        started = time.monotonic()
+        state, error = None, None
+        try:
+            # a prompt of the last half interval counts as a poll, the previous poll of the watchdog itself does not
+            state = pump.get_state(max_age=self.interval / 2)
+        except (PumpNoResponseError, OSError) as e: # serial.SerialException is an OSError too
+            error = e
+        except PumpError as e:
+            logger.warning(f'{self}: could not get the state of {pump.name}: {e}')
+            return
+        except Exception as e:
+            # e.g. a garbled reply that could not be parsed: report it like a failed port, and keep watching
+            logger.exception(f'{self}: polling {pump.name} failed')
+            error = e
+        finally:
+            finished = time.monotonic()
+            self._chain_free[pump.serialcon] = finished + (finished - started) * (1 - self.max_utilization) / self.max_utilization
+        self._update(pump, state, error)
+
+    def _update(self, pump: Pump, state: str | None, error: BaseException | None):
+        """Compare a poll to the previous one and emit the events."""
+        previous = self.states.get(pump)
+        if error is not None:
+            if pump not in self._disconnected:
+                self._disconnected.add(pump)
+                self.states[pump] = None
+                self._emit(EVENT_DISCONNECTED, pump, None, previous, error)
+            return
+        if pump in self._disconnected:
+            self._disconnected.discard(pump)
+            self._emit(EVENT_RECONNECTED, pump, state, previous)
+        self.states[pump] = state
+        if state == previous:
+            return
+        if state in pump.stalled_status:
+            self._emit(EVENT_STALLED, pump, state, previous)
+        elif previous is None:
+            return # first poll, or first after reconnecting: nothing to compare with
+        elif state in pump.running_status and previous not in pump.running_status:
+            self._emit(EVENT_STARTED, pump, state, previous)
+        elif state in pump.stopped_status and previous in pump.running_status:
+            self._emit(EVENT_STOPPED, pump, state, previous)
+
+    def _emit(self, kind: str, pump: Pump, state: str | None, previous: str | None, error: BaseException | None = None):
+        event = PumpEvent(kind, pump, state, previous, time.time(), error)
+        if kind in (EVENT_STALLED, EVENT_DISCONNECTED):
+            logger.warning(f'{pump.name}: {kind}' + (f' ({error})' if error else ''))
+        else:
+            logger.info(f'{pump.name}: {kind}')
+        if self.events is not None:
+            try:
+                self.events.put_nowait(event)
+            except queue.Full:
+                logger.warning(f'{self}: event queue is full, dropped {kind} event of {pump.name}')
+        for callback in list(self.callbacks):
+            try:
+                callback(event)
+            except Exception:
+                logger.exception(f'{self}: callback {callback!r} failed')